@@ -2,7 +2,8 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
 from .forms import UserRegisterForm
-from .models import Download, Extension, Format, Quality, Source, Command, UserProfile
+from .models import (Download, DownloadBatch, Extension, ExtractionCacheEntry, FileContent, Format,
+                     Quality, Source, Command, UserProfile)
 
 # Register your models here.
 
@@ -24,9 +25,12 @@ class CustomUserAdmin(UserAdmin):
 
 
 admin.site.register(Download)
+admin.site.register(DownloadBatch)
 admin.site.register(Extension)
 admin.site.register(Quality)
 admin.site.register(Format)
 admin.site.register(Source)
 admin.site.register(Command)
+admin.site.register(ExtractionCacheEntry)
+admin.site.register(FileContent)
 admin.site.register(UserProfile, CustomUserAdmin)
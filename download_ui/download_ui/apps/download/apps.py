@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class DownloadConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'download_ui.apps.download'
+
+    def ready(self):
+        from .models import Download
+        from .search import remove_from_search_index, update_search_index
+
+        # Keep the search index in step with the downloads
+        post_save.connect(update_search_index, sender=Download,
+                          dispatch_uid='download_update_search_index')
+        post_delete.connect(remove_from_search_index, sender=Download,
+                            dispatch_uid='download_remove_from_search_index')
@@ -0,0 +1,214 @@
+from datetime import time as time_of_day
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+import redis
+
+logger = logging.getLogger('__name__')
+
+KEY_PREFIX = 'bandwidth:'
+
+# Seconds of traffic a budget can save up while it is idle
+BURST_SECONDS = 1.0
+
+# Bytes taken from Redis at once and spent locally, so a download makes a
+# few round trips a second instead of one per block
+GRANT_SIZE = 256 * 1024
+
+# A download that stops drawing on a budget leaves its share after this long
+ACTIVE_TIMEOUT = 30
+
+# Seconds between a running download re-reading the limits and its share
+REFRESH_INTERVAL = 5.0
+
+# Takes ARGV[1] bytes from every bucket in KEYS, or none of them. ARGV then
+# holds a rate and a capacity per bucket. Returns 0 once taken, otherwise
+# the seconds until there are enough tokens.
+TAKE_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local wanted = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[i * 2])
+  local capacity = tonumber(ARGV[i * 2 + 1])
+  local bucket = redis.call('HMGET', key, 'tokens', 'time')
+  local level = tonumber(bucket[1]) or capacity
+  local last = tonumber(bucket[2]) or now
+  level = math.min(capacity, level + math.max(0, now - last) * rate)
+  tokens[i] = level
+  if level < wanted then
+    wait = math.max(wait, (wanted - level) / rate)
+  end
+end
+if wait > 0 then
+  return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+  redis.call('HSET', key, 'tokens', tostring(tokens[i] - wanted), 'time', tostring(now))
+  redis.call('EXPIRE', key, 3600)
+end
+return '0'
+"""
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.DOWNLOAD_BANDWIDTH_REDIS_URL)
+    return _client
+
+
+def current_limit(now=None):
+    """The shared limit in bytes per second at this time of day, 0 for none."""
+    moment = timezone.localtime(now).time()
+    for start, end, limit in settings.DOWNLOAD_BANDWIDTH_SCHEDULE:
+        start, end = time_of_day.fromisoformat(start), time_of_day.fromisoformat(end)
+        # A window like 22:00 to 06:00 runs past midnight
+        if start <= moment < end if start <= end else moment >= start or moment < end:
+            return limit
+    return settings.DOWNLOAD_BANDWIDTH_LIMIT
+
+
+def budgets_for(source, now=None):
+    """The (key, bytes per second) of every budget a download from the
+    source draws on."""
+    budgets = []
+    limit = current_limit(now)
+    if limit:
+        budgets.append((f'{KEY_PREFIX}all', limit))
+    source_limit = settings.DOWNLOAD_BANDWIDTH_SOURCES.get(source)
+    if source_limit:
+        budgets.append((f'{KEY_PREFIX}source:{source}', source_limit))
+    return budgets
+
+
+class BandwidthLimiter:
+    """Paces one download against the bandwidth budgets shared in Redis.
+
+    consume() is called with the bytes as they arrive and sleeps once the
+    download is ahead of the budgets. share() is the download's even split
+    of the tightest budget among the downloads drawing on it, for
+    downloaders with a rate limit of their own. If Redis is unreachable the
+    download carries on unthrottled.
+    """
+
+    def __init__(self, source, download_id, client=None, clock=time.monotonic, sleep=time.sleep):
+        self.source = source
+        self.member = str(download_id)
+        self.client = client
+        self.clock = clock
+        self.sleep = sleep
+        self.budgets = []
+        self.rate = None
+        self.balance = 0
+        self.next_refresh = None
+        self.lock = threading.Lock()
+        self.take = None
+
+    def __enter__(self):
+        self.refresh()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.leave(self.budgets)
+
+    def redis_call(self, method, *args):
+        try:
+            if self.client is None:
+                self.client = get_client()
+            return method(self.client, *args)
+        except redis.RedisError as error:
+            logger.warning('Bandwidth limiter unavailable, download %s is not throttled: %s',
+                           self.member, error)
+            self.budgets = []
+            self.rate = None
+            return None
+
+    def refresh(self):
+        budgets = budgets_for(self.source)
+        self.leave([budget for budget in self.budgets if budget not in budgets])
+        self.budgets = budgets
+        self.next_refresh = self.clock() + REFRESH_INTERVAL
+        if not budgets:
+            self.rate = None
+            return
+        counts = self.redis_call(self._join, budgets)
+        if counts is not None:
+            self.rate = min(limit / max(count, 1) for (_, limit), count in zip(budgets, counts))
+
+    def _join(self, client, budgets):
+        # Every budget keeps the downloads drawing on it in a sorted set,
+        # scored by when they drop out unless they refresh
+        now = time.time()
+        pipe = client.pipeline()
+        for key, _ in budgets:
+            active = f'{key}:active'
+            pipe.zremrangebyscore(active, '-inf', now)
+            pipe.zadd(active, {self.member: now + ACTIVE_TIMEOUT})
+            pipe.zcard(active)
+            pipe.expire(active, ACTIVE_TIMEOUT)
+        return pipe.execute()[2::4]
+
+    def leave(self, budgets):
+        if budgets:
+            self.redis_call(self._leave, budgets)
+
+    def _leave(self, client, budgets):
+        pipe = client.pipeline()
+        for key, _ in budgets:
+            pipe.zrem(f'{key}:active', self.member)
+        pipe.execute()
+
+    def share(self):
+        """Bytes per second for this download, None for no limit."""
+        if self.next_refresh is None or self.clock() >= self.next_refresh:
+            self.refresh()
+        return self.rate
+
+    def consume(self, size):
+        """Account for size bytes received and sleep while over budget."""
+        with self.lock:
+            self.share()
+            if not self.budgets:
+                self.balance = 0
+                return
+            self.balance -= size
+            capacity = min(limit * BURST_SECONDS for _, limit in self.budgets)
+            while self.balance < 0 and self.budgets:
+                wanted = int(max(1, min(max(-self.balance, GRANT_SIZE), capacity)))
+                wait = self.redis_call(self._take, wanted)
+                if wait is None:
+                    break
+                if wait > 0:
+                    self.sleep(wait)
+                else:
+                    self.balance += wanted
+
+    def _take(self, client, wanted):
+        if self.take is None:
+            self.take = client.register_script(TAKE_SCRIPT)
+        args = [wanted]
+        for _, limit in self.budgets:
+            args += [limit, max(limit * BURST_SECONDS, 1)]
+        return float(self.take(keys=[key for key, _ in self.budgets], args=args, client=client))
+
+
+class ThrottledWriter:
+    """A file wrapper that draws every write from a BandwidthLimiter."""
+
+    def __init__(self, target, limiter):
+        self.target = target
+        self.limiter = limiter
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.target.write(data)
+
@@ -0,0 +1,210 @@
+import http.client
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.error import URLError
+import urllib.request
+import urllib.response
+
+import certifi
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+import urllib3
+
+logger = logging.getLogger('__name__')
+
+# One retry for a keep-alive connection the server closed in the meantime,
+# nothing once the response has started
+RETRIES = urllib3.Retry(total=1, read=False, redirect=False)
+
+
+class HTTPPool:
+    """Keep-alive connections shared by the downloads of a worker process.
+
+    Up to per_host connections are kept open for each of the last hosts
+    hosts, more can be open at once but are closed after their request.
+    A host's connections are closed once it has not been used for
+    idle_seconds. stats() tells how many requests went over a connection
+    that was already open."""
+
+    def __init__(self, hosts, per_host, idle_seconds, ca_certs=None):
+        self.idle_seconds = idle_seconds
+        self.pid = os.getpid()
+        self.manager = urllib3.PoolManager(num_pools=hosts, maxsize=per_host, block=False,
+                                           cert_reqs='CERT_REQUIRED',
+                                           ca_certs=ca_certs or certifi.where())
+        # Keep the counts of the host pools that are thrown away
+        self.manager.pools.dispose_func = self.dispose
+        self.lock = threading.Lock()
+        # pool key -> (requests, when that count was first seen)
+        self.seen = {}
+        self.next_sweep = time.monotonic() + idle_seconds
+        self.closed_requests = 0
+        self.closed_connections = 0
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """A streamed response, read it to the end or close it to give the
+        connection back. Redirects and content encodings are left to the
+        caller."""
+        self.sweep()
+        return self.manager.request(method, url, body=body, headers=headers, timeout=timeout,
+                                    retries=RETRIES, redirect=False, preload_content=False,
+                                    decode_content=False)
+
+    def sweep(self):
+        if time.monotonic() >= self.next_sweep:
+            self.evict_idle()
+
+    def evict_idle(self, now=None):
+        now = time.monotonic() if now is None else now
+        idle = []
+        with self.lock:
+            self.next_sweep = now + max(self.idle_seconds / 2, 1)
+            seen = {}
+            for key in self.manager.pools.keys():
+                pool = self.manager.pools.get(key)
+                if pool is None:
+                    continue
+                count, since = self.seen.get(key, (None, now))
+                if count != pool.num_requests:
+                    seen[key] = (pool.num_requests, now)
+                elif now - since >= self.idle_seconds:
+                    idle.append(key)
+                else:
+                    seen[key] = (count, since)
+            self.seen = seen
+        for key in idle:
+            logger.debug('Closing the idle connections to %s', key.key_host)
+            try:
+                del self.manager.pools[key]
+            except KeyError:
+                pass
+        return len(idle)
+
+    def dispose(self, pool):
+        with self.lock:
+            self.closed_requests += pool.num_requests
+            self.closed_connections += pool.num_connections
+        pool.close()
+
+    def stats(self):
+        pools = [pool for pool in map(self.manager.pools.get, self.manager.pools.keys())
+                 if pool is not None]
+        with self.lock:
+            requests = self.closed_requests + sum(pool.num_requests for pool in pools)
+            connections = self.closed_connections + sum(pool.num_connections for pool in pools)
+        reused = max(requests - connections, 0)
+        return {
+            'hosts': len(pools),
+            'requests': requests,
+            'connections': connections,
+            'reused': reused,
+            'reuse_ratio': round(reused / requests, 3) if requests else 0.0,
+        }
+
+    def clear(self):
+        self.manager.clear()
+
+
+class PooledAdapter(HTTPAdapter):
+    """A requests adapter on an HTTPPool, for sessions that should share the
+    worker's connections."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        self.poolmanager = self.pool.manager
+
+    def send(self, request, **kwargs):
+        self.pool.sweep()
+        return super().send(request, **kwargs)
+
+    def close(self):
+        # The connections outlive the sessions using them
+        pass
+
+
+class PooledBody:
+    """A pooled response body for urllib. urllib3's read errors come out as
+    the socket errors urllib callers retry on."""
+
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, amt=None):
+        try:
+            return self.response.read(amt)
+        except urllib3.exceptions.ReadTimeoutError as error:
+            raise socket.timeout(str(error)) from error
+        except urllib3.exceptions.HTTPError as error:
+            raise ConnectionError(str(error)) from error
+
+    def readline(self, size=-1):
+        return self.response.readline(size)
+
+    def close(self):
+        # A body read to the end has already given its connection back, one
+        # closed half way gives back a closed connection
+        self.response.close()
+        self.response.release_conn()
+
+
+class PooledHTTPHandler(urllib.request.BaseHandler):
+    """Opens urllib's http and https requests on an HTTPPool. Proxied
+    requests are left to urllib's own handlers."""
+
+    # Ahead of HTTPHandler and HTTPSHandler, after ProxyHandler
+    handler_order = 400
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.open(req)
+
+    def https_open(self, req):
+        return self.open(req)
+
+    def open(self, req):
+        if req.has_proxy() or req._tunnel_host:
+            return None
+        # The headers as urllib's do_open sends them, without its
+        # Connection: close
+        headers = dict(req.unredirected_hdrs)
+        headers.update((name, value) for name, value in req.headers.items()
+                       if name not in headers)
+        headers = {name.title(): value for name, value in headers.items()
+                   if name.title() != 'Connection'}
+        timeout = req.timeout if isinstance(req.timeout, (int, float)) else None
+        try:
+            response = self.pool.request(req.get_method(), req.full_url, body=req.data,
+                                         headers=headers, timeout=timeout)
+        except urllib3.exceptions.HTTPError as error:
+            raise URLError(getattr(error, 'reason', None) or error) from error
+
+        message = http.client.HTTPMessage()
+        for name, value in response.headers.items():
+            message[name] = value
+        result = urllib.response.addinfourl(PooledBody(response), message, req.full_url,
+                                            response.status)
+        result.msg = response.reason
+        return result
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The HTTPPool of this process, a forked worker starts its own."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = HTTPPool(settings.DOWNLOAD_HTTP_POOL_HOSTS,
+                             settings.DOWNLOAD_HTTP_POOL_PER_HOST,
+                             settings.DOWNLOAD_HTTP_POOL_IDLE_SECONDS)
+        return _pool
@@ -0,0 +1,162 @@
+import json
+import logging
+import re
+import time
+
+from django.conf import settings
+import redis
+
+logger = logging.getLogger('__name__')
+
+CHANNEL_PREFIX = 'download-progress:'
+
+_client = None
+
+
+def channel_for(task_id):
+    return f'{CHANNEL_PREFIX}{task_id}'
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.DOWNLOAD_PROGRESS_REDIS_URL)
+    return _client
+
+
+def publish_progress(task_id, state, meta):
+    """Push a task state change to anyone streaming it. A broken stream
+    must never fail a download, so errors are only logged."""
+    if not settings.DOWNLOAD_PROGRESS_STREAM or not task_id:
+        return
+    message = json.dumps({'task_id': task_id, 'state': state, 'meta': meta})
+    try:
+        get_client().publish(channel_for(task_id), message)
+    except redis.RedisError as error:
+        logger.warning('Could not publish progress for %s: %s', task_id, error)
+
+
+class ProgressReporter:
+    """Coalesces download progress before it is written to the task state.
+
+    Progress hooks can fire hundreds of times a second, so a PROGRESS update
+    is only emitted once DOWNLOAD_PROGRESS_MIN_INTERVAL seconds or
+    DOWNLOAD_PROGRESS_MIN_DELTA percent have passed since the last one. The
+    first and last (100%) updates always go out, and anything held back is
+    flushed before the finished state. Emitted states are also published
+    for the progress stream.
+    """
+
+    def __init__(self, task, min_interval=None, min_delta=None, clock=time.monotonic):
+        self.task = task
+        self.min_interval = (settings.DOWNLOAD_PROGRESS_MIN_INTERVAL
+                             if min_interval is None else min_interval)
+        self.min_delta = (settings.DOWNLOAD_PROGRESS_MIN_DELTA
+                          if min_delta is None else min_delta)
+        self.clock = clock
+        self.last_time = None
+        self.last_percent = None
+        self.pending = None
+
+    def update(self, percent, meta):
+        now = self.clock()
+        if (self.last_time is None
+                or percent >= 100.0
+                or now - self.last_time >= self.min_interval
+                or abs(percent - self.last_percent) >= self.min_delta):
+            self.last_time = now
+            self.last_percent = percent
+            self.pending = None
+            self.emit('PROGRESS', meta)
+        else:
+            self.pending = meta
+
+    def flush(self):
+        if self.pending is not None:
+            meta, self.pending = self.pending, None
+            self.last_time = self.clock()
+            self.emit('PROGRESS', meta)
+
+    def finished(self, meta, state='FILENAME'):
+        self.flush()
+        self.emit(state, meta)
+
+    def emit(self, state, meta):
+        logger.info('%s %s', state, meta)
+        self.task.update_state(state=state, meta=meta)
+        publish_progress(self.task.request.id, state, meta)
+
+
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
+# twitch-dl rewrites its progress line with a carriage return
+LINE_BREAK = re.compile(r'[\r\n]')
+
+# Downloaded VOD 12/340 (3%) 24.1MB of ~683.5MB at 5.2MB/s remaining ~2 min 6 sec
+SEGMENT_PROGRESS = re.compile(
+    r'Downloaded VOD (?P<done>\d+)/(?P<total>\d+) \((?P<percent>\d+)%\) (?P<size>\S+)'
+    r' of ~(?P<estimate>\S+)(?:\s+at (?P<speed>\S+))?(?:\s+remaining ~(?P<remaining>.+))?$')
+
+DOWNLOADED = re.compile(r'Downloaded: (?P<filename>\S+)')
+
+
+class TwitchOutput:
+    """Stands in for stdout while twitch-dl downloads.
+
+    The output is parsed a line at a time as it is printed. Segment progress
+    goes to the ProgressReporter and the downloaded file name is kept, the
+    rest is dropped, so a long VOD doesn't pile its output up in memory.
+    """
+
+    # A line this long without a break is junk, drop it
+    MAX_LINE = 64 * 1024
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.partial = ''
+        self.filename = None
+
+    def write(self, text):
+        lines = LINE_BREAK.split(self.partial + text)
+        self.partial = lines.pop()
+        if len(self.partial) > self.MAX_LINE:
+            self.partial = ''
+        for line in lines:
+            self.parse_line(line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # The last line may not end in a line break
+        partial, self.partial = self.partial, ''
+        self.parse_line(partial)
+
+    def parse_line(self, line):
+        line = ANSI_ESCAPE.sub('', line).strip()
+        if not line:
+            return
+        match = SEGMENT_PROGRESS.match(line)
+        if match:
+            detail = f'{match["done"]}/{match["total"]} segments'
+            if match['speed']:
+                detail += f' at {match["speed"]}'
+            if match['remaining']:
+                detail += f', ~{match["remaining"]} left'
+            self.progress.update(float(match['percent']), {
+                'percent_str': f'{match["percent"]}%',
+                'percent': match['percent'],
+                'segments': int(match['done']),
+                'total_segments': int(match['total']),
+                'speed': match['speed'],
+                'detail': detail,
+            })
+            return
+        match = DOWNLOADED.match(line)
+        if match:
+            self.filename = match['filename']
+        elif line.startswith('Joining files'):
+            self.progress.update(100.0, {'percent_str': 'Joining', 'percent': '100',
+                                         'detail': 'Joining the segments'})
+
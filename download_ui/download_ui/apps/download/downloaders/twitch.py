@@ -0,0 +1,235 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+import logging
+import os
+import re
+import threading
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+import requests
+from twitchdl import commands, twitch, utils
+from twitchdl import download as twitch_download
+from twitchdl.download import DownloadFailed
+import urllib3
+
+from download_ui.apps.download.exceptions import ExtractionError, DownloadError
+from .bandwidth import ThrottledWriter
+from .downloader import Downloader, capture_stdout, is_transient, register_transient
+from .http_pool import get_pool
+from .progress import TwitchOutput
+from .twitch_client import get_client
+
+logger = logging.getLogger('__name__')
+
+# twitch-dl gives up on a segment after a few tries, the download can still
+# be tried again as a whole
+register_transient(DownloadFailed)
+
+
+def fetch_to_file(pool, url, path, limiter=None):
+    """What twitch-dl's _download does for a segment or clip, over the pool's
+    keep-alive connections and written through a ThrottledWriter when there
+    is a limiter. Failures are raised as the requests errors twitch-dl
+    retries on."""
+    tmp_path = path + '.tmp'
+    size = 0
+    try:
+        response = pool.request('GET', url, timeout=twitch_download.CONNECT_TIMEOUT)
+        try:
+            if response.status >= 400:
+                # Read the error page to keep the connection
+                response.drain_conn()
+                raise requests.HTTPError(f'{response.status} {response.reason} for {url}')
+            with open(tmp_path, 'wb') as target:
+                writer = ThrottledWriter(target, limiter) if limiter is not None else target
+                for chunk in response.stream(twitch_download.CHUNK_SIZE):
+                    writer.write(chunk)
+                    size += len(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+    except urllib3.exceptions.HTTPError as error:
+        raise requests.ConnectionError(str(error)) from error
+
+    os.rename(tmp_path, path)
+    return size
+
+
+# The (pool, limiter) of the download running in this context
+_download_context = contextvars.ContextVar('twitch_download', default=None)
+
+
+def pooled_download(url, path):
+    """Stands in for twitch-dl's _download, with the pool and limiter of the
+    download it runs for."""
+    pool, limiter = _download_context.get() or (get_pool(), None)
+    return fetch_to_file(pool, url, path, limiter)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """Runs every task in the context of the thread submitting it, so the
+    segment threads twitch-dl starts see the context of their download."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+_install_lock = threading.Lock()
+
+
+def install_pooled_download():
+    """Point twitch-dl at pooled_download, once for the process. twitch-dl
+    looks _download up on its module for every segment, the download
+    patching it for itself would change it under any other running."""
+    with _install_lock:
+        if twitch_download._download is not pooled_download:
+            twitch_download._download = pooled_download
+            twitch_download.ThreadPoolExecutor = ContextThreadPoolExecutor
+
+
+@contextmanager
+def pooled_twitch_download(limiter=None):
+    install_pooled_download()
+    token = _download_context.set((get_pool(), limiter))
+    try:
+        yield
+    finally:
+        _download_context.reset(token)
+
+
+class TwitchDownloader(Downloader):
+    command = 'TWDL'
+
+    # twitch-dl's own default for parallel VOD segment downloads
+    DEFAULT_MAX_WORKERS = 20
+
+    # twitch.tv/<channel> and twitch.tv/<channel>/videos
+    CHANNEL_URL = re.compile(
+        r'^https?://(?:www\.|m\.)?twitch\.tv/(?P<channel>\w+)(?:/videos)?/?(?:\?.*)?$')
+
+    def __init__(self, task=None, code='', max_workers=None, limiter=None):
+        Downloader.__init__(self, task, max_workers or self.DEFAULT_MAX_WORKERS, limiter)
+        self.code = code
+
+    @staticmethod
+    def format_size(total_bytes):
+        return utils.format_size(total_bytes)
+
+    @staticmethod
+    def get_download_opts(url, code, down_id, max_workers=DEFAULT_MAX_WORKERS):
+        options = namedtuple(
+            'Options', ['video', 'output', 'quality', 'overwrite', 'max_workers',
+                        'start', 'end', 'format', 'keep', 'no_join', 'auth_token'])
+        options.video = url
+        options.output = os.path.join(settings.FILE_PATH_FIELD_DIRECTORY,
+                                      f'twitch/{{title_slug}}-{down_id}-{code}.{{format}}')
+        options.quality = code
+        options.overwrite = False
+        # VOD segments are fetched by this many threads at once
+        options.max_workers = max_workers
+        # The rest keep twitch-dl's command line defaults
+        options.start = None
+        options.end = None
+        options.format = 'mkv'
+        options.keep = False
+        options.no_join = False
+        options.auth_token = None
+        return options
+
+    @staticmethod
+    def parse_extraction(result):
+        if not result:
+            raise ExtractionError(
+                'twitch-dl', 'Download Information not found')
+        # determine whether clip or video
+        if 'slug' in result:  # it's a clip
+            identifier = result['slug']
+            channel = result['broadcaster']
+            duration = result.get('durationSeconds')
+            format_info = []
+            for format_junk in result['videoQualities']:
+                res = format_junk['quality']
+                code = res
+                url = format_junk['sourceURL']
+                _, ext = os.path.splitext(url)
+                ext = ext.lstrip(".")
+                format_info.append((ext, res, code))
+        else:
+            identifier = result['id']
+            channel = result['creator']
+            duration = result.get('lengthSeconds')
+            format_info = []
+            for format_junk in result['playlists']:
+                res = format_junk['video']
+                code = res
+                ext = 'mkv'
+                format_info.append((ext, res, code))
+
+        results = {
+            'channel_name': channel['displayName'],
+            'title': result['title'],
+            'slug_id': identifier,
+            'source': 'Twitch',
+            'duration': duration,
+            'format_info': format_info
+        }
+        return results
+
+    def extract(self, url):
+        try:
+            client = get_client()
+            result = client.lookup([url])[url]
+            if result is not None and 'slug' not in result:
+                result['playlists'] = client.get_playlists(result)
+        except Exception as error:
+            raise ExtractionError('twitch-dl', str(error)) from error
+
+        return self.parse_extraction(result)
+
+    @staticmethod
+    def parse_batch_entry(video):
+        return {
+            'url': f'https://www.twitch.tv/videos/{video["id"]}',
+            'title': video['title'] or video['id'],
+            'slug_id': video['id'],
+            'channel_name': video['creator']['displayName'],
+            'source': 'Twitch',
+            'duration': video.get('lengthSeconds')
+        }
+
+    def extract_batch(self, url, limit):
+        match = self.CHANNEL_URL.match(url)
+        if not match or match['channel'] == 'videos':
+            raise ExtractionError('twitch-dl', 'Not a channel URL')
+        channel = match['channel']
+        try:
+            # Pages through the channel's past broadcasts, newest first
+            _, videos = twitch.channel_videos_generator(channel, limit, 'time', 'archive')
+            entries = [self.parse_batch_entry(video) for video in videos]
+        except Exception as error:
+            raise ExtractionError('twitch-dl', str(error)) from error
+
+        results = {
+            'title': f'{channel} videos',
+            'entries': entries
+        }
+        return results
+
+    def download(self, url, code, down_id):
+        try:
+            # Progress is parsed as it is printed instead of kept until the end
+            output = TwitchOutput(self.progress)
+            with capture_stdout(output), pooled_twitch_download(self.limiter):
+                commands.download(self.get_download_opts(url, code, down_id, self.max_workers))
+            output.close()
+        except SoftTimeLimitExceeded as soft:
+            raise soft
+        except Exception as error:
+            raise DownloadError('twitch-dl', str(error), transient=is_transient(error)) from error
+        if output.filename is None:
+            raise DownloadError('twitch-dl', 'The downloaded file was not reported')
+        logger.debug('Parsed filename as %s', output.filename)
+        self.progress.finished({'filename': output.filename})
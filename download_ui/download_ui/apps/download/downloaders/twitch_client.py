@@ -0,0 +1,133 @@
+import logging
+import threading
+
+from django.conf import settings
+import m3u8
+import requests
+from twitchdl import CLIENT_ID, twitch, utils
+
+from .http_pool import PooledAdapter, get_pool
+
+logger = logging.getLogger('__name__')
+
+# Videos and clips looked up in one GraphQL request
+BATCH_SIZE = 25
+
+ACCESS_TOKEN_PARAMS = '{platform: "web", playerBackend: "mediaplayer", playerType: "site"}'
+
+
+class TwitchError(Exception):
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+def parse_identifier(identifier):
+    """('video', id) or ('clip', slug) for a Twitch url, None if it is neither."""
+    video_id = utils.parse_video_identifier(identifier)
+    if video_id:
+        return 'video', video_id
+    slug = utils.parse_clip_identifier(identifier)
+    if slug:
+        return 'clip', slug
+    return None
+
+
+class TwitchClient:
+    """Twitch metadata over the worker's keep-alive connections, the same
+    data twitch-dl's info command prints but without a new connection for
+    every call."""
+
+    def __init__(self, pool=None):
+        self.session = requests.Session()
+        adapter = PooledAdapter(pool or get_pool())
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Client-ID'] = CLIENT_ID
+
+    def query(self, query):
+        response = self.session.post(settings.TWITCH_GQL_URL, json={'query': query},
+                                     timeout=settings.TWITCH_HTTP_TIMEOUT)
+        response.raise_for_status()
+        content = response.json()
+        if content.get('errors') and not content.get('data'):
+            raise TwitchError('GraphQL query failed', content['errors'])
+        if content.get('errors'):
+            # Aliased lookups fail one at a time, the rest are still good
+            logger.warning('Twitch GraphQL errors: %s', content['errors'])
+        return content.get('data') or {}
+
+    @staticmethod
+    def build_query(lookups):
+        fields = []
+        for index, (kind, key) in enumerate(lookups):
+            if kind == 'video':
+                fields.append(f'v{index}: video(id: "{key}") {{ {twitch.VIDEO_FIELDS} }}')
+                fields.append(f't{index}: videoPlaybackAccessToken(id: "{key}", '
+                              f'params: {ACCESS_TOKEN_PARAMS}) {{ signature value }}')
+            else:
+                fields.append(f'c{index}: clip(slug: "{key}") {{ {twitch.CLIP_FIELDS} }}')
+        return '{\n' + '\n'.join(fields) + '\n}'
+
+    def lookup(self, identifiers):
+        """Videos and clips by url, BATCH_SIZE to a request. Returns a dict of
+        identifier to the video or clip, None if Twitch has no such thing.
+        Videos come with their access token for get_playlists()."""
+        results = {}
+        lookups = []
+        for identifier in identifiers:
+            parsed = parse_identifier(identifier)
+            if parsed is None:
+                raise TwitchError(f'Invalid input: {identifier}')
+            lookups.append((identifier, parsed))
+
+        for start in range(0, len(lookups), BATCH_SIZE):
+            chunk = lookups[start:start + BATCH_SIZE]
+            data = self.query(self.build_query([parsed for _, parsed in chunk]))
+            for index, (identifier, (kind, _)) in enumerate(chunk):
+                if kind == 'video':
+                    video = data.get(f'v{index}')
+                    if video is not None:
+                        video['accessToken'] = data.get(f't{index}')
+                    results[identifier] = video
+                else:
+                    results[identifier] = data.get(f'c{index}')
+        return results
+
+    def get_playlists(self, video):
+        """The qualities of a video, as twitch-dl's info --json lists them."""
+        token = video.get('accessToken')
+        if not token:
+            raise TwitchError(f'No access token for video {video["id"]}')
+        response = self.session.get(
+            f'{settings.TWITCH_USHER_URL}/{video["id"]}',
+            params={
+                'nauth': token['value'],
+                'nauthsig': token['signature'],
+                'allow_audio_only': 'true',
+                'allow_source': 'true',
+                'player': 'twitchweb',
+            },
+            timeout=settings.TWITCH_HTTP_TIMEOUT)
+        response.raise_for_status()
+        return [
+            {
+                'bandwidth': playlist.stream_info.bandwidth,
+                'resolution': playlist.stream_info.resolution,
+                'codecs': playlist.stream_info.codecs,
+                'video': playlist.stream_info.video,
+                'uri': playlist.uri
+            } for playlist in m3u8.loads(response.text).playlists
+        ]
+
+
+_local = threading.local()
+
+
+def get_client():
+    """The client of the calling thread, sessions are not shared between
+    threads but their connections are, see http_pool.get_pool()."""
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = _local.client = TwitchClient()
+    return client
@@ -0,0 +1,288 @@
+from contextlib import contextmanager
+import logging
+import os
+import sys
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+import youtube_dl
+
+from download_ui.apps.download.exceptions import ExtractionError, DownloadError
+from .downloader import Downloader, is_transient, register_transient
+from .http_pool import PooledHTTPHandler, get_pool
+from .youtube_pool import YoutubeDLPool
+
+logger = logging.getLogger('__name__')
+
+# A download that ended early, the next attempt picks up the .part file
+register_transient(youtube_dl.utils.ContentTooShortError)
+
+# The worker process's YoutubeDLPool, None outside Celery workers
+_pool = None
+
+# Options that need urllib's own connections
+UNPOOLED_OPTIONS = ('proxy', 'nocheckcertificate', 'source_address')
+
+
+def build_youtube_dl(params):
+    """A YoutubeDL whose requests go over the process's shared keep-alive
+    connections, instead of a new connection for every request."""
+    ydl = youtube_dl.YoutubeDL(params)
+    if not any(params.get(option) for option in UNPOOLED_OPTIONS):
+        ydl._opener.add_handler(PooledHTTPHandler(get_pool()))
+    return ydl
+
+
+def start_pool():
+    """Give this process a pool of YoutubeDL instances, one per profile
+    built up front so the first tasks do not pay for it."""
+    global _pool
+    if settings.DOWNLOAD_YTDL_POOL_SIZE < 1:
+        return
+    _pool = YoutubeDLPool(settings.DOWNLOAD_YTDL_POOL_SIZE, settings.DOWNLOAD_YTDL_POOL_MAX_USES,
+                          factory=build_youtube_dl)
+    _pool.warm('extract', YoutubeDownloader.get_extract_opts())
+    _pool.warm('batch', YoutubeDownloader.get_batch_extract_opts(None))
+    _pool.warm('download', YoutubeDownloader.get_download_opts(None, 'best', 0))
+
+
+@contextmanager
+def open_youtube_dl(profile, params):
+    """A YoutubeDL for params, from the pool when the process has one."""
+    if _pool is not None:
+        with _pool.checkout(profile, params) as ydl:
+            yield ydl
+        return
+    ydl = build_youtube_dl(params)
+    with ydl:
+        yield ydl
+
+
+class YoutubeDownloader(Downloader):
+    command = 'YTDL'
+
+    def __init__(self, task=None, code='', max_workers=None, limiter=None):
+        Downloader.__init__(self, task, max_workers, limiter)
+        self.two_stages = '+bestaudio' in code
+        self.first_stage = True
+        self.final_filename = None
+        self.ydl = None
+        # Bytes so far per file, the hook only gets running totals
+        self.downloaded_bytes = {}
+
+    def throttle(self, down):
+        downloaded = down.get('downloaded_bytes') or 0
+        received = downloaded - self.downloaded_bytes.get(down.get('filename'), 0)
+        self.downloaded_bytes[down.get('filename')] = downloaded
+        if received > 0:
+            self.limiter.consume(received)
+        # youtube-dl reads the rate limit for every block, so the share
+        # follows other downloads starting and finishing
+        if self.ydl is not None:
+            self.ydl.params['ratelimit'] = self.limiter.share()
+
+    def my_hook(self, down):
+        if down['status'] == 'finished':
+            # If it's a youtube-dl download with separate audio and video
+            # Video is downloaded first and then audio
+            # We want to keep the filename from the video download
+            if self.two_stages and self.first_stage:
+                temp_path, ext = os.path.splitext(down['filename'])
+                file_sans_ext, _ = os.path.splitext(temp_path)
+                self.final_filename = f'{file_sans_ext}{ext}'
+                self.first_stage = False
+                self.progress.flush()
+            else:
+                filename = down['filename'] if not self.two_stages else self.final_filename
+                self.progress.finished({'filename': filename})
+                logger.debug("Done downloading %s", filename)
+
+        if down['status'] == 'downloading':
+            if self.limiter is not None:
+                self.throttle(down)
+            percent_str = down['_percent_str'].strip()
+            percent_float = float(percent_str.strip('%'))
+
+            # youtube-dl prints two separate progress percentages for the video and
+            # and audio download. The two have to be joined together
+            if self.two_stages:
+                percent_float = (percent_float / 2 if self.first_stage
+                                 else (percent_float / 2) + 50.0)
+                percent_str = f'{round(percent_float, 1)}%'
+
+            percent_int = str(round(percent_float))
+            self.progress.update(
+                percent_float,
+                {'percent_str': percent_str, 'percent': percent_int}
+            )
+
+    @staticmethod
+    def format_size(total_bytes):
+        return youtube_dl.utils.format_bytes(total_bytes)
+
+    @staticmethod
+    def get_download_opts(hook, code, down_id):
+        ydl_opts = {
+            'format': code,
+            'outtmpl': os.path.join(
+                settings.FILE_PATH_FIELD_DIRECTORY,
+                f'%(extractor_key)s/%(title)s-{down_id}-%(resolution)s.%(ext)s'
+            ),
+            'logger': logger,
+            'no_color': True,
+            'progress_hooks': [hook],
+            'restrictfilenames': True,
+            'noplaylist': True,
+            'nooverwrites': True,
+            # A retried or resumed download picks up its .part file
+            'continuedl': True
+        }
+        return ydl_opts
+
+    @staticmethod
+    def get_extract_opts():
+        ydl_opts = {
+            'logger': logger,
+            'no_color': True
+        }
+        return ydl_opts
+
+    @staticmethod
+    def get_batch_extract_opts(limit):
+        ydl_opts = {
+            'logger': logger,
+            'no_color': True,
+            # Only list the entries, each video is extracted when it downloads
+            'extract_flat': 'in_playlist',
+            'playlistend': limit
+        }
+        return ydl_opts
+
+    @staticmethod
+    def parse_extraction(result):
+        if not result:
+            raise ExtractionError(
+                'youtube-dl', 'Download Information not found')
+
+        format_info = []
+        audio_exists = False
+
+        for format_junk in result['formats']:
+            res = None
+            code = None
+            # Flip the boolean if audio only files are found but ignore them
+            if format_junk.get('vcodec') == 'none':
+                if format_junk.get('acodec') != 'none':
+                    audio_exists = True
+                continue
+            # If there are audio files, we only care about video only, if there
+            # are no audio files, we need combined files
+            if audio_exists:
+                if format_junk.get('acodec') != 'none':
+                    continue
+            else:
+                if format_junk.get('acodec') == 'none':
+                    continue
+            # Get the resolution string (cribbed from youtube-dl's formatting)
+            if format_junk.get('resolution') is not None:
+                res = format_junk['resolution']
+            elif format_junk.get('height') is not None:
+                if format_junk.get('width') is not None:
+                    res = f'{format_junk["width"]}x{format_junk["height"]}'
+                else:
+                    res = f'{format_junk["height"]}p'
+            elif format_junk.get('width') is not None:
+                res = f'{format_junk["width"]}x?'
+            else:
+                continue
+
+            # form code for formatting
+            # Always using best quality audio
+            if audio_exists:
+                format_id = format_junk['format_id']
+                code = f'{format_id}+bestaudio'
+            else:
+                code = format_junk['format_id']
+            format_info.append((format_junk['ext'], res, code))
+
+        results = {
+            'channel_name': result['channel'],
+            'title': result['title'],
+            'slug_id': result['id'],
+            'source': result['extractor_key'],
+            'duration': int(result['duration']) if result.get('duration') else None,
+            'format_info': format_info
+        }
+        return results
+
+    @staticmethod
+    def parse_batch_extraction(result):
+        if not result or result.get('_type') != 'playlist':
+            raise ExtractionError('youtube-dl', 'Not a playlist or channel')
+
+        entries = []
+        for entry in result.get('entries') or []:
+            if not entry or not entry.get('id'):
+                continue
+            url = entry.get('webpage_url') or entry.get('url') or entry['id']
+            # Flat YouTube entries only carry the video id
+            if '://' not in url and entry.get('ie_key') == 'Youtube':
+                url = f'https://www.youtube.com/watch?v={url}'
+            entries.append({
+                'url': url,
+                'title': entry.get('title') or entry['id'],
+                'slug_id': entry['id'],
+                'channel_name': (entry.get('channel') or entry.get('uploader')
+                                 or result.get('uploader') or ''),
+                'source': entry.get('ie_key') or result['extractor_key'],
+                'duration': int(entry['duration']) if entry.get('duration') else None
+            })
+
+        results = {
+            'title': result.get('title') or result['id'],
+            'entries': entries
+        }
+        return results
+
+    def extract(self, url):
+        try:
+            with open_youtube_dl('extract', self.get_extract_opts()) as ydl:
+                result = ydl.extract_info(
+                    url,
+                    download=False  # We just want to extract the info
+                )
+
+        except Exception as error:
+            _, exc_value, _ = sys.exc_info()
+            raise ExtractionError(
+                'youtube-dl', exc_value.exc_info[1]) from error
+
+        return self.parse_extraction(result)
+
+    def extract_batch(self, url, limit):
+        try:
+            with open_youtube_dl('batch', self.get_batch_extract_opts(limit)) as ydl:
+                result = ydl.extract_info(url, download=False)
+
+        except Exception as error:
+            _, exc_value, _ = sys.exc_info()
+            raise ExtractionError(
+                'youtube-dl', exc_value.exc_info[1]) from error
+
+        return self.parse_batch_extraction(result)
+
+    def download(self, url, code, down_id):
+        opts = self.get_download_opts(self.my_hook, code, down_id)
+        if self.limiter is not None:
+            opts['ratelimit'] = self.limiter.share()
+        try:
+            with open_youtube_dl('download', opts) as ydl:
+                self.ydl = ydl
+                result = ydl.download([url])
+            return result
+        except SoftTimeLimitExceeded as soft:
+            raise soft
+        except Exception as error:
+            _, exc_value, _ = sys.exc_info()
+            cause = exc_value.exc_info[1]
+            raise DownloadError('youtube-dl', cause, transient=is_transient(cause)) from error
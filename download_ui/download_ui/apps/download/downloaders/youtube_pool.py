@@ -0,0 +1,87 @@
+from contextlib import contextmanager
+import logging
+import threading
+
+import youtube_dl
+
+logger = logging.getLogger('__name__')
+
+
+class YoutubeDLPool:
+    """Idle YoutubeDL instances by option profile, for a worker process.
+
+    Building a YoutubeDL sets up the extractor list, the cookie jar and the
+    HTTP opener, and its extractors cache things like YouTube's player code.
+    A checked out instance gets the options of the task and a clean cookie
+    jar, and is thrown away after max_uses tasks to bound its caches. The
+    options of a profile that the constructor reads (proxy, timeouts,
+    cookiefile, postprocessors) have to stay the same from task to task.
+    Instances are built by factory, YoutubeDL itself by default."""
+
+    def __init__(self, size, max_uses, factory=None):
+        self.size = size
+        self.max_uses = max_uses
+        self.factory = factory
+        self.lock = threading.Lock()
+        # profile -> [(instance, uses)]
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+
+    def warm(self, profile, params):
+        with self.lock:
+            idle = self.idle.setdefault(profile, [])
+            if len(idle) < self.size:
+                idle.append((self.create(params), 0))
+
+    def create(self, params):
+        self.created += 1
+        return (self.factory or youtube_dl.YoutubeDL)(params)
+
+    @staticmethod
+    def reset(ydl, params):
+        # What YoutubeDL.__init__ sets from params or keeps per run
+        ydl.params = {'nocheckcertificate': False}
+        ydl.params.update(params)
+        ydl._progress_hooks = list(params.get('progress_hooks', []))
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl.cookiejar.clear()
+
+    def acquire(self, profile, params):
+        with self.lock:
+            idle = self.idle.get(profile)
+            entry = idle.pop() if idle else None
+        if entry is None:
+            return self.create(params), 0
+        ydl, uses = entry
+        self.reset(ydl, params)
+        self.reused += 1
+        return ydl, uses
+
+    def release(self, profile, ydl, uses):
+        if uses >= self.max_uses:
+            logger.debug('Recycling a %s YoutubeDL after %d uses', profile, uses)
+            return
+        with self.lock:
+            idle = self.idle.setdefault(profile, [])
+            if len(idle) < self.size:
+                idle.append((ydl, uses))
+
+    @contextmanager
+    def checkout(self, profile, params):
+        """A YoutubeDL set up with params for the length of the block."""
+        ydl, uses = self.acquire(profile, params)
+        try:
+            with ydl:
+                yield ydl
+        except youtube_dl.utils.YoutubeDLError:
+            # The video's fault, the instance is fine
+            self.release(profile, ydl, uses + 1)
+            raise
+        except BaseException:
+            # Interrupted somewhere inside youtube-dl, start over next time
+            logger.debug('Dropping a %s YoutubeDL after an error', profile)
+            raise
+        else:
+            self.release(profile, ydl, uses + 1)
@@ -17,9 +17,11 @@ class DownloadError(Exception):
     Attributes:
         tool -- the tool that failed to download
         message -- explanation of the error
+        transient -- whether trying again later could work
     """
 
-    def __init__(self, tool, message="Download Failed"):
+    def __init__(self, tool, message="Download Failed", transient=False):
         self.tool = tool
         self.message = message
+        self.transient = transient
         super().__init__(self.message)
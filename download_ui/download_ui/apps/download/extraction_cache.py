@@ -0,0 +1,133 @@
+import logging
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import ExtractionCacheEntry
+
+logger = logging.getLogger('__name__')
+
+YOUTUBE_HOSTS = {'youtube.com', 'music.youtube.com', 'youtube-nocookie.com'}
+YOUTUBE_PATH_PREFIXES = ('/shorts/', '/embed/', '/live/', '/v/')
+
+# Tracking parameters that never change what gets extracted
+IGNORED_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'pp', 'ab_channel'}
+
+
+def _strip_host(host):
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host
+
+
+def canonicalize_url(url):
+    """Collapse the different urls for the same video to a single form.
+
+    youtu.be/ID, youtube.com/watch?v=ID&t=30 and youtube.com/shorts/ID all
+    become https://youtube.com/watch?v=ID, Twitch clip links become
+    https://clips.twitch.tv/SLUG, and other urls lose their tracking
+    parameters, fragment and trailing slash.
+    """
+    parts = urlsplit(url.strip())
+    host = _strip_host(parts.netloc.lower())
+    path = parts.path.rstrip('/')
+    params = [(k, v) for k, v in parse_qsl(parts.query)
+              if k not in IGNORED_PARAMS and not k.startswith('utm_')]
+
+    if host == 'youtu.be' and path:
+        return f'https://youtube.com/watch?v={path.strip("/").split("/")[0]}'
+    if host in YOUTUBE_HOSTS:
+        video_id = dict(params).get('v')
+        for prefix in YOUTUBE_PATH_PREFIXES:
+            if path.startswith(prefix):
+                video_id = path[len(prefix):].split('/')[0]
+        if video_id:
+            return f'https://youtube.com/watch?v={video_id}'
+
+    if host == 'clips.twitch.tv' and path:
+        return f'https://clips.twitch.tv/{path.strip("/").split("/")[0]}'
+    if host == 'twitch.tv':
+        segments = path.strip('/').split('/')
+        if len(segments) == 3 and segments[1] == 'clip':
+            return f'https://clips.twitch.tv/{segments[2]}'
+        if len(segments) == 2 and segments[0] == 'videos':
+            return f'https://twitch.tv/videos/{segments[1]}'
+
+    return urlunsplit(('https', host, path, urlencode(sorted(params)), ''))
+
+
+def cache_key(command, url):
+    return f'{command}:{canonicalize_url(url)}'
+
+
+def get_extraction(command, url, count_miss=True):
+    """Return the cached extraction for the url or None on a miss.
+
+    A miss is counted on the stale entry if there is one, otherwise when
+    the extraction is stored. A lookup that is repeated by the extraction
+    it hands off to passes count_miss=False."""
+    key = cache_key(command, url)
+    now = timezone.now()
+    found = ExtractionCacheEntry.objects.filter(key=key, expires_at__gt=now).update(
+        hits=F('hits') + 1, last_used_at=now)
+    if not found:
+        logger.debug('Extraction cache miss for %s', key)
+        if count_miss:
+            ExtractionCacheEntry.objects.filter(key=key).update(misses=F('misses') + 1)
+        return None
+    logger.debug('Extraction cache hit for %s', key)
+    return ExtractionCacheEntry.objects.values_list('result', flat=True).get(key=key)
+
+
+def set_extraction(command, url, result):
+    """Store a successful extraction and evict the least recently used
+    entries once the cache is over its size limit."""
+    key = cache_key(command, url)
+    now = timezone.now()
+    ttl = settings.EXTRACTION_CACHE_TTL.get(
+        result['source'], settings.EXTRACTION_CACHE_TTL['default'])
+    values = {
+        'source': result['source'],
+        'result': result,
+        'expires_at': now + timedelta(seconds=ttl),
+        'last_used_at': now,
+    }
+    updated = ExtractionCacheEntry.objects.filter(key=key).update(**values)
+    if not updated:
+        try:
+            with transaction.atomic():
+                # The miss had no entry to be counted on
+                ExtractionCacheEntry.objects.create(key=key, misses=1, **values)
+        except IntegrityError:
+            # Another extraction of the same url stored it first
+            ExtractionCacheEntry.objects.filter(key=key).update(
+                misses=F('misses') + 1, **values)
+    evict()
+
+
+def evict():
+    ExtractionCacheEntry.objects.filter(expires_at__lte=timezone.now()).delete()
+    overflow = ExtractionCacheEntry.objects.count() - settings.EXTRACTION_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        oldest = ExtractionCacheEntry.objects.order_by(
+            'last_used_at').values_list('pk', flat=True)[:overflow]
+        ExtractionCacheEntry.objects.filter(pk__in=list(oldest)).delete()
+        logger.debug('Evicted %d extraction cache entries', overflow)
+
+
+def stats():
+    totals = ExtractionCacheEntry.objects.aggregate(hits=Sum('hits'), misses=Sum('misses'))
+    hits = totals['hits'] or 0
+    misses = totals['misses'] or 0
+    lookups = hits + misses
+    return {
+        'entries': ExtractionCacheEntry.objects.count(),
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / lookups if lookups else 0.0,
+    }
@@ -1,9 +1,12 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.core.mail import mail_admins
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, URLValidator
 from django.utils.translation import gettext_lazy as _get
 
-from .models import Download, Format, UserProfile
+from .models import Command, Download, DownloadBatch, Format, UserProfile
 
 
 class DownloadForm(forms.ModelForm):
@@ -12,15 +15,73 @@ class DownloadForm(forms.ModelForm):
         fields = ('command', 'url')
 
 
+class DownloadBatchForm(forms.ModelForm):
+    class Meta:
+        model = DownloadBatch
+        fields = ('command', 'url')
+        labels = {'url': _get('Playlist or channel URL')}
+
+
+class BulkImportForm(forms.Form):
+    command = forms.ModelChoiceField(queryset=Command.objects.all())
+    urls = forms.CharField(
+        label=_get('URLs'), required=False, widget=forms.Textarea(attrs={'rows': 8}),
+        help_text=_get('One link per line.'))
+    file = forms.FileField(
+        label=_get('Or a text file of links'), required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        lines = cleaned_data.get('urls', '').splitlines()
+        upload = cleaned_data.get('file')
+        if upload:
+            try:
+                lines += upload.read().decode('utf-8').splitlines()
+            except UnicodeDecodeError:
+                raise ValidationError(_get('The file has to be plain text.'), code='invalid')
+
+        urls = []
+        validate = URLValidator()
+        for line in lines:
+            url = line.strip()
+            if not url or url.startswith('#') or url in urls:
+                continue
+            try:
+                validate(url)
+            except ValidationError:
+                raise ValidationError(_get('Not a link: %(url)s'), code='invalid',
+                                      params={'url': url[:100]})
+            urls.append(url)
+
+        if not urls:
+            raise ValidationError(_get('Paste some links or choose a file.'), code='required')
+        limit = settings.DOWNLOAD_BULK_MAX_URLS
+        if len(urls) > limit:
+            raise ValidationError(_get('At most %(limit)d links at once.'), code='invalid',
+                                  params={'limit': limit})
+        cleaned_data['url_list'] = urls
+        return cleaned_data
+
+
 class DownloadFormatForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['file_format'].queryset = Format.objects.filter(
             choices__id=self.initial['id'])
+        if (self.instance.command_id is not None
+                and self.instance.command.name == Command.CommandName.TWITCHDL):
+            cap = settings.DOWNLOAD_MAX_WORKERS_CAP
+            self.fields['max_workers'].validators.append(MaxValueValidator(cap))
+            self.fields['max_workers'].widget.attrs.update({'min': 1, 'max': cap})
+            self.fields['max_workers'].help_text = _get(
+                'Segments downloaded at once, leave blank for the default.')
+        else:
+            # Only twitch-dl downloads segments in parallel
+            del self.fields['max_workers']
 
     class Meta:
         model = Download
-        fields = ('id', 'command', 'url', 'file_format')
+        fields = ('id', 'command', 'url', 'file_format', 'max_workers')
 
 
 class UserRegisterForm(UserCreationForm):
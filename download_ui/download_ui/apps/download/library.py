@@ -0,0 +1,91 @@
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+
+logger = logging.getLogger('__name__')
+
+# Bytes read at a time when hashing a file
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def scan_library(root):
+    """Return the set of file paths under root, found with one os.scandir
+    walk per directory.
+
+    Directories that can't be read are logged and skipped.
+    """
+    found = set()
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        found.add(entry.path)
+        except OSError as error:
+            logger.warning('Could not scan %s: %s', directory, error)
+    return found
+
+
+class LibraryFiles:
+    """Answers whether download files exist, from a single scan of the
+    library folder.
+
+    Paths outside the library folder are checked with os.path.exists.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.normpath(root)
+        self.paths = scan_library(self.root) if os.path.isdir(self.root) else None
+
+    def exists(self, path):
+        path = os.path.normpath(path)
+        if self.paths is not None and path.startswith(self.root + os.sep):
+            return path in self.paths
+        return os.path.exists(path)
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    """Return the hex SHA-256 of a file, read in large chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_duplicate(canonical, duplicate):
+    """Replace duplicate with a hardlink to canonical.
+
+    The link is made under a temporary name next to the duplicate and moved
+    over it, so the duplicate path always points at a complete file. Returns
+    False when the files are already linked or can't be (e.g. they are on
+    different filesystems).
+    """
+    if os.path.samefile(canonical, duplicate):
+        return False
+    directory = os.path.dirname(duplicate)
+    # os.link won't overwrite, a name taken in the meantime is tried again
+    for attempt in range(tempfile.TMP_MAX):
+        temp_path = os.path.join(directory, f'.dedupe-{uuid.uuid4().hex}')
+        try:
+            os.link(canonical, temp_path)
+            break
+        except FileExistsError:
+            continue
+        except OSError as error:
+            logger.warning('Could not link %s to %s: %s', duplicate, canonical, error)
+            return False
+    else:
+        raise FileExistsError(f'No free temporary name to link {duplicate}')
+    try:
+        os.replace(temp_path, duplicate)
+    except OSError:
+        os.remove(temp_path)
+        raise
+    return True
@@ -0,0 +1,207 @@
+from collections import defaultdict
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+# Runs in a fresh interpreter for every measurement. mark() records the
+# milliseconds since the previous mark and the peak RSS so far.
+CHILD_PRELUDE = '''
+import json, resource, sys, time
+started = time.perf_counter()
+phases = []
+def mark(name):
+    global started
+    now = time.perf_counter()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    rss_mb = rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    phases.append({'name': name, 'ms': (now - started) * 1000, 'rss_mb': rss_mb})
+    started = now
+'''
+
+CHILD_EPILOGUE = '''
+print(json.dumps(phases))
+'''
+
+# Each scenario is a list of phases, the code of a phase runs and is timed
+# in order after the previous ones
+SCENARIOS = {
+    # What every manage.py command, web and worker process pays first
+    'setup': [
+        ('setup', 'import django; django.setup()'),
+    ],
+    # A web process up to serving the home page once. The test database is
+    # set up in between and is not counted in the request
+    'first_request': [
+        ('setup', 'import django; django.setup()'),
+        ('database', '\n'.join([
+            'from django.test import Client',
+            'from django.test.utils import setup_databases, setup_test_environment',
+            'setup_test_environment()',
+            'setup_databases(verbosity=0, interactive=False)',
+            'from django.contrib.auth import get_user_model',
+            'client = Client()',
+            "client.force_login(get_user_model().objects.create(username='bench', is_approved=True))",
+        ])),
+        ('first_request', '\n'.join([
+            'from django.urls import reverse',
+            "response = client.get(reverse('download:home'))",
+            'assert response.status_code == 200, response.status_code',
+        ])),
+    ],
+    # A Celery worker loading its tasks, then the downloader backends its
+    # first extraction or download imports
+    'worker': [
+        ('setup', 'import django; django.setup()'),
+        ('tasks', '\n'.join([
+            'from download_ui.celery import app',
+            'app.loader.import_default_modules()',
+            'from download_ui.apps.download.tasks import worker_download',
+        ])),
+        ('backends', '\n'.join([
+            'from download_ui.apps.download.downloaders.downloader import get_backend, get_backends',
+            'for command in get_backends():',
+            '    get_backend(command)',
+        ])),
+    ],
+}
+
+
+def child_script(phases):
+    lines = [CHILD_PRELUDE]
+    for name, code in phases:
+        lines += [code, f'mark({name!r})']
+    lines.append(CHILD_EPILOGUE)
+    return '\n'.join(lines)
+
+
+def parse_importtime(output):
+    """The -X importtime lines of a run as (module, self ms, cumulative ms),
+    anything else on stderr is skipped."""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+    return imports
+
+
+def summarize_imports(imports, top):
+    packages = defaultdict(float)
+    for module, self_ms, _ in imports:
+        packages[module.split('.')[0]] += self_ms
+    slowest = sorted(imports, key=lambda row: row[2], reverse=True)[:top]
+    return {
+        'count': len(imports),
+        'total_ms': round(sum(self_ms for _, self_ms, _ in imports), 2),
+        # Self time by top level package, where the import time is spent
+        'packages': {package: round(ms, 2) for package, ms in sorted(
+            packages.items(), key=lambda item: item[1], reverse=True)[:top]},
+        # Cumulative time of the slowest single imports, with what they pull in
+        'slowest': [{'module': module, 'cumulative_ms': round(cumulative_ms, 2)}
+                    for module, _, cumulative_ms in slowest],
+    }
+
+
+class Command(BaseCommand):
+    help = ('Time django.setup(), the first home page request and a Celery worker '
+            'loading its tasks, each in fresh interpreters with -X importtime, and '
+            'write the results to a JSON file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenarios', default=','.join(SCENARIOS),
+            help='Comma separated scenarios to run')
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Runs per scenario, the medians are reported')
+        parser.add_argument(
+            '--top', type=int, default=15,
+            help='Packages and imports listed in the breakdown')
+        parser.add_argument(
+            '--output', default='startup_benchmark.json',
+            help='JSON file the results are written to')
+        parser.add_argument(
+            '--compare',
+            help='An earlier results file to print the differences against')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'].split(',')
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)['scenarios']
+
+        results = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'settings': settings.SETTINGS_MODULE,
+            'repeat': options['repeat'],
+            'scenarios': {name: self.benchmark(SCENARIOS[name], options['repeat'], options['top'])
+                          for name in names},
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+
+        self.report(results['scenarios'], baseline)
+        self.stdout.write(f"\nWrote {options['output']}")
+
+    def run_child(self, phases):
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', child_script(phases)],
+            capture_output=True, text=True, cwd=settings.BASE_DIR)
+        wall_ms = (time.perf_counter() - start) * 1000
+        if completed.returncode != 0:
+            raise CommandError(completed.stderr.strip().splitlines()[-1])
+        # Only the last line is ours, a print during setup stays out of the way
+        measured = json.loads(completed.stdout.strip().splitlines()[-1])
+        return wall_ms, measured, completed.stderr
+
+    def benchmark(self, phases, repeat, top):
+        # The first run writes the .pyc files, later restarts find them
+        self.run_child(phases)
+        runs = [self.run_child(phases) for _ in range(repeat)]
+        runs.sort(key=lambda run: run[0])
+        wall_ms, _, importtime = runs[len(runs) // 2]
+        return {
+            # The whole process, interpreter start and exit included
+            'wall_ms': round(wall_ms, 2),
+            'rss_mb': round(statistics.median(run[1][-1]['rss_mb'] for run in runs), 2),
+            'phases': [{
+                'name': name,
+                'ms': round(statistics.median(run[1][index]['ms'] for run in runs), 2),
+                'rss_mb': round(statistics.median(run[1][index]['rss_mb'] for run in runs), 2),
+            } for index, (name, _) in enumerate(phases)],
+            # From the median run
+            'imports': summarize_imports(parse_importtime(importtime), top),
+        }
+
+    def report(self, scenarios, baseline):
+        for name, result in scenarios.items():
+            line = f"{name:<14} {result['wall_ms']:>8.1f}ms {result['rss_mb']:>7.1f}MB"
+            previous = (baseline or {}).get(name)
+            if previous:
+                line += (f"  ({result['wall_ms'] - previous['wall_ms']:+.1f}ms "
+                         f"{result['rss_mb'] - previous['rss_mb']:+.1f}MB)")
+            self.stdout.write(line)
+            for phase in result['phases']:
+                self.stdout.write(f"  {phase['name']:<14} {phase['ms']:>8.1f}ms "
+                                  f"{phase['rss_mb']:>7.1f}MB")
+            packages = ', '.join(f'{package} {ms:.0f}ms' for package, ms
+                                 in list(result['imports']['packages'].items())[:5])
+            self.stdout.write(f"  {result['imports']['count']} imports, "
+                              f"{result['imports']['total_ms']:.0f}ms: {packages}")
@@ -0,0 +1,180 @@
+from contextlib import contextmanager
+from datetime import timedelta
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import (setup_databases, setup_test_environment, teardown_databases,
+                               teardown_test_environment)
+from django.urls import reverse
+from django.utils import timezone
+
+from download_ui.apps.download.models import (Command as DownloadCommand, Download, Extension,
+                                              Format, Quality, Source, UserProfile)
+from download_ui.apps.download.pagination import KeysetPaginator
+from download_ui.apps.download.search import get_search_backend
+
+# Every seeded download is this much older than the previous one, so the
+# last 24 hours always hold the same rows however big the table gets.
+SEED_SPACING = timedelta(minutes=10)
+
+SEED_BATCH_SIZE = 5000
+
+SEED_USERS = 20
+
+# Repeating status pattern for the seeded downloads, mostly completed like a
+# long running instance.
+SEED_STATUSES = [Download.Status.COMPLETED] * 7 + [
+    Download.Status.FAILED,
+    Download.Status.ARCHIVED,
+    Download.Status.MISSING,
+]
+
+
+@contextmanager
+def explicit_timestamps():
+    # Let bulk_create keep the seeded created_at and updated_at values
+    fields = [Download._meta.get_field('created_at'), Download._meta.get_field('updated_at')]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database with downloads and time the home, '
+            'create dedupe and list views as the table grows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='1000,10000,100000',
+            help='Comma separated table sizes to measure at')
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='Requests per view and size, the median is reported')
+        parser.add_argument(
+            '--explain', action='store_true',
+            help='Print the query plans at the largest size')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.benchmark(sizes, options['repeat'], options['explain'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+    def benchmark(self, sizes, repeat, explain):
+        self.now = timezone.now()
+        self.seed_fixtures()
+        client = Client()
+        client.force_login(self.users[0])
+
+        slug_id = 'slug-1'
+        file_format = self.formats[0]
+        cases = {
+            'home': lambda: client.get(reverse('download:home')),
+            'create dedupe': lambda: list(Download.objects.filter(
+                slug_id=slug_id, status=Download.Status.COMPLETED)),
+            'update dedupe': lambda: list(Download.objects.filter(
+                slug_id=slug_id, status=Download.Status.COMPLETED, file_format=file_format)),
+            'list': lambda: client.get(reverse('download:list')),
+            'list deep page': lambda: client.get(reverse('download:list'),
+                                                 {'cursor': self.deep_cursor}),
+            'list mine': lambda: client.get(reverse('download:list') + '?mine'),
+            'list search': lambda: client.get(reverse('download:list') + '?q=12345'),
+        }
+
+        self.stdout.write(f"{'rows':>8}  " + '  '.join(f'{name:>14}' for name in cases))
+        for size in sizes:
+            self.seed_downloads(size)
+            timings = [self.measure(case, repeat) for case in cases.values()]
+            self.stdout.write(f'{size:>8}  ' + '  '.join(
+                f'{ms:>7.2f}ms {queries:>2}q' for ms, queries in timings))
+
+        if explain:
+            self.explain({
+                'home': Download.objects.filter(
+                    created_at__gte=self.now - timedelta(hours=24),
+                    created_by=self.users[0]).exclude(status=Download.Status.DRAFT),
+                'dedupe': Download.objects.filter(
+                    slug_id=slug_id, status=Download.Status.COMPLETED, file_format=file_format),
+                'nightly': Download.objects.filter(status=Download.Status.COMPLETED),
+            })
+
+    def seed_fixtures(self):
+        self.users = [UserProfile.objects.create(username=f'bench{num}', is_approved=True)
+                      for num in range(SEED_USERS)]
+        self.command = DownloadCommand.objects.create(name=DownloadCommand.CommandName.YOUTUBEDL)
+        self.source = Source.objects.create(name='Youtube')
+        extension = Extension.objects.create(name='mp4')
+        self.formats = [
+            Format.objects.create(quality=Quality.objects.create(name=name), extension=extension,
+                                  command=self.command, format_code=code)
+            for code, name in [('18', '360p'), ('22', '720p'), ('137', '1080p')]
+        ]
+        self.seeded = 0
+
+    def seed_downloads(self, size):
+        with explicit_timestamps():
+            while self.seeded < size:
+                batch = range(self.seeded, min(size, self.seeded + SEED_BATCH_SIZE))
+                Download.objects.bulk_create([self.make_download(num) for num in batch])
+                self.seeded = batch.stop
+        # bulk_create skips the signals that keep the search index updated
+        get_search_backend().rebuild()
+        # The cursor for one of the last pages of the list
+        ordered = Download.objects.order_by('-created_at', '-id')
+        self.deep_cursor = KeysetPaginator(ordered, 20).encode_cursor(
+            'next', ordered[max(size - 30, 0)])
+
+    def make_download(self, num):
+        # About three downloads per video in different formats
+        created_at = self.now - SEED_SPACING * num
+        return Download(
+            command=self.command,
+            source=self.source,
+            created_by=self.users[num % len(self.users)],
+            url=f'https://www.youtube.com/watch?v=slug-{num // 3}',
+            file_path=f'/downloads/slug-{num // 3}-{num % 3}.mp4',
+            title=f'Video {num // 3}',
+            slug_id=f'slug-{num // 3}',
+            channel_name=f'Channel {num % 50}',
+            size='10.00MiB',
+            status=SEED_STATUSES[num % len(SEED_STATUSES)],
+            active_task_id=f'task-{num}',
+            file_format=self.formats[num % len(self.formats)],
+            created_at=created_at,
+            updated_at=created_at,
+        )
+
+    def measure(self, case, repeat):
+        # Count with an execute wrapper, the test client resets the query log
+        # at the start of every request
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        case()
+        with connection.execute_wrapper(count_query):
+            case()
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            case()
+            durations.append((time.perf_counter() - start) * 1000)
+        return statistics.median(durations), len(queries)
+
+    def explain(self, querysets):
+        for name, queryset in querysets.items():
+            self.stdout.write(f'\n{name}:\n{queryset.explain()}')
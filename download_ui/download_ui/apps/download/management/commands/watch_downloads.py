@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from download_ui.apps.download.tasks import check_for_missing_files
+from download_ui.apps.download.watcher import LibraryWatcher
+
+
+class Command(BaseCommand):
+    help = ('Watch FILE_PATH_FIELD_DIRECTORY with inotify and mark downloads missing '
+            'as their files are deleted or moved away.')
+
+    def handle(self, *args, **options):
+        try:
+            watcher = LibraryWatcher(settings.FILE_PATH_FIELD_DIRECTORY,
+                                     settings.DOWNLOAD_FILE_WATCHER_BATCH_SECONDS)
+        except ImproperlyConfigured as error:
+            raise CommandError(error)
+
+        # The watches are in place, catch up on what changed while nothing
+        # was watching
+        stats = check_for_missing_files()
+        self.stdout.write(f"Checked {stats['checked']} downloads, "
+                          f"{stats['missing']} missing. Watching {watcher.root}")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
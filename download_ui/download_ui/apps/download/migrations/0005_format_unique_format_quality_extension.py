@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:05
+
+from django.db import migrations, models
+
+
+def merge_duplicate_formats(apps, schema_editor):
+    # get_or_create could race and leave duplicate formats behind, point
+    # everything at the oldest one before the unique constraint goes on
+    Format = apps.get_model('download', 'Format')
+    Download = apps.get_model('download', 'Download')
+    Through = Download.choices_for.through
+    keep = {}
+    for file_format in Format.objects.order_by('id'):
+        pair = (file_format.quality_id, file_format.extension_id)
+        if pair not in keep:
+            keep[pair] = file_format.id
+            continue
+        Download.objects.filter(file_format_id=file_format.id).update(
+            file_format_id=keep[pair])
+        download_ids = Through.objects.filter(
+            format_id=file_format.id).values_list('download_id', flat=True)
+        Through.objects.bulk_create([
+            Through(download_id=download_id, format_id=keep[pair])
+            for download_id in download_ids
+        ], ignore_conflicts=True)
+        file_format.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0004_extractioncacheentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_formats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='format',
+            constraint=models.UniqueConstraint(fields=('quality', 'extension'), name='unique_format_quality_extension'),
+        ),
+    ]
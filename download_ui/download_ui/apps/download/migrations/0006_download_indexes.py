@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0005_format_unique_format_quality_extension'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='download',
+            index=models.Index(fields=['slug_id', 'status', 'file_format'], name='download_slug_status_format'),
+        ),
+        migrations.AddIndex(
+            model_name='download',
+            index=models.Index(fields=['created_at', 'status'], name='download_created_status'),
+        ),
+        migrations.AddIndex(
+            model_name='download',
+            index=models.Index(fields=['created_by', 'created_at'], name='download_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='download',
+            index=models.Index(fields=['status'], name='download_status'),
+        ),
+    ]
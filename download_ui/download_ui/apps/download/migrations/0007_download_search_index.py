@@ -0,0 +1,42 @@
+import logging
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+logger = logging.getLogger('__name__')
+
+
+def create_search_index(apps, schema_editor):
+    # Full text search is only built on SQLite, other databases search with LIKE
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE download_search USING fts5('
+            'title, channel_name, source, url, tokenize="trigram")')
+    except OperationalError as error:
+        # FTS5 or the trigram tokenizer (SQLite 3.34+) is missing, searches
+        # fall back to LIKE queries
+        logger.info('Skipping the download search index: %s', error)
+        return
+    schema_editor.execute(
+        'INSERT INTO download_search (rowid, title, channel_name, source, url) '
+        'SELECT d.id, d.title, d.channel_name, s.name, d.url '
+        'FROM download_download d JOIN download_source s ON s.id = d.source_id')
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS download_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0006_download_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
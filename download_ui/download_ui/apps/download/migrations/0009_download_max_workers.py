@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:01
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0008_file_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='download',
+            name='max_workers',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0009_download_max_workers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='download',
+            name='duration',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'High'), (1, 'Normal'), (2, 'Low')], default=1),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='download',
+            name='status',
+            field=models.CharField(choices=[('D', 'Draft'), ('S', 'Started'), ('F', 'Failed'), ('C', 'Completed'), ('A', 'Archived'), ('M', 'Missing'), ('T', 'Terminated'), ('Q', 'Queued')], default='D', max_length=1),
+        ),
+        migrations.AddIndex(
+            model_name='download',
+            index=models.Index(fields=['status', 'finished_at'], name='download_status_finished'),
+        ),
+    ]
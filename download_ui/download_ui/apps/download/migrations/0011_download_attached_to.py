@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0010_download_scheduling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='download',
+            name='attached_to',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='attached', to='download.download'),
+        ),
+    ]
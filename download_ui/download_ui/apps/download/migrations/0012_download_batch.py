@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('download', '0011_download_attached_to'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('url', models.URLField(max_length=300)),
+                ('title', models.CharField(blank=True, max_length=200)),
+                ('status', models.CharField(choices=[('E', 'Extracting'), ('S', 'Started'), ('F', 'Failed')], default='E', max_length=1)),
+                ('error', models.CharField(blank=True, max_length=300)),
+                ('command', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='download.command')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('file_format', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='download.format')),
+            ],
+            options={
+                'ordering': ['-created_at', '-updated_at'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='downloads', to='download.downloadbatch'),
+        ),
+    ]
@@ -1,11 +1,14 @@
 import logging
 import os
+import re
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _get
 
 from .downloaders.downloader import Downloader
@@ -72,21 +75,163 @@ class Extension(TimestampedModel):
         return self.name
 
 
+def ids_by_name(model, names):
+    """Map each name to the id of its row, inserting the missing rows."""
+    ids = dict(model.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = [name for name in names if name not in ids]
+    if missing:
+        model.objects.bulk_create([model(name=name) for name in missing],
+                                  ignore_conflicts=True)
+        ids.update(model.objects.filter(name__in=missing).values_list('name', 'id'))
+    return ids
+
+
 class Format(models.Model):
     quality = models.ForeignKey(Quality, on_delete=models.CASCADE)
     extension = models.ForeignKey(Extension, on_delete=models.CASCADE)
     command = models.ForeignKey(Command, on_delete=models.CASCADE)
     format_code = models.CharField(max_length=100)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['quality', 'extension'],
+                                    name='unique_format_quality_extension'),
+        ]
+
     def __str__(self):
         return f'{self.extension.name} : {self.quality.name}'
 
+    @classmethod
+    def bulk_get_or_create(cls, command_name, format_info):
+        """Write the format catalog for an extraction's format_info in a
+        fixed number of queries and return the Format ids in order.
+
+        Formats are matched on extension and quality like get_or_create,
+        the format code and command only apply to newly created rows.
+        """
+        if not format_info:
+            return []
+        extensions = ids_by_name(Extension, {ext for ext, _, _ in format_info})
+        qualities = ids_by_name(Quality, {qual for _, qual, _ in format_info})
+        command = Command.objects.get(name=command_name)
+
+        codes = {}
+        for ext, qual, code in format_info:
+            codes.setdefault((extensions[ext], qualities[qual]), code)
+
+        def fetch(pairs):
+            found = cls.objects.filter(extension_id__in={ext for ext, _ in pairs},
+                                       quality_id__in={qual for _, qual in pairs})
+            return {(ext, qual): pk for pk, ext, qual in
+                    found.values_list('id', 'extension_id', 'quality_id')
+                    if (ext, qual) in pairs}
+
+        format_ids = fetch(codes.keys())
+        missing = [pair for pair in codes if pair not in format_ids]
+        if missing:
+            cls.objects.bulk_create([
+                cls(extension_id=ext, quality_id=qual, command=command,
+                    format_code=codes[(ext, qual)])
+                for ext, qual in missing
+            ], ignore_conflicts=True)
+            format_ids.update(fetch(set(missing)))
+
+        return [format_ids[pair] for pair in codes]
+
+
+# 1920x1080, 1080p60 or 720p
+QUALITY_PATTERN = re.compile(r'(?:\d+x(?P<height>\d+)|(?P<lines>\d+)p(?P<fps>\d*))')
+
+
+def quality_rank(quality, max_height):
+    """Sort key for picking a default quality, higher is better. The
+    tallest video up to max_height wins, then the highest frame rate."""
+    match = QUALITY_PATTERN.search(quality)
+    if not match:
+        return (False, 0, 0)
+    height = int(match['height'] or match['lines'])
+    fps = int(match['fps'] or 0)
+    if height > max_height:
+        # Too tall, but better than nothing and the closer the better
+        return (False, -height, fps)
+    return (True, height, fps)
+
+
+class ExtractionCacheEntry(models.Model):
+    # The command name and canonical url of the extraction
+    key = models.CharField(unique=True, max_length=400)
+
+    # The website the extraction came from
+    source = models.CharField(max_length=100)
+
+    # The parsed info extraction
+    result = models.JSONField()
+
+    # Lookups served from this entry
+    hits = models.PositiveIntegerField(default=0)
+
+    # Times this entry had to be filled by a real extraction
+    misses = models.PositiveIntegerField(default=0)
+
+    # When the entry goes stale
+    expires_at = models.DateTimeField()
+
+    # When the entry was last stored or served, used for LRU eviction
+    last_used_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+class FileContent(TimestampedModel):
+    # Hex SHA-256 of the file content
+    sha256 = models.CharField(unique=True, max_length=64)
+
+    # The canonical copy, duplicates are hardlinked to it
+    file_path = models.FilePathField(
+        path=settings.FILE_PATH_FIELD_DIRECTORY,
+        max_length=300,
+        allow_files=True,
+        allow_folders=False)
+
+    # Size of the content in bytes
+    size = models.BigIntegerField()
+
+    def __str__(self):
+        return self.sha256
+
+    @classmethod
+    def release(cls, download):
+        """Let go of a download's claim on its content before its file is
+        removed.
+
+        When the download held the canonical copy the content moves to
+        another completed download with the same hash, or is forgotten when
+        there is none.
+        """
+        if not download.content_hash:
+            return
+        content = cls.objects.filter(sha256=download.content_hash).first()
+        if content is None or content.file_path != download.file_path:
+            return
+        others = Download.objects.filter(
+            content_hash=download.content_hash,
+            status=Download.Status.COMPLETED).exclude(pk=download.pk)
+        for other in others:
+            if os.path.exists(other.file_path):
+                content.file_path = other.file_path
+                content.save()
+                return
+        content.delete()
+
 
 class Download(TimestampedModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.downloader = None
         self.format_ids = []
+        # The parsed info extraction, filled in by the worker_extract task
+        self.extraction = None
 
     class Status(models.TextChoices):
         DRAFT = 'D', _get('Draft')
@@ -96,6 +241,29 @@ class Download(TimestampedModel):
         ARCHIVED = 'A', _get('Archived')
         MISSING = 'M', _get('Missing')
         TERMINATED = 'T', _get('Terminated')
+        QUEUED = 'Q', _get('Queued')
+
+    class Priority(models.IntegerChoices):
+        HIGH = 0, _get('High')
+        NORMAL = 1, _get('Normal')
+        LOW = 2, _get('Low')
+
+    class Meta(TimestampedModel.Meta):
+        indexes = [
+            # Dedupe lookups on create and update, by status and optionally format
+            models.Index(fields=['slug_id', 'status', 'file_format'],
+                         name='download_slug_status_format'),
+            # The last 24 hours on the home page and the date ordered list
+            models.Index(fields=['created_at', 'status'],
+                         name='download_created_status'),
+            # The home page and the list filtered to the user's downloads
+            models.Index(fields=['created_by', 'created_at'],
+                         name='download_user_created'),
+            # The nightly missing files check
+            models.Index(fields=['status'], name='download_status'),
+            # Recent run times for the queue estimates
+            models.Index(fields=['status', 'finished_at'], name='download_status_finished'),
+        ]
 
     # The command used to download
     command = models.ForeignKey(Command, on_delete=models.CASCADE)
@@ -146,18 +314,87 @@ class Download(TimestampedModel):
     file_format = models.ForeignKey(
         Format, on_delete=models.CASCADE, blank=True, null=True)
 
+    # SHA-256 of the completed file, see FileContent
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # Parallel segment downloads for commands that fetch segments, blank
+    # uses the source default from DOWNLOAD_MAX_WORKERS
+    max_workers = models.PositiveSmallIntegerField(
+        blank=True, null=True, validators=[MinValueValidator(1)])
+
+    # Length of the video in seconds, if the extraction knew it
+    duration = models.PositiveIntegerField(blank=True, null=True)
+
+    # Queued downloads with a better priority start first, see scheduler.py
+    priority = models.PositiveSmallIntegerField(
+        choices=Priority.choices,
+        default=Priority.NORMAL,
+    )
+
+    # When the download was queued, started and finished running
+    queued_at = models.DateTimeField(blank=True, null=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    # An identical download (same video and format) that was already queued
+    # or running when this one was asked for. This one shares its task and
+    # ends up with the same file instead of fetching it again.
+    attached_to = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, blank=True, null=True, related_name='attached')
+
+    # The playlist or channel batch this download came from
+    batch = models.ForeignKey(
+        'DownloadBatch', on_delete=models.SET_NULL, blank=True, null=True,
+        related_name='downloads')
+
     def get_absolute_url(self):
         return reverse('download:detail', kwargs={'pk': self.pk})
 
     def __str__(self):
         return self.title
 
+    def get_max_workers(self):
+        workers = self.max_workers or settings.DOWNLOAD_MAX_WORKERS.get(
+            self.source.name, settings.DOWNLOAD_MAX_WORKERS['default'])
+        return max(1, min(workers, settings.DOWNLOAD_MAX_WORKERS_CAP))
+
+    @staticmethod
+    def priority_for(duration):
+        # Short clips jump ahead of long VODs
+        if duration is None:
+            return Download.Priority.NORMAL
+        if duration <= settings.DOWNLOAD_SHORT_SECONDS:
+            return Download.Priority.HIGH
+        if duration >= settings.DOWNLOAD_LONG_SECONDS:
+            return Download.Priority.LOW
+        return Download.Priority.NORMAL
+
+    def default_format(self):
+        """The format to use when the user doesn't pick one, see
+        DOWNLOAD_DEFAULT_MAX_HEIGHT and DOWNLOAD_DEFAULT_EXTENSIONS."""
+        formats = Format.objects.filter(pk__in=self.format_ids).select_related(
+            'quality', 'extension')
+        preferred = settings.DOWNLOAD_DEFAULT_EXTENSIONS
+
+        def rank(file_format):
+            extension = file_format.extension.name
+            return (*quality_rank(file_format.quality.name, settings.DOWNLOAD_DEFAULT_MAX_HEIGHT),
+                    extension in preferred, -self.format_ids.index(file_format.id))
+
+        return max(formats, key=rank, default=None)
+
     def set_missing_if_file_not_found(self):
         if self.status == Download.Status.COMPLETED and not os.path.exists(self.file_path):
             self.status = Download.Status.MISSING
 
     def change_status_and_kill_file(self, status):
-        if os.path.exists(self.file_path):
+        # The file may be a hardlink to content other downloads share.
+        # Removing it only drops this path.
+        FileContent.release(self)
+        # Attached downloads share the path itself, the file stays for them
+        shared = Download.objects.filter(
+            file_path=self.file_path, status=Download.Status.COMPLETED).exclude(pk=self.pk)
+        if os.path.exists(self.file_path) and not shared.exists():
             os.remove(self.file_path)
 
         self.status = status
@@ -168,6 +405,17 @@ class Download(TimestampedModel):
     def cancel_download(self):
         self.change_status_and_kill_file(Download.Status.TERMINATED)
 
+    def extract(self):
+        """Run the info extraction for the url. This blocks on the network,
+        so it should only be called from the worker_extract task."""
+        self.downloader = Downloader.get_downloader(self.command.name)
+        try:
+            self.extraction = self.downloader.extract(self.url)
+        except ExtractionError as error:
+            logger.error(error)
+            self.extraction = {'error': error.message}
+        return self.extraction
+
     def clean_fields(self, exclude=None):
         super().clean_fields(exclude=exclude)
         logger.debug('Cleaning fields')
@@ -176,17 +424,16 @@ class Download(TimestampedModel):
 
         # Only do something if both fields are valid so far.
         # Also only if the download object is being created for the first time
-        if (not self.id) and command and url:
+        # and the background info extraction has finished
+        if (not self.id) and command and url and self.extraction is not None:
 
-            self.downloader = Downloader.get_downloader(command.name)
-            try:
-                result = self.downloader.extract(url)
-            except ExtractionError as error:
+            result = self.extraction
+            if 'error' in result:
                 raise ValidationError(
                     _get('Download failure: %(message)s'),
                     code='invalid',
-                    params={'message': error.message},
-                ) from error
+                    params={'message': result['error']},
+                )
 
             # Add attributes parsed from info extraction
             self.source, _ = Source.objects.get_or_create(
@@ -194,18 +441,14 @@ class Download(TimestampedModel):
             self.title = result['title']
             self.slug_id = result['slug_id']
             self.channel_name = result['channel_name']
+            # Cached extractions from before durations were parsed have none
+            self.duration = result.get('duration')
+            self.priority = Download.priority_for(self.duration)
 
             # Create database objects for Video formats if they don't exist
+            self.format_ids = Format.bulk_get_or_create(
+                command.name, result['format_info'])
             for (ext, qual, code) in result['format_info']:
-                extension, _ = Extension.objects.get_or_create(name=ext)
-                quality, _ = Quality.objects.get_or_create(name=qual)
-                comm = Command.objects.get(name=self.command.name)
-                file_format, _ = Format.objects.get_or_create(
-                    quality=quality,
-                    extension=extension,
-                    defaults={'format_code': code, 'command': comm}
-                )
-                self.format_ids.append(file_format.id)
                 logger.debug(
                     'File format option: Ext: %s Res: %s Code: %s', ext, qual, code)
 
@@ -221,5 +464,71 @@ class Download(TimestampedModel):
         super().save(*args, **kwargs)
 
         # Add the relationships to the format objects after object is saved
-        if not_exists:
-            self.choices_for.add(*format_ids)
+        if not_exists and format_ids:
+            through = Download.choices_for.through
+            through.objects.bulk_create([
+                through(download_id=self.id, format_id=format_id)
+                for format_id in format_ids
+            ], ignore_conflicts=True)
+
+
+class DownloadBatch(TimestampedModel):
+    """Every video of a playlist or a channel, downloaded as one Download
+    each in the command's batch format."""
+
+    class Status(models.TextChoices):
+        EXTRACTING = 'E', _get('Extracting')
+        STARTED = 'S', _get('Started')
+        FAILED = 'F', _get('Failed')
+
+    # The command used to list and download the videos
+    command = models.ForeignKey(Command, on_delete=models.CASCADE)
+
+    # The user who asked for the batch
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+
+    # The playlist or channel URL
+    url = models.URLField(max_length=300)
+
+    # The playlist or channel name, once extracted
+    title = models.CharField(max_length=200, blank=True)
+
+    status = models.CharField(
+        max_length=1,
+        choices=Status.choices,
+        default=Status.EXTRACTING,
+    )
+
+    # Why the extraction failed
+    error = models.CharField(max_length=300, blank=True)
+
+    # The format every video is downloaded in, see DOWNLOAD_BATCH_FORMATS
+    file_format = models.ForeignKey(
+        Format, on_delete=models.CASCADE, blank=True, null=True)
+
+    def get_absolute_url(self):
+        return reverse('download:batch_detail', kwargs={'pk': self.pk})
+
+    def __str__(self):
+        return self.title or self.url
+
+    def create_downloads(self, entries):
+        """Add a queued Download for every extracted entry with one insert
+        and return how many there are."""
+        ext, qual, code = settings.DOWNLOAD_BATCH_FORMATS[self.command.name]
+        self.file_format_id = Format.bulk_get_or_create(self.command.name, [(ext, qual, code)])[0]
+        sources = ids_by_name(Source, {entry['source'] for entry in entries})
+        now = timezone.now()
+        Download.objects.bulk_create([
+            Download(command=self.command, source_id=sources[entry['source']],
+                     created_by=self.created_by, url=entry['url'], title=entry['title'][:200],
+                     slug_id=entry['slug_id'], channel_name=entry['channel_name'][:100],
+                     duration=entry['duration'], priority=Download.priority_for(entry['duration']),
+                     file_format_id=self.file_format_id, status=Download.Status.QUEUED,
+                     queued_at=now, batch=self)
+            for entry in entries
+        ])
+        self.save()
+        return len(entries)
+
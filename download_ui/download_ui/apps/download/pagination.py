@@ -0,0 +1,139 @@
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Pages through a queryset by the values of its ordering instead of an
+    OFFSET, so every page costs the same as the first one.
+
+    Cursors are signed tokens holding the ordering values of the first or
+    last row of a page. The primary key is added to the ordering when it is
+    missing so every row has a distinct position.
+    """
+    salt = 'download.pagination.keyset'
+
+    def __init__(self, queryset, per_page):
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        if not {'pk', '-pk', 'id', '-id'} & set(ordering):
+            ordering.append('-pk')
+        self.queryset = queryset.order_by(*ordering)
+        self.ordering = ordering
+        self.per_page = per_page
+
+    @property
+    def count(self):
+        # Counting a big table costs as much as a deep OFFSET, so the total
+        # is cached per query for a short while
+        key = 'download-list-count:' + hashlib.md5(
+            str(self.queryset.query).encode()).hexdigest()
+        return cache.get_or_set(key, self.queryset.count, settings.DOWNLOAD_LIST_COUNT_TIMEOUT)
+
+    def page(self, cursor=None):
+        if cursor is None:
+            return self._forward(self.queryset, first_page=True)
+        direction, values = self.decode_cursor(cursor)
+        if direction == 'next':
+            return self._forward(self.queryset.filter(self._after(self.ordering, values)))
+        reverse = [self._flip(field) for field in self.ordering]
+        return self._backward(
+            self.queryset.filter(self._after(reverse, values)).order_by(*reverse))
+
+    def _forward(self, queryset, first_page=False):
+        rows = list(queryset[:self.per_page + 1])
+        object_list = rows[:self.per_page]
+        return KeysetPage(
+            object_list,
+            next_cursor=self.encode_cursor('next', object_list[-1])
+            if len(rows) > self.per_page else None,
+            previous_cursor=self.encode_cursor('previous', object_list[0])
+            if object_list and not first_page else None,
+        )
+
+    def _backward(self, queryset):
+        rows = list(queryset[:self.per_page + 1])
+        object_list = rows[:self.per_page][::-1]
+        return KeysetPage(
+            object_list,
+            next_cursor=self.encode_cursor('next', object_list[-1]) if object_list else None,
+            previous_cursor=self.encode_cursor('previous', object_list[0])
+            if len(rows) > self.per_page else None,
+        )
+
+    def encode_cursor(self, direction, obj):
+        values = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return signing.dumps([direction, values], salt=self.salt, compress=True)
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, values = signing.loads(cursor, salt=self.salt)
+        except (signing.BadSignature, TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        if direction not in ('next', 'previous') or len(values) != len(self.ordering):
+            raise InvalidCursor(cursor)
+        return direction, [self._to_python(field, value)
+                           for field, value in zip(self.ordering, values)]
+
+    def _to_python(self, field, value):
+        name = field.lstrip('-')
+        try:
+            model_field = (self.queryset.model._meta.pk if name == 'pk'
+                           else self.queryset.model._meta.get_field(name))
+        except FieldDoesNotExist:
+            # Annotations like the search rank are stored as they are
+            return value
+        return model_field.to_python(value)
+
+    @staticmethod
+    def _flip(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def _after(ordering, values):
+        # Rows past the cursor row, e.g. for -created_at, -pk:
+        # created_at <= x AND (created_at < x OR (created_at = x AND pk < y))
+        # The leading range lets the database use an index on the first field
+        first = ordering[0]
+        name = first.lstrip('-')
+        condition = Q(**{f"{name}__{'lte' if first.startswith('-') else 'gte'}": values[0]})
+        past = Q()
+        equal = Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            past |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition & past
@@ -0,0 +1,342 @@
+import heapq
+import logging
+import threading
+from collections import Counter, deque, namedtuple
+from datetime import timedelta
+
+from celery import states
+from celery.result import AsyncResult
+from celery.utils import uuid
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+import redis
+
+from .downloaders.progress import publish_progress
+from .models import Download
+
+logger = logging.getLogger('__name__')
+
+# Held in Redis while a dispatch runs so two of them, in any web or worker
+# process, can't hand out the same slot
+LOCK_KEY = 'download-scheduler-lock'
+LOCK_TIMEOUT = 60
+
+# Set when a dispatch was asked for while the lock was held
+RERUN_KEY = 'download-scheduler-rerun'
+
+# Finished downloads the run time estimates learn from
+HISTORY_SIZE = 50
+
+QueueEntry = namedtuple(
+    'QueueEntry', ['id', 'user_id', 'priority', 'queued_at', 'started_at', 'duration',
+                   'slug_id', 'file_format_id'])
+
+
+def load_entries(status):
+    # Attached downloads ride along on another download's slot
+    rows = Download.objects.filter(status=status, attached_to__isnull=True).values_list(
+        'id', 'created_by_id', 'priority', 'queued_at', 'started_at', 'duration',
+        'slug_id', 'file_format_id')
+    return [QueueEntry(*row) for row in rows]
+
+
+def load_last_started(queued):
+    # When each user with queued downloads last had one start, running or not
+    return dict(Download.objects.filter(
+        created_by__in={entry.user_id for entry in queued}, started_at__isnull=False).values(
+        'created_by').annotate(last=Max('started_at')).values_list('created_by', 'last'))
+
+
+class FairQueue:
+    """The queued downloads grouped by user.
+
+    pop() hands out the next download to start. The best priority goes
+    first, within a priority the user with the fewest running downloads,
+    then the one who started a download least recently. A user already
+    running DOWNLOAD_USER_SLOTS downloads is skipped until one finishes.
+    """
+
+    def __init__(self, queued, running, last_started, user_slots):
+        self.user_slots = user_slots
+        self.heads = {}
+        for entry in sorted(queued, key=lambda entry: (entry.priority, entry.queued_at, entry.id)):
+            self.heads.setdefault(entry.user_id, deque()).append(entry)
+        self.running = Counter(entry.user_id for entry in running)
+        self.last_started = dict(last_started)
+
+    def __bool__(self):
+        return bool(self.heads)
+
+    def pop(self, now):
+        best = None
+        for user_id, entries in self.heads.items():
+            if self.running[user_id] >= self.user_slots:
+                continue
+            head = entries[0]
+            # Users who have never started a download sort first
+            last_started = (user_id in self.last_started, self.last_started.get(user_id))
+            key = (head.priority, self.running[user_id], last_started, head.queued_at, head.id)
+            if best is None or key < best[0]:
+                best = (key, user_id)
+        if best is None:
+            return None
+
+        user_id = best[1]
+        entry = self.heads[user_id].popleft()
+        if not self.heads[user_id]:
+            del self.heads[user_id]
+        self.running[user_id] += 1
+        self.last_started[user_id] = now
+        return entry
+
+    def finished(self, user_id):
+        self.running[user_id] -= 1
+
+
+_client = None
+
+# Stands in for the Redis lock while Redis is unreachable. The broker is
+# down then too, so only this process can start anything anyway
+_local_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.DOWNLOAD_SCHEDULER_REDIS_URL)
+    return _client
+
+
+def dispatch():
+    """Start queued downloads while there are free slots and return their ids."""
+    client = get_client()
+    lock = client.lock(LOCK_KEY, timeout=LOCK_TIMEOUT)
+    started = []
+    while True:
+        try:
+            acquired = lock.acquire(blocking=False)
+        except redis.RedisError as error:
+            logger.warning('Scheduler lock unavailable, dispatching in this process only: %s',
+                           error)
+            with _local_lock:
+                return started + _dispatch()
+        if not acquired:
+            # The dispatch holding the lock runs again for this one
+            client.set(RERUN_KEY, 1, ex=LOCK_TIMEOUT)
+            return started
+        try:
+            client.delete(RERUN_KEY)
+            started += _dispatch()
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # Held past LOCK_TIMEOUT, someone else may have it by now
+                pass
+        # Asked for while this one ran
+        if not client.get(RERUN_KEY):
+            return started
+
+
+def task_ended(task_id):
+    """Whether Celery has finished with the task, None if it can't tell."""
+    try:
+        return AsyncResult(task_id).state in states.READY_STATES
+    except redis.RedisError as error:
+        logger.warning('Could not read the state of task %s: %s', task_id, error)
+        return None
+
+
+def recover_stale(now=None):
+    """Fail started downloads whose task is gone and return their ids.
+
+    A task killed by the hard time limit, or lost with its worker process,
+    never gets to update its download, which would keep its slot for good.
+    Downloads running longer than the time limit are checked against the
+    result backend, and DOWNLOAD_SLOT_MAX_AGE is as long as any of them,
+    retries included, can keep a slot.
+    """
+    now = now or timezone.now()
+    candidates = Download.objects.filter(
+        status=Download.Status.STARTED, attached_to__isnull=True,
+        started_at__lt=now - timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT)).values_list(
+        'id', 'active_task_id', 'started_at')
+    oldest = now - timedelta(seconds=settings.DOWNLOAD_SLOT_MAX_AGE)
+    recovered = []
+    for download_id, task_id, started_at in candidates:
+        if started_at >= oldest and (not task_id or not task_ended(task_id)):
+            continue
+        Download.objects.filter(Q(pk=download_id) | Q(attached_to=download_id),
+                                status=Download.Status.STARTED).update(
+            status=Download.Status.FAILED, finished_at=now, updated_at=now)
+        publish_progress(task_id, 'DONE', {'status': Download.Status.FAILED})
+        logger.warning('Download %d lost its task %s, marked failed', download_id, task_id)
+        recovered.append(download_id)
+    return recovered
+
+
+def _dispatch():
+    from .tasks import worker_download
+
+    running = load_entries(Download.Status.STARTED)
+    free = settings.DOWNLOAD_SLOTS - len(running)
+    if free <= 0:
+        return []
+    queued = load_entries(Download.Status.QUEUED)
+    if not queued:
+        return []
+    queue = FairQueue(queued, running, load_last_started(queued), settings.DOWNLOAD_USER_SLOTS)
+    now = timezone.now()
+    # The running download for every video and format, identical ones
+    # queued at the same moment attach to it rather than start
+    leaders = {(entry.slug_id, entry.file_format_id): entry.id for entry in running}
+    started = []
+    while free > 0:
+        entry = queue.pop(now)
+        if entry is None:
+            break
+        key = (entry.slug_id, entry.file_format_id)
+        if entry.slug_id and key in leaders:
+            queue.finished(entry.user_id)
+            leader = Download.objects.only('status', 'active_task_id').get(pk=leaders[key])
+            Download.objects.filter(pk=entry.id, status=Download.Status.QUEUED).update(
+                attached_to=leader, status=leader.status, started_at=now,
+                active_task_id=leader.active_task_id, updated_at=now)
+            continue
+        # The task id is known up front so the progress card can find it
+        # before the worker picks the task up
+        task_id = uuid()
+        claimed = Download.objects.filter(pk=entry.id, status=Download.Status.QUEUED).update(
+            status=Download.Status.STARTED, started_at=now, active_task_id=task_id, updated_at=now)
+        if not claimed:
+            # Cancelled since it was read
+            continue
+        # Downloads attached while this one was queued start along with it
+        Download.objects.filter(attached_to=entry.id, status=Download.Status.QUEUED).update(
+            status=Download.Status.STARTED, started_at=now, active_task_id=task_id, updated_at=now)
+        worker_download.apply_async((entry.id,), task_id=task_id)
+        leaders[key] = entry.id
+        started.append(entry.id)
+        free -= 1
+    if started:
+        logger.info('Scheduler started downloads %s', started)
+    return started
+
+
+def find_leader(download):
+    """The queued or running download fetching the same video in the same
+    format, if there is one."""
+    if not download.slug_id or download.file_format_id is None:
+        return None
+    return Download.objects.filter(
+        slug_id=download.slug_id, file_format=download.file_format_id,
+        status__in=(Download.Status.QUEUED, Download.Status.STARTED),
+        attached_to__isnull=True).exclude(pk=download.pk).order_by('id').first()
+
+
+def enqueue(download):
+    """Queue a download and start it straight away if there is room.
+
+    A download identical to one already queued or running attaches to it
+    instead, it follows the same task and gets the same file.
+    """
+    now = timezone.now()
+    download.queued_at = now
+    download.attached_to = find_leader(download)
+    if download.attached_to is not None:
+        leader = download.attached_to
+        download.status = leader.status
+        download.started_at = now if leader.status == Download.Status.STARTED else None
+        download.active_task_id = leader.active_task_id
+        download.save()
+        logger.info('Download %d attached to download %d', download.id, leader.id)
+        return
+    download.status = Download.Status.QUEUED
+    download.save()
+    dispatch()
+    download.refresh_from_db(fields=['status', 'started_at', 'active_task_id', 'attached_to'])
+
+
+def detach(download):
+    """Queue the downloads attached to a cancelled download on their own."""
+    waiting = download.attached.filter(
+        status__in=(Download.Status.QUEUED, Download.Status.STARTED))
+    leader = waiting.order_by('id').first()
+    if leader is None:
+        return
+    # The first one takes over and the rest attach to it, they start together
+    waiting.exclude(pk=leader.pk).update(
+        attached_to=leader, status=Download.Status.QUEUED, started_at=None, active_task_id='')
+    leader.attached_to = None
+    enqueue(leader)
+
+
+class RuntimeEstimator:
+    """Guesses how long a download runs from the last finished ones, scaled
+    by the video duration where it is known."""
+
+    def __init__(self, history):
+        self.default = settings.DOWNLOAD_ESTIMATE_SECONDS
+        run_total = media_total = 0.0
+        runs = []
+        for started_at, finished_at, duration in history:
+            seconds = (finished_at - started_at).total_seconds()
+            runs.append(seconds)
+            if duration:
+                run_total += seconds
+                media_total += duration
+        # Seconds of running per second of video
+        self.rate = run_total / media_total if media_total else None
+        if runs:
+            self.default = sum(runs) / len(runs)
+
+    @classmethod
+    def from_history(cls):
+        history = Download.objects.filter(
+            status=Download.Status.COMPLETED, started_at__isnull=False,
+            finished_at__isnull=False).order_by('-finished_at').values_list(
+            'started_at', 'finished_at', 'duration')[:HISTORY_SIZE]
+        return cls(history)
+
+    def __call__(self, entry):
+        if entry.duration and self.rate is not None:
+            return entry.duration * self.rate
+        return self.default
+
+
+def queue_estimates(now=None, estimate=None):
+    """Map each queued download id to its (position, estimated start).
+
+    Runs the scheduler forward over the current queue, assuming nothing
+    else is queued and every download takes its estimated run time.
+    """
+    now = now or timezone.now()
+    queued = load_entries(Download.Status.QUEUED)
+    if not queued:
+        return {}
+    estimate = estimate or RuntimeEstimator.from_history()
+    running = load_entries(Download.Status.STARTED)
+    queue = FairQueue(queued, running, load_last_started(queued), settings.DOWNLOAD_USER_SLOTS)
+
+    # (estimated end, user) for every download holding a slot
+    finishing = []
+    for entry in running:
+        end = (entry.started_at or now) + timedelta(seconds=estimate(entry))
+        finishing.append((max(end, now), entry.user_id))
+    heapq.heapify(finishing)
+
+    clock = now
+    estimates = {}
+    while queue:
+        entry = queue.pop(clock) if len(finishing) < settings.DOWNLOAD_SLOTS else None
+        if entry is None:
+            if not finishing:
+                break
+            end, user_id = heapq.heappop(finishing)
+            clock = max(clock, end)
+            queue.finished(user_id)
+            continue
+        estimates[entry.id] = (len(estimates) + 1, clock)
+        heapq.heappush(finishing, (clock + timedelta(seconds=estimate(entry)), entry.user_id))
+    return estimates
@@ -0,0 +1,144 @@
+from abc import abstractmethod, ABC
+import logging
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Download, Source
+
+logger = logging.getLogger('__name__')
+
+# The FTS5 table created by migration 0007, its rowid is the Download id
+SEARCH_TABLE = 'download_search'
+
+# bm25 weights for the title, channel_name, source and url columns
+SEARCH_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+
+# Fields a save has to touch for the index entry to change
+INDEXED_FIELDS = {'title', 'channel_name', 'source', 'url'}
+
+
+class SearchBackend(ABC):
+    """Keeps a search index of the downloads and searches it.
+
+    The default implementations do nothing so backends that search the
+    Download table directly only need to implement search.
+    """
+
+    def update(self, download):
+        pass
+
+    def remove(self, download_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+    @abstractmethod
+    def search(self, queryset, query):
+        pass
+
+
+class LikeSearchBackend(SearchBackend):
+    # Every term has to appear in one of the fields. Works on any database
+    # but scans the whole table.
+    def search(self, queryset, query):
+        condition = Q()
+        for term in query.split():
+            condition &= (Q(title__icontains=term) | Q(channel_name__icontains=term)
+                          | Q(source__name__icontains=term) | Q(url__icontains=term))
+        return queryset.filter(condition)
+
+
+class SQLiteFTSSearchBackend(SearchBackend):
+    # The trigram tokenizer matches any substring like icontains did, so a
+    # term needs at least three characters. Shorter terms use LIKE instead.
+    min_term_length = 3
+
+    def __init__(self):
+        self.fallback = LikeSearchBackend()
+        self._available = None
+
+    def is_available(self):
+        # The migration skips the table when SQLite lacks FTS5 or the
+        # trigram tokenizer
+        if self._available is None:
+            if connection.vendor != 'sqlite':
+                self._available = False
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                                   [SEARCH_TABLE])
+                    self._available = cursor.fetchone() is not None
+            if not self._available:
+                logger.warning('No %s table, searching with LIKE', SEARCH_TABLE)
+        return self._available
+
+    def update(self, download):
+        if not self.is_available():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [download.pk])
+            cursor.execute(
+                f'INSERT INTO {SEARCH_TABLE} (rowid, title, channel_name, source, url) '
+                'VALUES (%s, %s, %s, %s, %s)',
+                [download.pk, download.title, download.channel_name, download.source.name,
+                 download.url])
+
+    def remove(self, download_id):
+        if not self.is_available():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [download_id])
+
+    def rebuild(self):
+        if not self.is_available():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {SEARCH_TABLE} (rowid, title, channel_name, source, url) '
+                'SELECT d.id, d.title, d.channel_name, s.name, d.url '
+                f'FROM {Download._meta.db_table} d JOIN {Source._meta.db_table} s '
+                'ON s.id = d.source_id')
+
+    def search(self, queryset, query):
+        terms = query.split()
+        if (not terms or not self.is_available()
+                or any(len(term) < self.min_term_length for term in terms)):
+            return self.fallback.search(queryset, query)
+
+        # Quote every term so FTS5 syntax in the query is matched literally
+        match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+        table = queryset.model._meta.db_table
+        matching = RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s',
+                          [match])
+        rank = RawSQL(f'SELECT bm25({SEARCH_TABLE}, {weights}) FROM {SEARCH_TABLE} '
+                      f'WHERE {SEARCH_TABLE} MATCH %s AND rowid = "{table}"."id"', [match])
+        # bm25 is lower for better matches
+        return queryset.filter(id__in=matching).annotate(search_rank=rank).order_by(
+            'search_rank', *(queryset.query.order_by or queryset.model._meta.ordering))
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_search_backend():
+    return _load_backend(settings.DOWNLOAD_SEARCH_BACKEND)
+
+
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not INDEXED_FIELDS & set(update_fields):
+        return
+    get_search_backend().update(instance)
+
+
+def remove_from_search_index(sender, instance, **kwargs):
+    get_search_backend().remove(instance.pk)
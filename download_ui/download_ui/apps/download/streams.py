@@ -0,0 +1,160 @@
+import asyncio
+from importlib import import_module
+import json
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.http import HttpRequest
+from django.urls import reverse
+import redis.asyncio
+
+from .downloaders.progress import channel_for
+from .models import Download
+
+
+def async_client():
+    return redis.asyncio.Redis.from_url(settings.DOWNLOAD_PROGRESS_REDIS_URL)
+
+
+@sync_to_async
+def get_streamed_tasks(session_key, ids):
+    """Map the active task ids of the user's visible downloads to their
+    download ids, or None if the session isn't logged in."""
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    if not get_user(request).is_authenticated:
+        return None
+    tasks = {}
+    downloads = Download.objects.filter(pk__in=ids, status=Download.Status.STARTED).exclude(
+        active_task_id='').values_list('id', 'active_task_id')
+    for download_id, task_id in downloads:
+        tasks.setdefault(task_id, []).append(download_id)
+    return tasks
+
+
+@sync_to_async
+def get_finished(tasks):
+    """(task id, download id, status) of the streamed downloads that are no
+    longer running the task they were streamed for."""
+    followed = {download_id: task_id for task_id, download_ids in tasks.items()
+                for download_id in download_ids}
+    downloads = Download.objects.filter(pk__in=followed).values_list(
+        'id', 'status', 'active_task_id')
+    return [(followed[download_id], download_id, status)
+            for download_id, status, task_id in downloads
+            if status != Download.Status.STARTED or task_id != followed[download_id]]
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+class ProgressStreamApp:
+    """ASGI app that streams Server-Sent Events for the STARTED downloads in
+    ?ids= over one connection. Workers publish to it through Redis pub/sub
+    (see ProgressReporter). Every other request goes to the Django app.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != reverse('download:events'):
+            await self.application(scope, receive, send)
+            return
+
+        query = parse_qs(scope['query_string'].decode())
+        ids = [int(pk) for pk in ','.join(query.get('ids', [])).split(',') if pk.isdigit()]
+        cookies = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+        session = cookies.get(settings.SESSION_COOKIE_NAME)
+        tasks = await get_streamed_tasks(session.value if session else None, ids)
+
+        if tasks is None:
+            await send({'type': 'http.response.start', 'status': 403, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        disconnect = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        try:
+            await self.stream(tasks, send, disconnect)
+        finally:
+            disconnect.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def wait_for_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def stream(self, tasks, send, disconnect):
+        if not tasks:
+            await send({'type': 'http.response.body',
+                        'body': format_event('end', {}), 'more_body': True})
+            return
+        client = async_client()
+        pubsub = client.pubsub()
+        await pubsub.subscribe(*[channel_for(task_id) for task_id in tasks])
+        try:
+            # Read again now that the subscription is in place, a download
+            # finishing before it published its DONE to nobody
+            body = self.handle_finished(tasks, await get_finished(tasks))
+            if body:
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            while tasks and not disconnect.done():
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=settings.DOWNLOAD_PROGRESS_STREAM_KEEPALIVE)
+                if message is None:
+                    body = b': keepalive\n\n'
+                else:
+                    body = self.handle_message(tasks, json.loads(message['data']))
+                if body:
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            if not tasks:
+                await send({'type': 'http.response.body',
+                            'body': format_event('end', {}), 'more_body': True})
+        finally:
+            await pubsub.close()
+            await client.close()
+
+    @staticmethod
+    def handle_message(tasks, message):
+        state = message['state']
+        if state == 'DONE':
+            download_ids = tasks.pop(message['task_id'], [])
+            event = 'done'
+        else:
+            download_ids = tasks.get(message['task_id'], [])
+            event = 'progress'
+        return b''.join(
+            format_event(event, {'id': download_id, 'state': state, **message['meta']})
+            for download_id in download_ids
+        )
+
+    @staticmethod
+    def handle_finished(tasks, finished):
+        events = []
+        for task_id, download_id, status in finished:
+            download_ids = tasks.get(task_id, [])
+            if download_id in download_ids:
+                download_ids.remove(download_id)
+                events.append(format_event(
+                    'done', {'id': download_id, 'state': 'DONE', 'status': status}))
+            if not download_ids:
+                tasks.pop(task_id, None)
+        return b''.join(events)
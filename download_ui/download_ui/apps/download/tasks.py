@@ -1,24 +1,107 @@
 from __future__ import absolute_import
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
+import time
 
 from celery import shared_task
 from celery.exceptions import SoftTimeLimitExceeded
 from celery.schedules import crontab
+from celery.signals import worker_process_init
+from celery.utils.time import get_exponential_backoff_interval
+from django.conf import settings
+from django.utils import timezone
 
 from download_ui.celery import app
+from . import extraction_cache, scheduler
+from .downloaders.bandwidth import BandwidthLimiter
 from .downloaders.downloader import Downloader
-from .exceptions import DownloadError
-from .models import Download
+from .downloaders.http_pool import get_pool
+from .downloaders.progress import publish_progress
+from .exceptions import DownloadError, ExtractionError
+from .forms import DownloadForm
+from .library import LibraryFiles, hash_file, link_duplicate
+from .models import Command, Download, DownloadBatch, FileContent
+from .search import get_search_backend
 
 logger = logging.getLogger('__name__')
 
+# Completed downloads checked and updated per query by check_for_missing_files
+MISSING_FILES_CHUNK_SIZE = 2000
+
+
+@shared_task(bind=True)
+def worker_extract(self, command_id, url):
+    command = Command.objects.get(pk=command_id)
+    result = extraction_cache.get_extraction(command.name, url)
+    if result is None:
+        download = Download(command=command, url=url)
+        result = download.extract()
+        if 'error' not in result:
+            extraction_cache.set_extraction(command.name, url, result)
+    logger.debug('Extraction task %s complete for %s', self.request.id, url)
+    return result
+
+
+def extract_download(download):
+    # Runs in the bulk import's threads, so it stays off the database
+    try:
+        return download.extract()
+    except Exception as error:
+        logger.exception('Extraction of %s failed', download.url)
+        return {'error': str(error)}
+
+
+def save_bulk_draft(command, url, user_id, extraction):
+    """Turn an extraction into a draft with a default format, like the
+    create form would, and report how it went."""
+    form = DownloadForm({'command': command.id, 'url': url})
+    form.instance.extraction = extraction
+    if not form.is_valid():
+        return {'url': url, 'error': ' '.join(
+            message for errors in form.errors.values() for message in errors)}
+    download = form.save(commit=False)
+    download.created_by_id = user_id
+    download.file_format = download.default_format()
+    download.save()
+    existing = download.file_format is not None and Download.objects.filter(
+        slug_id=download.slug_id, file_format=download.file_format,
+        status=Download.Status.COMPLETED).exists()
+    return {'url': url, 'download_id': download.id, 'title': download.title,
+            'format': str(download.file_format or ''), 'existing': existing}
+
 
 @shared_task(bind=True)
+def worker_extract_bulk(self, command_id, urls, user_id):
+    """Extract a list of urls at once and save a draft for each."""
+    command = Command.objects.get(pk=command_id)
+    extractions = {url: extraction_cache.get_extraction(command.name, url) for url in urls}
+    missing = [url for url in urls if extractions[url] is None]
+    if missing:
+        # Extractions mostly wait on the network, a few threads overlap them
+        workers = min(settings.DOWNLOAD_BULK_EXTRACT_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(extract_download,
+                               [Download(command=command, url=url) for url in missing])
+            for url, result in zip(missing, results):
+                extractions[url] = result
+                if 'error' not in result:
+                    extraction_cache.set_extraction(command.name, url, result)
+
+    report = [save_bulk_draft(command, url, user_id, extractions[url]) for url in urls]
+    logger.debug('Bulk extraction task %s: %d of %d urls extracted', self.request.id,
+                 sum('error' not in row for row in report), len(urls))
+    return {'user_id': user_id, 'results': report}
+
+
+# acks_late puts the task back on the queue if the worker dies mid download,
+# the next attempt resumes from the partial files
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
 def worker_download(self, download_id):
     filepath = 'N/A'
     size = 'N/A'
     result = None
+    retry = None
     download = Download.objects.get(pk=download_id)
     download.active_task_id = self.request.id
     download.save()
@@ -29,17 +112,24 @@ def worker_download(self, download_id):
         command = download.command.name
         code = download.file_format.format_code
 
-        downloader = Downloader.get_downloader(command, task=self, code=code)
+        limiter = BandwidthLimiter(download.source.name, download_id)
+        downloader = Downloader.get_downloader(command, task=self, code=code,
+                                               max_workers=download.get_max_workers(),
+                                               limiter=limiter)
         try:
-            downloader.download(url, code, download_id)
-            logger.debug('Downloading complete')
+            with limiter:
+                downloader.download(url, code, download_id)
+            logger.debug('Downloading complete, connections: %s', get_pool().stats())
         except (DownloadError) as error:
-            status = Download.Status.FAILED
+            if error.transient and self.request.retries < settings.DOWNLOAD_MAX_RETRIES:
+                retry = error
+            else:
+                status = Download.Status.FAILED
             logger.error(error)
 
         result = self.AsyncResult(self.request.id)
 
-        if status == Download.Status.COMPLETED:
+        if retry is None and status == Download.Status.COMPLETED:
             filepath = result.info['filename']
             try:
                 size = downloader.format_size(os.path.getsize(filepath))
@@ -51,11 +141,110 @@ def worker_download(self, download_id):
         logger.info('Task %s for download %d Terminated', self.request.id, download_id)
         status = Download.Status.TERMINATED
     finally:
-        download.file_path = filepath
-        download.size = size
-        download.status = status
-        download.save()
-        logger.debug('Task complete with status: %s', status.label)
+        # A download waiting to retry keeps its slot and stays started
+        if retry is None:
+            download.file_path = filepath
+            download.size = size
+            download.status = status
+            download.finished_at = timezone.now()
+            download.save()
+            if status != Download.Status.TERMINATED:
+                # Attached downloads end with this one and share its file. The
+                # ones attached to a cancelled download were queued on their own.
+                download.attached.filter(status=Download.Status.STARTED).update(
+                    file_path=filepath, size=size, status=status,
+                    finished_at=download.finished_at, updated_at=download.finished_at)
+            publish_progress(self.request.id, 'DONE', {'status': status})
+            logger.debug('Task complete with status: %s', status.label)
+            if status == Download.Status.COMPLETED and settings.DOWNLOAD_DEDUPE:
+                dedupe_download.delay(download_id)
+            # Hand the slot to the next queued download
+            scheduler.dispatch()
+
+    if retry is not None:
+        countdown = get_exponential_backoff_interval(
+            settings.DOWNLOAD_RETRY_BACKOFF, self.request.retries,
+            settings.DOWNLOAD_RETRY_BACKOFF_MAX, full_jitter=False)
+        logger.info('Retrying download %d in %ds, attempt %d of %d', download_id, countdown,
+                    self.request.retries + 1, settings.DOWNLOAD_MAX_RETRIES)
+        # Celery would stop at its own default of 3 retries
+        raise self.retry(exc=retry, countdown=countdown,
+                         max_retries=settings.DOWNLOAD_MAX_RETRIES)
+
+
+@shared_task(bind=True)
+def worker_extract_batch(self, batch_id):
+    """List a batch's playlist or channel and queue a download per video."""
+    batch = DownloadBatch.objects.select_related('command', 'created_by').get(pk=batch_id)
+    downloader = Downloader.get_downloader(batch.command.name)
+    try:
+        result = downloader.extract_batch(batch.url, settings.DOWNLOAD_BATCH_MAX_ENTRIES)
+    except ExtractionError as error:
+        logger.error(error)
+        batch.status = DownloadBatch.Status.FAILED
+        batch.error = str(error.message)[:300]
+        batch.save()
+        return None
+
+    batch.title = result['title'][:200]
+    batch.status = DownloadBatch.Status.STARTED
+    count = batch.create_downloads(result['entries'])
+    # bulk_create skips the signals that keep the search index up to date
+    backend = get_search_backend()
+    for download in batch.downloads.select_related('source'):
+        backend.update(download)
+    logger.info('Batch %d queued %d downloads from %s', batch_id, count, batch.url)
+    # The scheduler starts them as slots free up, interleaved with
+    # everyone else's downloads
+    scheduler.dispatch()
+    return count
+
+
+@app.task
+def schedule_downloads():
+    # Downloads finishing start the next ones, this catches anything missed
+    # and frees the slots of tasks that died without finishing their download
+    scheduler.recover_stale()
+    return scheduler.dispatch()
+
+
+@shared_task(bind=True)
+def dedupe_download(self, download_id):
+    """Hash a completed download and hardlink it to an identical file that
+    is already in the library."""
+    download = Download.objects.get(pk=download_id)
+    if download.status != Download.Status.COMPLETED:
+        return None
+    try:
+        digest = hash_file(download.file_path)
+        size = os.path.getsize(download.file_path)
+    except OSError as error:
+        logger.error(error)
+        return None
+
+    content, created = FileContent.objects.get_or_create(
+        sha256=digest, defaults={'file_path': download.file_path, 'size': size})
+    linked = False
+    if not created and content.file_path != download.file_path:
+        if os.path.exists(content.file_path):
+            try:
+                linked = link_duplicate(content.file_path, download.file_path)
+            except OSError as error:
+                logger.error(error)
+        else:
+            # The canonical copy is gone, this file takes its place
+            content.file_path = download.file_path
+            content.save()
+
+    download.content_hash = digest
+    download.save(update_fields=['content_hash', 'updated_at'])
+    # Attached downloads have the very same file
+    download.attached.filter(file_path=download.file_path,
+                             status=Download.Status.COMPLETED).update(content_hash=digest)
+    if linked:
+        logger.info('Download %d hardlinked to %s, saved %d bytes',
+                    download_id, content.file_path, size)
+    return {'sha256': digest, 'linked': linked}
 
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
@@ -64,10 +253,48 @@ def setup_periodic_tasks(sender, **kwargs):
         crontab(hour=3, minute=30),
         check_for_missing_files.s(),
     )
+    sender.add_periodic_task(60.0, schedule_downloads.s())
+
+
+@worker_process_init.connect
+def start_youtube_dl_pool(**kwargs):
+    # Every prefork child keeps its own warm YoutubeDL instances
+    from .downloaders.youtube import start_pool
+    start_pool()
 
 @app.task
 def check_for_missing_files():
-    completed_downloads = Download.objects.filter(status=Download.Status.COMPLETED)
-    for download in completed_downloads:
-        download.set_missing_if_file_not_found()
-        download.save()
+    start = time.monotonic()
+    library = LibraryFiles(settings.FILE_PATH_FIELD_DIRECTORY)
+    completed_downloads = Download.objects.filter(
+        status=Download.Status.COMPLETED).only('id', 'file_path', 'status').order_by('id')
+
+    # Walk the completed downloads in primary key chunks. SQLite has no
+    # isolation between an open .iterator() cursor and the updates to the
+    # rows it is reading.
+    checked = missing = 0
+    last_id = 0
+    while True:
+        chunk = list(completed_downloads.filter(id__gt=last_id)[:MISSING_FILES_CHUNK_SIZE])
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        now = timezone.now()
+        changed = []
+        for download in chunk:
+            # The scan predates downloads completed since, so a miss is
+            # checked again on disk. Misses are rare.
+            if not library.exists(download.file_path) and not os.path.exists(download.file_path):
+                download.status = Download.Status.MISSING
+                download.updated_at = now
+                changed.append(download)
+        if changed:
+            Download.objects.bulk_update(changed, ['status', 'updated_at'])
+        checked += len(chunk)
+        missing += len(changed)
+
+    stats = {'checked': checked, 'missing': missing,
+             'seconds': round(time.monotonic() - start, 3)}
+    logger.info('Missing files check: %(checked)d checked, %(missing)d marked missing '
+                'in %(seconds).3fs', stats)
+    return stats
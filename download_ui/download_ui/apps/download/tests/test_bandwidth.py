@@ -0,0 +1,159 @@
+from datetime import datetime
+import time
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.utils import timezone
+import redis
+
+from download_ui.apps.download.downloaders import bandwidth
+from download_ui.apps.download.downloaders.bandwidth import (BandwidthLimiter, GRANT_SIZE,
+                                                             budgets_for, current_limit)
+from download_ui.apps.download.downloaders.youtube import YoutubeDownloader
+
+
+def redis_available():
+    try:
+        return redis.Redis.from_url(settings.DOWNLOAD_BANDWIDTH_REDIS_URL,
+                                    socket_connect_timeout=0.2).ping()
+    except redis.RedisError:
+        return False
+
+
+def at(hour, minute=0):
+    return timezone.make_aware(datetime(2021, 6, 1, hour, minute))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@override_settings(DOWNLOAD_BANDWIDTH_LIMIT=1000, DOWNLOAD_BANDWIDTH_SOURCES={'Twitch': 400},
+                   DOWNLOAD_BANDWIDTH_SCHEDULE=[('09:00', '17:00', 300), ('22:00', '06:00', 0)])
+class BandwidthBudgetTest(TestCase):
+    def test_schedule(self):
+        self.assertEqual(current_limit(at(12)), 300)
+        self.assertEqual(current_limit(at(17)), 1000)
+        # The night window runs past midnight and lifts the limit
+        self.assertEqual(current_limit(at(23)), 0)
+        self.assertEqual(current_limit(at(3)), 0)
+        self.assertEqual(current_limit(at(7)), 1000)
+
+    def test_source_budgets(self):
+        self.assertEqual(budgets_for('Youtube', at(8)), [('bandwidth:all', 1000)])
+        self.assertEqual(budgets_for('Twitch', at(8)),
+                         [('bandwidth:all', 1000), ('bandwidth:source:Twitch', 400)])
+        self.assertEqual(budgets_for('Twitch', at(23)), [('bandwidth:source:Twitch', 400)])
+
+
+@override_settings(DOWNLOAD_BANDWIDTH_LIMIT=GRANT_SIZE * 4, DOWNLOAD_BANDWIDTH_SOURCES={},
+                   DOWNLOAD_BANDWIDTH_SCHEDULE=[])
+class BandwidthLimiterTest(TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.pipeline.return_value.execute.return_value = [0, 1, 2, 1]
+        self.take = self.client.register_script.return_value
+        self.take.return_value = b'0'
+        self.clock = FakeClock()
+
+    def limiter(self):
+        return BandwidthLimiter('Youtube', 7, client=self.client, clock=self.clock,
+                                sleep=self.clock.sleep)
+
+    def test_share_splits_the_budget(self):
+        with self.limiter() as limiter:
+            self.assertEqual(limiter.share(), GRANT_SIZE * 2)
+        pipe = self.client.pipeline.return_value
+        pipe.zadd.assert_called_once()
+        pipe.zrem.assert_called_once_with('bandwidth:all:active', '7')
+
+    def test_share_follows_other_downloads(self):
+        with self.limiter() as limiter:
+            self.client.pipeline.return_value.execute.return_value = [0, 1, 4, 1]
+            self.assertEqual(limiter.share(), GRANT_SIZE * 2)
+            self.clock.now += bandwidth.REFRESH_INTERVAL
+            self.assertEqual(limiter.share(), GRANT_SIZE)
+
+    def test_grants_are_spent_locally(self):
+        with self.limiter() as limiter:
+            for _ in range(GRANT_SIZE // 1024):
+                limiter.consume(1024)
+        self.take.assert_called_once()
+        _, kwargs = self.take.call_args
+        self.assertEqual(kwargs['keys'], ['bandwidth:all'])
+        self.assertEqual(kwargs['args'], [GRANT_SIZE, GRANT_SIZE * 4, GRANT_SIZE * 4])
+
+    def test_sleeps_while_over_budget(self):
+        self.take.side_effect = [b'0.25', b'0.5', b'0']
+        with self.limiter() as limiter:
+            limiter.consume(100)
+        self.assertEqual(self.clock.now, 0.75)
+        self.assertEqual(limiter.balance, GRANT_SIZE - 100)
+
+    def test_large_reads_take_several_grants(self):
+        with self.limiter() as limiter:
+            limiter.consume(GRANT_SIZE * 10)
+        # Capped at the budget's capacity, a second's worth
+        self.assertEqual([call.kwargs['args'][0] for call in self.take.call_args_list],
+                         [GRANT_SIZE * 4, GRANT_SIZE * 4, GRANT_SIZE * 2])
+
+    def test_redis_errors_do_not_stop_the_download(self):
+        self.client.pipeline.return_value.execute.side_effect = redis.ConnectionError('down')
+        with self.assertLogs('__name__', 'WARNING'):
+            with self.limiter() as limiter:
+                self.assertIsNone(limiter.share())
+                limiter.consume(GRANT_SIZE * 10)
+        self.take.assert_not_called()
+
+    @override_settings(DOWNLOAD_BANDWIDTH_LIMIT=0)
+    def test_no_limit_skips_redis(self):
+        with patch.object(bandwidth, 'get_client') as mocked_client:
+            with BandwidthLimiter('Youtube', 7) as limiter:
+                limiter.consume(GRANT_SIZE * 10)
+                self.assertIsNone(limiter.share())
+        mocked_client.assert_not_called()
+
+
+class YoutubeThrottleTest(TestCase):
+    def test_hook_draws_on_the_limiter(self):
+        limiter = MagicMock()
+        limiter.share.return_value = 5000
+        downloader = YoutubeDownloader(task=MagicMock(), limiter=limiter)
+        downloader.ydl = MagicMock(params={})
+        for downloaded in (1000, 3000):
+            downloader.my_hook({'status': 'downloading', 'filename': 'video.mp4',
+                                'downloaded_bytes': downloaded, '_percent_str': '10.0%'})
+
+        self.assertEqual([call.args[0] for call in limiter.consume.call_args_list], [1000, 2000])
+        self.assertEqual(downloader.ydl.params['ratelimit'], 5000)
+
+
+@skipUnless(redis_available(), 'Redis is not running')
+@override_settings(DOWNLOAD_BANDWIDTH_LIMIT=GRANT_SIZE * 2, DOWNLOAD_BANDWIDTH_SOURCES={},
+                   DOWNLOAD_BANDWIDTH_SCHEDULE=[])
+class RedisBandwidthLimiterTest(TestCase):
+    def setUp(self):
+        client = redis.Redis.from_url(settings.DOWNLOAD_BANDWIDTH_REDIS_URL)
+        client.delete('bandwidth:all', 'bandwidth:all:active')
+        self.addCleanup(client.delete, 'bandwidth:all', 'bandwidth:all:active')
+
+    def test_workers_share_the_budget(self):
+        with BandwidthLimiter('Youtube', 1) as first, BandwidthLimiter('Youtube', 2) as second:
+            second.refresh()
+            self.assertEqual(second.share(), GRANT_SIZE)
+            start = time.monotonic()
+            for _ in range(4):
+                first.consume(GRANT_SIZE // 2)
+                second.consume(GRANT_SIZE // 2)
+            elapsed = time.monotonic() - start
+        # 4 grants at 2 a second, the first second's worth was saved up
+        self.assertGreater(elapsed, 0.9)
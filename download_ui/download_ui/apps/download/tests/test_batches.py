@@ -0,0 +1,191 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from download_ui.apps.download.downloaders.twitch import TwitchDownloader
+from download_ui.apps.download.downloaders.youtube import YoutubeDownloader
+from download_ui.apps.download.exceptions import ExtractionError
+from download_ui.apps.download.models import Command, Download, DownloadBatch, Source, UserProfile
+from download_ui.apps.download.search import get_search_backend
+from download_ui.apps.download.tasks import worker_extract_batch
+from download_ui.apps.download.tests.test_tasks import MockedTask
+
+FLAT_PLAYLIST = {
+    '_type': 'playlist',
+    'id': 'PL123',
+    'title': 'Speedruns',
+    'uploader': 'Runner',
+    'extractor_key': 'YoutubeTab',
+    'entries': [
+        {'_type': 'url', 'ie_key': 'Youtube', 'id': 'aaa', 'url': 'aaa', 'title': 'Any%',
+         'duration': 300.0},
+        {'_type': 'url', 'ie_key': 'Youtube', 'id': 'bbb', 'url': 'bbb', 'title': '100%',
+         'uploader': 'Guest'},
+        None,
+    ],
+}
+
+
+def twitch_video(video_id, title):
+    return {'id': video_id, 'title': title, 'lengthSeconds': 7200,
+            'creator': {'login': 'streamer', 'displayName': 'Streamer'}}
+
+
+class BatchExtractionTest(TestCase):
+    def test_youtube_flat_playlist(self):
+        result = YoutubeDownloader.parse_batch_extraction(FLAT_PLAYLIST)
+
+        self.assertEqual(result['title'], 'Speedruns')
+        self.assertEqual(result['entries'], [
+            {'url': 'https://www.youtube.com/watch?v=aaa', 'title': 'Any%', 'slug_id': 'aaa',
+             'channel_name': 'Runner', 'source': 'Youtube', 'duration': 300},
+            {'url': 'https://www.youtube.com/watch?v=bbb', 'title': '100%', 'slug_id': 'bbb',
+             'channel_name': 'Guest', 'source': 'Youtube', 'duration': None},
+        ])
+
+    def test_youtube_single_video_is_not_a_batch(self):
+        with self.assertRaises(ExtractionError):
+            YoutubeDownloader.parse_batch_extraction({'id': 'aaa', 'title': 'Any%'})
+
+    @patch('download_ui.apps.download.downloaders.youtube.youtube_dl.YoutubeDL')
+    def test_youtube_lists_lazily(self, mocked_ydl):
+        mocked_ydl.return_value.extract_info.return_value = FLAT_PLAYLIST
+
+        YoutubeDownloader().extract_batch('https://www.youtube.com/playlist?list=PL123', 25)
+
+        opts = mocked_ydl.call_args.args[0]
+        self.assertEqual(opts['extract_flat'], 'in_playlist')
+        self.assertEqual(opts['playlistend'], 25)
+
+    @patch('download_ui.apps.download.downloaders.twitch.twitch.channel_videos_generator')
+    def test_twitch_channel(self, mocked_videos):
+        mocked_videos.return_value = (2, iter([twitch_video('11', 'Day 1'),
+                                               twitch_video('12', 'Day 2')]))
+
+        result = TwitchDownloader().extract_batch('https://www.twitch.tv/streamer/videos', 50)
+
+        mocked_videos.assert_called_once_with('streamer', 50, 'time', 'archive')
+        self.assertEqual(result['title'], 'streamer videos')
+        self.assertEqual(result['entries'][1], {
+            'url': 'https://www.twitch.tv/videos/12', 'title': 'Day 2', 'slug_id': '12',
+            'channel_name': 'Streamer', 'source': 'Twitch', 'duration': 7200})
+
+    def test_twitch_video_url_is_not_a_channel(self):
+        with self.assertRaises(ExtractionError):
+            TwitchDownloader().extract_batch('https://www.twitch.tv/videos/12', 50)
+
+
+@override_settings(DOWNLOAD_SLOTS=2, DOWNLOAD_USER_SLOTS=1)
+class WorkerExtractBatchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='archivist', is_approved=True)
+        cls.command = Command.objects.create(name='YTDL')
+
+    def setUp(self):
+        cache.clear()
+        self.batch = DownloadBatch.objects.create(
+            command=self.command, created_by=self.user,
+            url='https://www.youtube.com/playlist?list=PL123')
+        patcher = patch('download_ui.apps.download.tasks.worker_download')
+        self.mocked_worker = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('download_ui.apps.download.tasks.Downloader.get_downloader')
+    def test_queues_a_download_per_video(self, mocked_downloader):
+        entries = YoutubeDownloader.parse_batch_extraction(FLAT_PLAYLIST)
+        mocked_downloader.return_value.extract_batch.return_value = entries
+
+        self.assertEqual(worker_extract_batch(self=MockedTask(), batch_id=self.batch.id), 2)
+
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.status, DownloadBatch.Status.STARTED)
+        self.assertEqual(self.batch.title, 'Speedruns')
+        self.assertEqual(self.batch.file_format.format_code,
+                         'bestvideo[ext=mp4]+bestaudio[ext=m4a]')
+        downloads = list(self.batch.downloads.order_by('id'))
+        self.assertEqual([down.slug_id for down in downloads], ['aaa', 'bbb'])
+        self.assertEqual(downloads[0].priority, Download.Priority.HIGH)
+        self.assertEqual(downloads[0].file_format, self.batch.file_format)
+        self.assertEqual(downloads[0].created_by, self.user)
+        # One user gets one slot, the other video waits its turn
+        self.assertEqual([down.status for down in downloads],
+                         [Download.Status.STARTED, Download.Status.QUEUED])
+        self.mocked_worker.apply_async.assert_called_once()
+        # The bulk insert still reaches the search index
+        found = get_search_backend().search(Download.objects.all(), '100%')
+        self.assertEqual([down.slug_id for down in found], ['bbb'])
+
+    @patch('download_ui.apps.download.tasks.Downloader.get_downloader')
+    def test_extraction_failure(self, mocked_downloader):
+        mocked_downloader.return_value.extract_batch.side_effect = ExtractionError(
+            'youtube-dl', 'Not a playlist or channel')
+
+        self.assertIsNone(worker_extract_batch(self=MockedTask(), batch_id=self.batch.id))
+
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.status, DownloadBatch.Status.FAILED)
+        self.assertEqual(self.batch.error, 'Not a playlist or channel')
+        self.assertFalse(self.batch.downloads.exists())
+
+
+class DownloadBatchViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='archivist', is_approved=True)
+        cls.command = Command.objects.create(name='TWDL')
+        cls.source = Source.objects.create(name='Twitch')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    @patch('download_ui.apps.download.views.worker_extract_batch')
+    def test_create_starts_the_extraction(self, mocked_task):
+        response = self.client.post(reverse('download:batch_create'), {
+            'command': self.command.id, 'url': 'https://www.twitch.tv/streamer'})
+
+        batch = DownloadBatch.objects.get()
+        self.assertRedirects(response, reverse('download:batch_detail', kwargs={'pk': batch.id}))
+        self.assertEqual(batch.created_by, self.user)
+        self.assertEqual(batch.status, DownloadBatch.Status.EXTRACTING)
+        mocked_task.delay.assert_called_once_with(batch.id)
+
+    def test_aggregate_progress(self):
+        batch = DownloadBatch.objects.create(command=self.command, created_by=self.user,
+                                             url='https://www.twitch.tv/streamer',
+                                             title='streamer videos',
+                                             status=DownloadBatch.Status.STARTED)
+        for slug_id, status, task_id in (('1', Download.Status.COMPLETED, ''),
+                                         ('2', Download.Status.STARTED, 'task-2'),
+                                         ('3', Download.Status.QUEUED, ''),
+                                         ('4', Download.Status.FAILED, '')):
+            Download.objects.create(command=self.command, source=self.source, created_by=self.user,
+                                    url=f'https://www.twitch.tv/videos/{slug_id}', slug_id=slug_id,
+                                    status=status, active_task_id=task_id, batch=batch)
+        metas = {'task-2': {'status': 'PROGRESS', 'result': {'percent_str': '40.0%',
+                                                             'percent': '40'}}}
+
+        with patch('download_ui.apps.download.views.get_task_metas', return_value=metas):
+            response = self.client.get(reverse('download:batch_progress', kwargs={'pk': batch.id}))
+
+        progress = response.context['progress']
+        # 100 + 40 + 0 + 100 over four videos
+        self.assertEqual(progress['percent'], 60)
+        self.assertEqual(progress['total'], 4)
+        self.assertFalse(progress['done'])
+        self.assertEqual(dict(progress['counts']),
+                         {'Started': 1, 'Failed': 1, 'Completed': 1, 'Queued': 1})
+        self.assertContains(response, 'every 2s')
+
+    def test_detail_lists_the_downloads(self):
+        batch = DownloadBatch.objects.create(command=self.command, created_by=self.user,
+                                             url='https://www.twitch.tv/streamer',
+                                             status=DownloadBatch.Status.FAILED,
+                                             error='Channel streamer not found')
+
+        response = self.client.get(reverse('download:batch_detail', kwargs={'pk': batch.id}))
+
+        self.assertContains(response, 'Failed: Channel streamer not found')
+        self.assertTrue(response.context['progress']['done'])
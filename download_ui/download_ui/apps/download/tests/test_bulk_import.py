@@ -0,0 +1,278 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from download_ui.apps.download import extraction_cache
+from download_ui.apps.download.downloaders.downloader import capture_stdout
+from download_ui.apps.download.exceptions import ExtractionError
+from download_ui.apps.download.forms import BulkImportForm
+from download_ui.apps.download.models import Command, Download, Format, Source, UserProfile
+from download_ui.apps.download.tasks import worker_extract_bulk
+from download_ui.apps.download.tests.test_tasks import MockedTask
+
+FORMAT_INFO = [
+    ('webm', '1920x1080', '248+bestaudio'),
+    ('mp4', '1920x1080', '137+bestaudio'),
+    ('mp4', '3840x2160', '313+bestaudio'),
+    ('mp4', '1280x720', '136+bestaudio'),
+]
+
+
+def extraction(slug_id):
+    return {
+        'source': 'Youtube',
+        'title': f'Video {slug_id}',
+        'slug_id': slug_id,
+        'channel_name': 'Channel',
+        'duration': 60,
+        'format_info': FORMAT_INFO,
+    }
+
+
+class BulkImportFormTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.command = Command.objects.create(name='YTDL')
+
+    def test_pasted_and_uploaded_links(self):
+        upload = SimpleUploadedFile('links.txt',
+                                    b'# my list\nhttps://youtu.be/b\n\nhttps://youtu.be/c\n')
+        form = BulkImportForm({'command': self.command.id,
+                               'urls': 'https://youtu.be/a\n  https://youtu.be/b  \n'},
+                              {'file': upload})
+
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['url_list'],
+                         ['https://youtu.be/a', 'https://youtu.be/b', 'https://youtu.be/c'])
+
+    def test_not_a_link(self):
+        form = BulkImportForm({'command': self.command.id, 'urls': 'https://youtu.be/a\nhello'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('Not a link: hello', form.non_field_errors())
+
+    def test_no_links(self):
+        form = BulkImportForm({'command': self.command.id, 'urls': '\n# nothing\n'})
+        self.assertFalse(form.is_valid())
+
+    @override_settings(DOWNLOAD_BULK_MAX_URLS=2)
+    def test_too_many_links(self):
+        urls = '\n'.join(f'https://youtu.be/{index}' for index in range(3))
+        form = BulkImportForm({'command': self.command.id, 'urls': urls})
+        self.assertFalse(form.is_valid())
+        self.assertIn('At most 2 links at once.', form.non_field_errors())
+
+
+class CaptureStdoutTest(TestCase):
+    def test_threads_capture_their_own_prints(self):
+        barrier = threading.Barrier(4)
+        captured = {}
+
+        def work(name):
+            with capture_stdout() as buffer:
+                barrier.wait()
+                for _ in range(50):
+                    print(name)
+            captured[name] = buffer.getvalue()
+
+        threads = [threading.Thread(target=work, args=(f'thread-{index}',)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name, output in captured.items():
+            self.assertEqual(output, f'{name}\n' * 50)
+
+
+class DefaultFormatTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Command.objects.create(name='YTDL')
+
+    def test_tallest_up_to_the_limit_in_a_preferred_extension(self):
+        download = Download()
+        download.format_ids = Format.bulk_get_or_create('YTDL', FORMAT_INFO)
+
+        self.assertEqual(download.default_format().format_code, '137+bestaudio')
+        with self.settings(DOWNLOAD_DEFAULT_MAX_HEIGHT=720):
+            self.assertEqual(download.default_format().format_code, '136+bestaudio')
+
+    def test_nothing_short_enough(self):
+        download = Download()
+        download.format_ids = Format.bulk_get_or_create(
+            'YTDL', [('mp4', '3840x2160', '313'), ('mp4', '2560x1440', '271')])
+        self.assertEqual(download.default_format().format_code, '271')
+
+    def test_no_formats(self):
+        self.assertIsNone(Download().default_format())
+
+
+@override_settings(DOWNLOAD_BULK_EXTRACT_WORKERS=4)
+class WorkerExtractBulkTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.command = Command.objects.create(name='YTDL')
+        cls.user = UserProfile.objects.create(username='importer', is_approved=True)
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def extract(self, url):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        if url.endswith('broken'):
+            raise ExtractionError('youtube-dl', 'Video unavailable')
+        return extraction(url.rsplit('/', 1)[1])
+
+    @patch('download_ui.apps.download.models.Downloader.get_downloader')
+    def test_extracts_concurrently_and_reports_each_url(self, mocked_downloader):
+        mocked_downloader.return_value = MagicMock(extract=self.extract)
+        urls = ['https://youtu.be/a', 'https://youtu.be/broken', 'https://youtu.be/b',
+                'https://youtu.be/c']
+
+        report = worker_extract_bulk(self=MockedTask(), command_id=self.command.id, urls=urls,
+                                     user_id=self.user.id)
+
+        self.assertGreater(self.peak, 1)
+        self.assertEqual(report['user_id'], self.user.id)
+        results = report['results']
+        self.assertEqual([result['url'] for result in results], urls)
+        self.assertEqual(results[1], {'url': 'https://youtu.be/broken',
+                                      'error': 'Download failure: Video unavailable'})
+        draft = Download.objects.get(pk=results[0]['download_id'])
+        self.assertEqual(draft.status, Download.Status.DRAFT)
+        self.assertEqual(draft.created_by, self.user)
+        self.assertEqual(draft.file_format.format_code, '137+bestaudio')
+        self.assertEqual(draft.choices_for.count(), 4)
+        self.assertEqual(results[0]['format'], str(draft.file_format))
+        self.assertFalse(results[0]['existing'])
+        # Successful extractions are cached for the next import
+        self.assertIsNotNone(extraction_cache.get_extraction('YTDL', 'https://youtu.be/c'))
+        self.assertIsNone(extraction_cache.get_extraction('YTDL', 'https://youtu.be/broken'))
+
+    @patch('download_ui.apps.download.models.Downloader.get_downloader')
+    def test_cached_urls_are_not_extracted(self, mocked_downloader):
+        extraction_cache.set_extraction('YTDL', 'https://youtu.be/a', extraction('a'))
+
+        report = worker_extract_bulk(self=MockedTask(), command_id=self.command.id,
+                                     urls=['https://youtu.be/a'], user_id=self.user.id)
+
+        mocked_downloader.assert_not_called()
+        self.assertEqual(report['results'][0]['title'], 'Video a')
+
+
+class BulkImportViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.command = Command.objects.create(name='YTDL')
+        cls.source = Source.objects.create(name='Youtube')
+        cls.user = UserProfile.objects.create(username='importer', is_approved=True)
+        cls.other = UserProfile.objects.create(username='other', is_approved=True)
+        cls.file_format = Format.objects.get(
+            pk=Format.bulk_get_or_create('YTDL', [('mp4', '1920x1080', '137+bestaudio')])[0])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        # The import the tests poll was started by this session
+        session = self.client.session
+        session['bulk_tasks'] = ['bulk-1']
+        session.save()
+
+    def draft(self, user, slug_id):
+        return Download.objects.create(
+            command=self.command, source=self.source, created_by=user,
+            url=f'https://youtu.be/{slug_id}', title=slug_id, slug_id=slug_id,
+            file_format=self.file_format)
+
+    @patch('download_ui.apps.download.views.worker_extract_bulk')
+    def test_import_starts_the_extraction(self, mocked_task):
+        mocked_task.delay.return_value = MagicMock(id='bulk-1')
+
+        response = self.client.post(reverse('download:bulk_import'), {
+            'command': self.command.id, 'urls': 'https://youtu.be/a\nhttps://youtu.be/b'})
+
+        self.assertRedirects(response, reverse('download:bulk_results',
+                                               kwargs={'task_id': 'bulk-1'}),
+                             fetch_redirect_response=False)
+        mocked_task.delay.assert_called_once_with(
+            self.command.id, ['https://youtu.be/a', 'https://youtu.be/b'], self.user.id)
+        self.assertEqual(self.client.session['bulk_tasks'], ['bulk-1', 'bulk-1'])
+
+    @patch('download_ui.apps.download.views.AsyncResult')
+    def test_results_poll_until_ready(self, mocked_result):
+        mocked_result.return_value = MagicMock(ready=MagicMock(return_value=False))
+
+        response = self.client.get(reverse('download:bulk_results', kwargs={'task_id': 'bulk-1'}))
+
+        self.assertContains(response, 'Extracting the links')
+        self.assertContains(response, 'hx-trigger="load delay:1s"')
+
+    @patch('download_ui.apps.download.views.AsyncResult')
+    def test_results(self, mocked_result):
+        draft = self.draft(self.user, 'a')
+        mocked_result.return_value = MagicMock(result={'user_id': self.user.id, 'results': [
+            {'url': 'https://youtu.be/a', 'download_id': draft.id, 'title': 'a',
+             'format': 'mp4 : 1920x1080', 'existing': False},
+            {'url': 'https://youtu.be/broken', 'error': 'Download failure: Video unavailable'},
+        ]})
+
+        response = self.client.get(reverse('download:bulk_results', kwargs={'task_id': 'bulk-1'}))
+
+        self.assertContains(response, f'name="download" value="{draft.id}"')
+        self.assertContains(response, 'Download failure: Video unavailable')
+
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('download:bulk_results', kwargs={'task_id': 'bulk-1'}))
+        self.assertEqual(response.status_code, 404)
+
+    @patch('download_ui.apps.download.views.AsyncResult')
+    def test_results_of_other_tasks(self, mocked_result):
+        mocked_result.return_value = MagicMock(
+            successful=MagicMock(return_value=False), result=ValueError('secret'))
+        response = self.client.get(reverse('download:bulk_results', kwargs={'task_id': 'a1b2'}))
+        self.assertEqual(response.status_code, 404)
+        mocked_result.assert_not_called()
+
+        # A task of this session that isn't a bulk import
+        for result in ({'source': 'Youtube', 'title': 'a'}, ['a'], {'user_id': 'a', 'results': []}):
+            mocked_result.return_value = MagicMock(result=result)
+            response = self.client.get(
+                reverse('download:bulk_results', kwargs={'task_id': 'bulk-1'}))
+            self.assertEqual(response.status_code, 404)
+
+    @patch('download_ui.apps.download.views.AsyncResult')
+    def test_results_failed(self, mocked_result):
+        mocked_result.return_value = MagicMock(
+            successful=MagicMock(return_value=False), result=ValueError('Redis went away'))
+        response = self.client.get(reverse('download:bulk_results', kwargs={'task_id': 'bulk-1'}))
+        self.assertContains(response, 'Redis went away')
+
+    @override_settings(DOWNLOAD_SLOTS=1)
+    @patch('download_ui.apps.download.tasks.worker_download')
+    def test_queue_selected(self, mocked_worker):
+        first = self.draft(self.user, 'a')
+        second = self.draft(self.user, 'b')
+        unticked = self.draft(self.user, 'c')
+        not_mine = self.draft(self.other, 'd')
+
+        response = self.client.post(
+            reverse('download:bulk_results', kwargs={'task_id': 'bulk-1'}),
+            {'download': [first.id, second.id, not_mine.id]})
+
+        self.assertRedirects(response, reverse('download:home'))
+        statuses = dict(Download.objects.values_list('slug_id', 'status'))
+        self.assertEqual(statuses, {'a': Download.Status.STARTED, 'b': Download.Status.QUEUED,
+                                    'c': Download.Status.DRAFT, 'd': Download.Status.DRAFT})
+        self.assertEqual(mocked_worker.apply_async.call_count, 1)
@@ -1,13 +1,27 @@
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib.metadata import EntryPoint
 from unittest.mock import MagicMock, patch
+from urllib.error import HTTPError, URLError
 from django.conf import settings
 
 from celery.exceptions import SoftTimeLimitExceeded
 from django.test import TestCase
-from youtube_dl.utils import UnsupportedError, ExtractorError
+import requests
+import twitchdl.download
+from youtube_dl.utils import DownloadError as YoutubeDLDownloadError, UnsupportedError, ExtractorError
 
 from download_ui.apps.download.exceptions import DownloadError, ExtractionError
-from download_ui.apps.download.downloaders.downloader import YoutubeDownloader, Downloader, TwitchDownloader
+from download_ui.apps.download.downloaders import downloader as downloader_module
+from download_ui.apps.download.downloaders.downloader import Downloader, is_transient
+from download_ui.apps.download.downloaders import twitch as twitch_backend
+from download_ui.apps.download.downloaders.twitch import TwitchDownloader
+from download_ui.apps.download.downloaders.youtube import YoutubeDownloader
 
 
 class DownloaderTest(TestCase):
@@ -37,6 +51,72 @@ class DownloaderTest(TestCase):
         self.assertEqual(downloader.task, task_mock)
 
 
+class BackendRegistryTest(TestCase):
+    def setUp(self):
+        downloader_module.get_backends.cache_clear()
+        downloader_module.get_backend.cache_clear()
+        self.addCleanup(downloader_module.get_backends.cache_clear)
+        self.addCleanup(downloader_module.get_backend.cache_clear)
+
+    def test_backends_from_entry_points(self):
+        plugin = EntryPoint('FAKE', 'unittest.mock:MagicMock', 'download_ui.downloaders')
+        with patch.object(downloader_module, 'entry_points', return_value=[plugin]) as mocked:
+            self.assertIs(downloader_module.get_backend('FAKE'), MagicMock)
+            self.assertIs(downloader_module.get_backend('YTDL'), YoutubeDownloader)
+            downloader_module.get_backend('TWDL')
+        # Discovered once, not for every downloader
+        mocked.assert_called_once_with(group='download_ui.downloaders')
+
+    def test_unknown_command(self):
+        with self.assertRaises(KeyError):
+            Downloader.get_downloader('NOPE')
+
+    def test_old_import_path(self):
+        from download_ui.apps.download.downloaders.downloader import TwitchDownloader as moved
+        self.assertIs(moved, TwitchDownloader)
+
+    def test_web_process_does_not_load_the_libraries(self):
+        code = ('import sys, django; django.setup(); '
+                'import download_ui.urls, download_ui.apps.download.tasks; '
+                'print(sorted({"youtube_dl", "twitchdl"} & set(sys.modules)))')
+        # A fresh interpreter with the settings of this test run
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+
+class TransientErrorTest(TestCase):
+    def test_network_errors_are_transient(self):
+        self.assertTrue(is_transient(ConnectionResetError()))
+        self.assertTrue(is_transient(TimeoutError()))
+        self.assertTrue(is_transient(URLError('unreachable')))
+        self.assertTrue(is_transient(HTTPError('url', 503, 'Unavailable', {}, None)))
+        self.assertTrue(is_transient(HTTPError('url', 429, 'Too Many Requests', {}, None)))
+        self.assertTrue(is_transient(requests.ConnectionError()))
+        self.assertTrue(is_transient(twitchdl.download.DownloadFailed()))
+        self.assertTrue(is_transient(ExtractorError('Unable to download', cause=URLError('reset'))))
+
+    def test_other_errors_are_not(self):
+        self.assertFalse(is_transient(HTTPError('url', 404, 'Not Found', {}, None)))
+        self.assertFalse(is_transient(UnsupportedError('url')))
+        self.assertFalse(is_transient(ExtractorError('Video unavailable', expected=True)))
+        self.assertFalse(is_transient(ValueError()))
+
+    @patch("download_ui.apps.download.downloaders.youtube.youtube_dl.YoutubeDL")
+    def test_youtube_download_error_is_marked_transient(self, mocked_ydl):
+        try:
+            raise URLError('reset')
+        except URLError:
+            error = YoutubeDLDownloadError('reset', sys.exc_info())
+        mocked_ydl.return_value.download.side_effect = error
+        downloader = YoutubeDownloader()
+
+        with self.assertRaises(DownloadError) as raised:
+            downloader.download('https://youtube.com', '22', 1)
+        self.assertTrue(raised.exception.transient)
+        self.assertTrue(downloader.get_download_opts(None, '22', 1)['continuedl'])
+
+
 class YoutubeDownloaderTest(TestCase):
     @patch("youtube_dl.YoutubeDL")
     def test_downloader_extract_combined_files(self, mocked_youtube_dl):
@@ -317,7 +397,7 @@ class YoutubeDownloaderTest(TestCase):
 
 
 class TwitchDownloaderTest(TestCase):
-    @patch("download_ui.apps.download.downloaders.downloader.utils.format_size")
+    @patch("download_ui.apps.download.downloaders.twitch.utils.format_size")
     def test_downloader_format_size(self, mocked_format_size):
         mocked_format_size.return_value = '23567'
 
@@ -336,9 +416,163 @@ class TwitchDownloaderTest(TestCase):
             'twitch/{title_slug}-3-testcode.{format}'))
         self.assertEqual(options.quality, 'testcode')
         self.assertFalse(options.overwrite)
-
-    def test_downloader_extract_opts(self):
-        downloader = TwitchDownloader()
-        options = downloader.get_extract_opts('www.testurl.com')
-        self.assertEqual(options.identifier, 'www.testurl.com')
-        self.assertTrue(options.json)
+        self.assertEqual(options.max_workers, TwitchDownloader.DEFAULT_MAX_WORKERS)
+        self.assertEqual(options.format, 'mkv')
+        self.assertIsNone(options.start)
+
+    def test_downloader_max_workers(self):
+        self.assertEqual(TwitchDownloader().max_workers, 20)
+        self.assertEqual(TwitchDownloader(max_workers=4).max_workers, 4)
+        options = TwitchDownloader.get_download_opts('www.testurl.com', 'testcode', 3, 4)
+        self.assertEqual(options.max_workers, 4)
+
+
+class VodSegmentHandler(BaseHTTPRequestHandler):
+    """Serves a media playlist and its segments, counting how many segment
+    requests are in flight at once."""
+    segments = 12
+    lock = threading.Lock()
+    active = 0
+    peak = 0
+
+    def do_GET(self):
+        if self.path.endswith('.m3u8'):
+            lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:10']
+            for index in range(self.segments):
+                lines += ['#EXTINF:10.000,', f'{index}.ts']
+            lines.append('#EXT-X-ENDLIST')
+            body = '\n'.join(lines).encode()
+        else:
+            cls = type(self)
+            with cls.lock:
+                cls.active += 1
+                cls.peak = max(cls.peak, cls.active)
+            # Long enough for the other workers to start their requests
+            time.sleep(0.2)
+            with cls.lock:
+                cls.active -= 1
+            body = b'segment'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TwitchParallelDownloadTest(TestCase):
+    """Runs twitch-dl's VOD download against a local HTTP server standing in
+    for the Twitch CDN."""
+
+    def setUp(self):
+        VodSegmentHandler.active = VodSegmentHandler.peak = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), VodSegmentHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.library = tempfile.TemporaryDirectory()
+        self.addCleanup(self.library.cleanup)
+
+        # twitchdl.commands re-exports the download function over the module
+        module = sys.modules['twitchdl.commands.download']
+        host, port = self.server.server_address
+
+        def master(video_id, access_token):
+            # twitch-dl keeps the segments in a folder named after the playlist
+            playlist = f'http://{host}:{port}/vod-{self.id()}-{video_id}/chunked/index-dvr.m3u8'
+            return '\n'.join([
+                '#EXTM3U',
+                '#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="chunked",NAME="1080p60",AUTOSELECT=YES,DEFAULT=YES',
+                '#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080,VIDEO="chunked"',
+                playlist,
+            ])
+        video = {
+            'id': '1234',
+            'title': 'Parallel VOD',
+            'publishedAt': '2021-06-01T10:00:00Z',
+            'game': {'name': 'Chess'},
+            'creator': {'displayName': 'Channel', 'login': 'channel'},
+        }
+        for name, value in (('get_video', video), ('get_access_token', {})):
+            patcher = patch.object(module.twitch, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(module.twitch, 'get_playlists', side_effect=master)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # ffmpeg is not needed to check the segments, the join just touches the target
+        patcher = patch.object(module, '_join_vods', side_effect=self.join_vods)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def join_vods(playlist_path, target, overwrite, video):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        open(target, 'w').close()
+
+    def download(self, max_workers, limiter=None):
+        self.task = MagicMock()
+        downloader = TwitchDownloader(task=self.task, max_workers=max_workers, limiter=limiter)
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library.name):
+            downloader.download('https://www.twitch.tv/videos/1234', '1080p60', 7)
+        return os.path.join(self.library.name, 'twitch', 'parallel_vod-7-1080p60.mkv')
+
+    def test_segments_download_in_parallel(self):
+        target = self.download(max_workers=4)
+        self.assertTrue(os.path.exists(target))
+        self.assertEqual(os.listdir(os.path.dirname(target)), [os.path.basename(target)])
+        self.assertEqual(VodSegmentHandler.peak, 4)
+
+    def test_progress_and_filename_reported(self):
+        target = self.download(max_workers=4)
+
+        states = [(call.kwargs['state'], call.kwargs['meta'])
+                  for call in self.task.update_state.call_args_list]
+        progress = [meta for state, meta in states if state == 'PROGRESS']
+        self.assertEqual(progress[0]['segments'], 1)
+        self.assertEqual(progress[0]['total_segments'], VodSegmentHandler.segments)
+        self.assertEqual(progress[-1]['percent_str'], 'Joining')
+        self.assertEqual(states[-1], ('FILENAME', {'filename': target}))
+
+    def test_single_worker(self):
+        self.download(max_workers=1)
+        self.assertEqual(VodSegmentHandler.peak, 1)
+
+    def test_segments_draw_on_the_bandwidth_limiter(self):
+        limiter = MagicMock()
+        self.download(max_workers=4, limiter=limiter)
+
+        received = sum(call.args[0] for call in limiter.consume.call_args_list)
+        self.assertEqual(received, VodSegmentHandler.segments * len(b'segment'))
+        self.assertIs(twitchdl.download._download, twitch_backend.pooled_download)
+
+    def test_downloads_at_once_keep_their_own_limiter(self):
+        limiters = [MagicMock(), None, MagicMock()]
+        errors = []
+
+        def download(index, limiter):
+            try:
+                downloader = TwitchDownloader(task=MagicMock(), max_workers=4, limiter=limiter)
+                downloader.download(f'https://www.twitch.tv/videos/{1000 + index}', '1080p60',
+                                    index)
+            except Exception as error:
+                errors.append(error)
+
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library.name):
+            threads = [threading.Thread(target=download, args=(index, limiter))
+                       for index, limiter in enumerate(limiters)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        # All three ran at once, each limiter only saw its own segments
+        self.assertGreater(VodSegmentHandler.peak, 4)
+        for limiter in (limiters[0], limiters[2]):
+            received = sum(call.args[0] for call in limiter.consume.call_args_list)
+            self.assertEqual(received, VodSegmentHandler.segments * len(b'segment'))
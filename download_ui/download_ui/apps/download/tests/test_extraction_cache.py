@@ -0,0 +1,128 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from download_ui.apps.download import extraction_cache
+from download_ui.apps.download.models import ExtractionCacheEntry
+
+
+RESULT = {
+    'source': 'Youtube',
+    'title': 'Test Title',
+    'slug_id': 'sluggy',
+    'channel_name': 'youtuber man',
+    'format_info': [['mkv', '720p', '54'], ['mp4', '360p', '36']]
+}
+
+
+class CanonicalizeUrlTest(TestCase):
+    def test_youtube_variants_collapse(self):
+        variants = [
+            'https://www.youtube.com/watch?v=sluggy',
+            'https://youtube.com/watch?v=sluggy&t=30s',
+            'http://m.youtube.com/watch?feature=share&v=sluggy',
+            'https://youtu.be/sluggy?t=12',
+            'https://www.youtube.com/shorts/sluggy',
+            'https://www.youtube.com/embed/sluggy',
+            'https://www.youtube.com/watch?v=sluggy&list=PL123&index=4#comments',
+        ]
+        for url in variants:
+            self.assertEqual(extraction_cache.canonicalize_url(url),
+                             'https://youtube.com/watch?v=sluggy')
+
+    def test_youtube_playlist_keeps_list(self):
+        self.assertEqual(
+            extraction_cache.canonicalize_url('https://www.youtube.com/playlist?list=PL123'),
+            'https://youtube.com/playlist?list=PL123')
+
+    def test_twitch_variants_collapse(self):
+        self.assertEqual(
+            extraction_cache.canonicalize_url('https://www.twitch.tv/videos/1234?t=1h2m'),
+            'https://twitch.tv/videos/1234')
+        self.assertEqual(
+            extraction_cache.canonicalize_url('https://www.twitch.tv/streamer/clip/FunnySlug?filter=clips'),
+            'https://clips.twitch.tv/FunnySlug')
+        self.assertEqual(
+            extraction_cache.canonicalize_url('https://clips.twitch.tv/FunnySlug/'),
+            'https://clips.twitch.tv/FunnySlug')
+
+    def test_other_urls_drop_tracking(self):
+        self.assertEqual(
+            extraction_cache.canonicalize_url('http://www.Vimeo.com/123/?utm_source=x&b=2&a=1#top'),
+            'https://vimeo.com/123?a=1&b=2')
+
+
+class ExtractionCacheTest(TestCase):
+    def test_miss_then_hit(self):
+        url = 'https://www.youtube.com/watch?v=sluggy'
+        self.assertIsNone(extraction_cache.get_extraction('YTDL', url))
+
+        extraction_cache.set_extraction('YTDL', url, RESULT)
+
+        self.assertEqual(extraction_cache.get_extraction(
+            'YTDL', 'https://youtu.be/sluggy'), RESULT)
+        self.assertIsNone(extraction_cache.get_extraction('TWDL', url))
+        stats = extraction_cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_stale_lookups_count_as_misses(self):
+        url = 'https://youtu.be/sluggy'
+        extraction_cache.set_extraction('YTDL', url, RESULT)
+        ExtractionCacheEntry.objects.update(expires_at=timezone.now())
+
+        self.assertIsNone(extraction_cache.get_extraction('YTDL', url))
+        self.assertIsNone(extraction_cache.get_extraction('YTDL', url, count_miss=False))
+        extraction_cache.set_extraction('YTDL', url, RESULT)
+        self.assertEqual(extraction_cache.get_extraction('YTDL', url), RESULT)
+
+        stats = extraction_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_concurrent_extractions_store_once(self):
+        url = 'https://youtu.be/sluggy'
+        extraction_cache.set_extraction('YTDL', url, RESULT)
+        filter_entries = ExtractionCacheEntry.objects.filter
+
+        def stored_meanwhile(*args, **kwargs):
+            # The other extraction's entry appears after the first update
+            if not stored_meanwhile.called:
+                stored_meanwhile.called = True
+                return ExtractionCacheEntry.objects.none()
+            return filter_entries(*args, **kwargs)
+        stored_meanwhile.called = False
+
+        with patch.object(ExtractionCacheEntry.objects, 'filter', side_effect=stored_meanwhile):
+            extraction_cache.set_extraction('YTDL', url, dict(RESULT, title='Newer'))
+
+        entry = ExtractionCacheEntry.objects.get()
+        self.assertEqual(entry.result['title'], 'Newer')
+        self.assertEqual(entry.misses, 2)
+
+    @override_settings(EXTRACTION_CACHE_TTL={'default': 60, 'Youtube': 0})
+    def test_per_source_ttl(self):
+        url = 'https://www.youtube.com/watch?v=sluggy'
+        extraction_cache.set_extraction('YTDL', url, RESULT)
+        self.assertIsNone(extraction_cache.get_extraction('YTDL', url))
+
+        twitch_result = dict(RESULT, source='Twitch')
+        extraction_cache.set_extraction('TWDL', 'https://twitch.tv/videos/1', twitch_result)
+        entry = ExtractionCacheEntry.objects.get(key='TWDL:https://twitch.tv/videos/1')
+        self.assertAlmostEqual(entry.expires_at, timezone.now() + timedelta(seconds=60),
+                               delta=timedelta(seconds=5))
+
+    @override_settings(EXTRACTION_CACHE_MAX_ENTRIES=2)
+    def test_least_recently_used_evicted(self):
+        extraction_cache.set_extraction('YTDL', 'https://youtu.be/one', RESULT)
+        extraction_cache.set_extraction('YTDL', 'https://youtu.be/two', RESULT)
+        ExtractionCacheEntry.objects.filter(key__endswith='one').update(
+            last_used_at=timezone.now() + timedelta(seconds=1))
+        extraction_cache.set_extraction('YTDL', 'https://youtu.be/three', RESULT)
+
+        keys = set(ExtractionCacheEntry.objects.values_list('key', flat=True))
+        self.assertEqual(keys, {'YTDL:https://youtube.com/watch?v=one',
+                                'YTDL:https://youtube.com/watch?v=three'})
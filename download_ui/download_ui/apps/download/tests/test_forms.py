@@ -1,13 +1,16 @@
 from django.forms import URLField
 from django.test import TestCase
 
+from download_ui.apps.download import extraction_cache
 from download_ui.apps.download.forms import DownloadForm, DownloadFormatForm
-from download_ui.apps.download.models import Command, Source, Quality, Extension, Format, Download
+from download_ui.apps.download.models import (Command, Source, Quality, Extension, Format, Download,
+                                              UserProfile)
 
 
 class DownloadFormTest(TestCase):
     @classmethod
     def setUpTestData(cls):
+        user = UserProfile.objects.create(username='former', is_approved=True)
         command = Command.objects.create(name='YTDL')
         quality = Quality.objects.create(name='720p')
         extension = Extension.objects.create(name='mkv')
@@ -18,6 +21,7 @@ class DownloadFormTest(TestCase):
         source = Source.objects.create(name='Youtube')
         download = Download.objects.create(command=command,
                                            source=source,
+                                           created_by=user,
                                            url='https://www.youtube.com',
                                            title='Testing Title 123')
         download.choices_for.add(format_test)
@@ -46,3 +50,35 @@ class DownloadFormTest(TestCase):
         )
         self.assertEqual(form.fields['file_format'].queryset.count(), 1)
         self.assertEqual(form.fields['file_format'].queryset.all()[0].id, 1)
+
+    def test_download_form_with_cached_extraction(self):
+        extraction_cache.set_extraction('YTDL', 'https://youtu.be/sluggy', {
+            'source': 'Youtube',
+            'title': 'Test Title',
+            'slug_id': 'sluggy',
+            'channel_name': 'youtuber man',
+            'format_info': [['mkv', '720p', '64'], ['mp4', '360p', '36']]
+        })
+        url = 'https://www.youtube.com/watch?v=sluggy'
+        form = DownloadForm({'command': 1, 'url': url})
+        form.instance.extraction = extraction_cache.get_extraction('YTDL', url)
+
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.instance.slug_id, 'sluggy')
+        self.assertEqual(form.instance.source.name, 'Youtube')
+        self.assertEqual(len(form.instance.format_ids), 2)
+
+    def test_download_format_form_max_workers(self):
+        download = Download.objects.get(id=1)
+        form = DownloadFormatForm(instance=download, initial={'id': download.id})
+        self.assertNotIn('max_workers', form.fields)
+
+        download.command = Command.objects.create(name='TWDL')
+        with self.settings(DOWNLOAD_MAX_WORKERS_CAP=32):
+            form = DownloadFormatForm(instance=download, initial={'id': download.id})
+        self.assertEqual(form.fields['max_workers'].widget.attrs['max'], 32)
+        form = DownloadFormatForm(instance=download, initial={'id': download.id}, data={
+            'command': download.command.pk, 'url': download.url,
+            'file_format': Format.objects.get().pk, 'max_workers': 100})
+        self.assertFalse(form.is_valid())
+        self.assertIn('max_workers', form.errors)
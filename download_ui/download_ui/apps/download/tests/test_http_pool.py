@@ -0,0 +1,160 @@
+import gzip
+import os
+import ssl
+import tempfile
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from django.test import TestCase
+import requests
+
+from download_ui.apps.download.downloaders import http_pool
+from download_ui.apps.download.downloaders.http_pool import HTTPPool, get_pool
+from download_ui.apps.download.downloaders.twitch import fetch_to_file
+from download_ui.apps.download.downloaders.youtube import build_youtube_dl
+
+# A self-signed certificate and its key for localhost and 127.0.0.1
+CERTIFICATE = os.path.join(os.path.dirname(__file__), 'fixtures', 'localhost.pem')
+
+
+class ClipHandler(BaseHTTPRequestHandler):
+    """Stands in for a CDN serving small clips over HTTPS, noting the client
+    port of every request."""
+    protocol_version = 'HTTP/1.1'
+    connections = []
+
+    def reply(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.connections.append(self.client_address)
+        if self.path.startswith('/clips/'):
+            self.reply(200, b'clip' * 256, [('Content-Type', 'video/mp4')])
+        elif self.path == '/gzip':
+            self.reply(200, gzip.compress(b'compressed'), [('Content-Encoding', 'gzip')])
+        elif self.path == '/moved':
+            self.reply(302, b'', [('Location', '/clips/moved.mp4')])
+        else:
+            self.reply(404, b'not found')
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPPoolTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ClipHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(CERTIFICATE)
+        cls.server.socket = context.wrap_socket(cls.server.socket, server_side=True)
+        thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        thread.start()
+        cls.addClassCleanup(thread.join)
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+        host, port = cls.server.server_address
+        cls.base_url = f'https://{host}:{port}'
+
+    def setUp(self):
+        ClipHandler.connections = []
+        self.pool = HTTPPool(hosts=4, per_host=2, idle_seconds=60, ca_certs=CERTIFICATE)
+        patcher = patch.object(http_pool, '_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Lets the server's keep-alive handlers finish before it closes
+        self.addCleanup(self.pool.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_clips_share_a_connection(self):
+        download = partial(fetch_to_file, self.pool)
+        for index in range(5):
+            path = os.path.join(self.directory, f'{index}.mp4')
+            self.assertEqual(download(f'{self.base_url}/clips/{index}.mp4', path), 1024)
+            with open(path, 'rb') as clip:
+                self.assertEqual(clip.read(), b'clip' * 256)
+
+        self.assertEqual(len(ClipHandler.connections), 5)
+        self.assertEqual(len(set(ClipHandler.connections)), 1)
+        self.assertEqual(self.pool.stats(), {'hosts': 1, 'requests': 5, 'connections': 1,
+                                             'reused': 4, 'reuse_ratio': 0.8})
+
+    def test_failed_clip_is_retried_by_twitch_dl(self):
+        download = partial(fetch_to_file, self.pool)
+        with self.assertRaises(requests.HTTPError):
+            download(f'{self.base_url}/missing', os.path.join(self.directory, 'missing.mp4'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        # Nothing listens there any more
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ClipHandler)
+        host, port = server.server_address
+        server.server_close()
+        with self.assertRaises(requests.ConnectionError):
+            download(f'https://{host}:{port}/clips/0.mp4', os.path.join(self.directory, '0.mp4'))
+
+        # Neither spoils the connection for the next clip
+        download(f'{self.base_url}/clips/0.mp4', os.path.join(self.directory, '0.mp4'))
+        self.assertEqual(len(set(ClipHandler.connections)), 1)
+
+    def test_youtube_dl_requests_share_a_connection(self):
+        with build_youtube_dl({'quiet': True}) as ydl:
+            for index in range(3):
+                response = ydl.urlopen(f'{self.base_url}/clips/{index}.mp4')
+                self.assertEqual(response.getcode(), 200)
+                self.assertEqual(response.headers['Content-Type'], 'video/mp4')
+                self.assertEqual(response.read(), b'clip' * 256)
+            # youtube-dl follows redirects and decodes the body itself
+            response = ydl.urlopen(f'{self.base_url}/moved')
+            self.assertEqual(response.geturl(), f'{self.base_url}/clips/moved.mp4')
+            response.read()
+            self.assertEqual(ydl.urlopen(f'{self.base_url}/gzip').read(), b'compressed')
+            # A body left half read closes its connection
+            ydl.urlopen(f'{self.base_url}/clips/partial.mp4').read(10)
+
+        self.assertEqual(len(ClipHandler.connections), 7)
+        self.assertEqual(len(set(ClipHandler.connections)), 1)
+        stats = self.pool.stats()
+        self.assertEqual((stats['requests'], stats['connections']), (7, 1))
+
+    def test_youtube_dl_with_a_proxy_keeps_its_own_connections(self):
+        ydl = build_youtube_dl({'quiet': True, 'proxy': 'http://127.0.0.1:9'})
+        self.assertFalse(any(isinstance(handler, http_pool.PooledHTTPHandler)
+                             for handler in ydl._opener.handlers))
+
+    def test_idle_hosts_are_closed(self):
+        download = partial(fetch_to_file, self.pool)
+        download(f'{self.base_url}/clips/0.mp4', os.path.join(self.directory, '0.mp4'))
+
+        self.assertEqual(self.pool.evict_idle(now=1000), 0)
+        self.assertEqual(self.pool.evict_idle(now=1030), 0)
+        self.assertEqual(self.pool.evict_idle(now=1060), 1)
+
+        download(f'{self.base_url}/clips/1.mp4', os.path.join(self.directory, '1.mp4'))
+        self.assertEqual(len(set(ClipHandler.connections)), 2)
+        # The closed host's requests still count
+        self.assertEqual(self.pool.stats(), {'hosts': 1, 'requests': 2, 'connections': 2,
+                                             'reused': 0, 'reuse_ratio': 0.0})
+
+    def test_used_hosts_stay_open(self):
+        download = partial(fetch_to_file, self.pool)
+        download(f'{self.base_url}/clips/0.mp4', os.path.join(self.directory, '0.mp4'))
+        self.pool.evict_idle(now=1000)
+        download(f'{self.base_url}/clips/1.mp4', os.path.join(self.directory, '1.mp4'))
+
+        self.assertEqual(self.pool.evict_idle(now=1060), 0)
+        self.assertEqual(self.pool.stats()['hosts'], 1)
+
+    def test_forked_workers_get_a_pool_of_their_own(self):
+        self.assertIs(get_pool(), self.pool)
+        self.pool.pid = -1
+        self.assertIsNot(get_pool(), self.pool)
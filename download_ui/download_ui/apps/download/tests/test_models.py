@@ -4,17 +4,20 @@ from django.forms import ValidationError
 
 from django.test import TestCase
 
-from download_ui.apps.download.models import Command, Source, Quality, Extension, Format, Download
+from download_ui.apps.download.models import (Command, Source, Quality, Extension, Format, Download,
+                                              UserProfile)
 from download_ui.apps.download.exceptions import ExtractionError
 
 
 class DownloadModelTest(TestCase):
     @classmethod
     def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='modeller', is_approved=True)
         command = Command.objects.create(name='YTDL')
         source = Source.objects.create(name='Twitch')
         Download.objects.create(command=command,
                                 source=source,
+                                created_by=cls.user,
                                 url='https://www.twitch.com',
                                 title='Testing Title 123')
         quality = Quality.objects.create(name='720p')
@@ -33,6 +36,26 @@ class DownloadModelTest(TestCase):
         download = Download.objects.get(id=1)
         self.assertEqual(download.get_absolute_url(), '/download/1/')
 
+    def test_get_max_workers(self):
+        download = Download.objects.get(id=1)
+        self.assertEqual(download.get_max_workers(), 20)
+        with self.settings(DOWNLOAD_MAX_WORKERS={'default': 20, 'Twitch': 8}):
+            self.assertEqual(download.get_max_workers(), 8)
+        download.max_workers = 4
+        self.assertEqual(download.get_max_workers(), 4)
+
+    def test_priority_for(self):
+        self.assertEqual(Download.priority_for(None), Download.Priority.NORMAL)
+        self.assertEqual(Download.priority_for(30), Download.Priority.HIGH)
+        self.assertEqual(Download.priority_for(45 * 60), Download.Priority.NORMAL)
+        self.assertEqual(Download.priority_for(4 * 60 * 60), Download.Priority.LOW)
+
+    def test_get_max_workers_is_capped(self):
+        download = Download.objects.get(id=1)
+        download.max_workers = 500
+        with self.settings(DOWNLOAD_MAX_WORKERS_CAP=32):
+            self.assertEqual(download.get_max_workers(), 32)
+
     def test_set_missing_if_file_not_found_is_missing(self):
         download = Download.objects.get(id=1)
         download.status = Download.Status.COMPLETED
@@ -81,8 +104,30 @@ class DownloadModelTest(TestCase):
         self.assertTrue(not os.path.exists(filename))
         self.assertEqual(download.status, Download.Status.TERMINATED)
 
+    def test_clean_fields(self):
+        download = Download()
+        download.url = 'https://www.youtube.com/watch?v=currentslug'
+        download.command = Command.objects.get(id=1)
+        download.extraction = {'error': 'Extraction failed to work'}
+
+        with self.assertRaisesMessage(ValidationError, 'Download failure: Extraction failed to work'):
+            download.clean_fields(exclude=[
+                'source', 'created_by', 'file_path', 'title', 'slug_id', 'channel_name', 'size',
+                'active_task_id'])
+
+    def test_clean_fields_extraction_pending(self):
+        download = Download()
+        download.url = 'https://www.youtube.com/watch?v=currentslug'
+        download.command = Command.objects.get(id=1)
+
+        download.clean_fields(exclude=[
+            'source', 'created_by', 'file_path', 'title', 'slug_id', 'channel_name', 'size',
+            'active_task_id'])
+        self.assertEqual(download.slug_id, '')
+        self.assertEqual(download.format_ids, [])
+
     @patch("download_ui.apps.download.models.Downloader.get_downloader")
-    def test_clean_fields(self, mocked_downloader):
+    def test_extract(self, mocked_downloader):
         mocked_extract = MagicMock()
         mocked_extract.side_effect = ExtractionError(
             'youtube-dl', 'Extraction failed to work')
@@ -91,15 +136,37 @@ class DownloadModelTest(TestCase):
         download.url = 'https://www.youtube.com/watch?v=currentslug'
         download.command = Command.objects.get(id=1)
 
-        with self.assertRaisesMessage(ValidationError, 'Download failure: Extraction failed to work'):
-            download.clean_fields(exclude=[
-                                  'source', 'file_path', 'title', 'slug_id', 'channel_name', 'size', 'active_task_id'])
+        result = download.extract()
+
+        self.assertEqual(result, {'error': 'Extraction failed to work'})
+        self.assertEqual(download.extraction, result)
+
+    def test_clean_fields_with_extraction(self):
+        download = Download()
+        download.url = 'https://www.youtube.com/watch?v=currentslug'
+        download.command = Command.objects.get(id=1)
+        download.extraction = {
+            'source': 'Youtube',
+            'title': 'Test Title',
+            'slug_id': 'currentslug',
+            'channel_name': 'youtuber man',
+            'format_info': [['mkv', '720p', '54'], ['mp4', '360p', '36']]
+        }
+
+        download.clean_fields(exclude=[
+            'source', 'created_by', 'file_path', 'title', 'slug_id', 'channel_name', 'size',
+            'active_task_id'])
+        self.assertEqual(download.source.name, 'Youtube')
+        self.assertEqual(download.slug_id, 'currentslug')
+        self.assertEqual(len(download.format_ids), 2)
+        self.assertEqual(download.format_ids[0], 1)
 
     def test_save_first_save_with_format_ids(self):
         download = Download()
         format_test = Format.objects.get(id=1)
         download.command = Command.objects.get(id=1)
         download.source = Source.objects.get(id=1)
+        download.created_by = self.user
         download.format_ids = [format_test.id]
         self.assertTrue(not download.id)
         download.save()
@@ -177,3 +244,53 @@ class FormatModelTest(TestCase):
         format_test = Format.objects.get(id=1)
         expected_object_name = f'{format_test.extension.name} : {format_test.quality.name}'
         self.assertEqual(str(format_test), expected_object_name)
+
+    def test_bulk_get_or_create_query_count(self):
+        format_info = [('mkv', '720p', '99')] + [
+            ('mp4', f'{height}p', str(height)) for height in range(100, 120)]
+
+        # Command, then select/insert/select for extensions, qualities and formats
+        with self.assertNumQueries(10):
+            format_ids = Format.bulk_get_or_create('YTDL', format_info)
+
+        self.assertEqual(len(format_ids), 21)
+        self.assertEqual(format_ids[0], 1)
+        self.assertEqual(Format.objects.get(id=1).format_code, '64')
+        new_format = Format.objects.get(id=format_ids[-1])
+        self.assertEqual(str(new_format), 'mp4 : 119p')
+        self.assertEqual(new_format.format_code, '119')
+
+        # Everything exists on the second pass so nothing is inserted
+        with self.assertNumQueries(4):
+            self.assertEqual(Format.bulk_get_or_create('YTDL', format_info), format_ids)
+
+    def test_bulk_get_or_create_duplicates(self):
+        format_ids = Format.bulk_get_or_create(
+            'YTDL', [('mp4', '360p', '18'), ('mp4', '360p', '134+bestaudio')])
+        self.assertEqual(len(format_ids), 1)
+        self.assertEqual(Format.objects.get(id=format_ids[0]).format_code, '18')
+
+
+class DownloadIndexTest(TestCase):
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(f'USING INDEX {index_name}', queryset.explain())
+
+    def test_dedupe_lookups(self):
+        self.assertUsesIndex(
+            Download.objects.filter(slug_id='a1b2', status=Download.Status.COMPLETED),
+            'download_slug_status_format')
+        self.assertUsesIndex(
+            Download.objects.filter(slug_id='a1b2', status=Download.Status.COMPLETED,
+                                    file_format=1),
+            'download_slug_status_format')
+
+    def test_home_lookup(self):
+        self.assertUsesIndex(
+            Download.objects.filter(created_at__gte='2021-01-01', created_by=1).exclude(
+                status=Download.Status.DRAFT),
+            'download_user_created')
+
+    def test_missing_files_lookup(self):
+        self.assertUsesIndex(
+            Download.objects.filter(status=Download.Status.COMPLETED),
+            'download_status')
@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from download_ui.apps.download.models import Command, Download, Source, UserProfile
+from download_ui.apps.download.pagination import InvalidCursor, KeysetPaginator
+
+
+class KeysetPaginatorTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = UserProfile.objects.create(username='pager', is_approved=True)
+        command = Command.objects.create(name='YTDL')
+        source = Source.objects.create(name='Youtube')
+        now = timezone.now()
+        for down_id in range(25):
+            download = Download.objects.create(
+                command=command,
+                source=source,
+                created_by=user,
+                url=f'URL {down_id}',
+                title=f'Title {down_id}'
+            )
+            # Pairs of downloads share a timestamp so the id breaks the tie
+            Download.objects.filter(pk=download.pk).update(
+                created_at=now - timedelta(minutes=down_id // 2))
+
+    def setUp(self):
+        cache.clear()
+        self.queryset = Download.objects.order_by('-created_at', '-id')
+        self.expected = list(self.queryset)
+
+    def paginator(self, queryset=None):
+        return KeysetPaginator(queryset if queryset is not None else self.queryset, 10)
+
+    def test_walks_forward_through_every_row(self):
+        paginator = self.paginator()
+        page = paginator.page()
+        rows = list(page)
+        self.assertFalse(page.has_previous())
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            rows.extend(page)
+        self.assertEqual(rows, self.expected)
+        self.assertEqual(len(page), 5)
+
+    def test_walks_back_to_the_first_page(self):
+        paginator = self.paginator()
+        second = paginator.page(paginator.page().next_cursor)
+        third = paginator.page(second.next_cursor)
+        self.assertEqual(list(paginator.page(third.previous_cursor)), self.expected[10:20])
+        first = paginator.page(second.previous_cursor)
+        self.assertEqual(list(first), self.expected[:10])
+        self.assertFalse(first.has_previous())
+        self.assertTrue(first.has_next())
+
+    def test_deep_pages_skip_rows_in_the_query(self):
+        paginator = self.paginator()
+        cursor = paginator.page(paginator.page().next_cursor).next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            paginator.page(cursor)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+        self.assertIn('LIMIT 11', queries[0]['sql'])
+
+    def test_adds_the_primary_key_to_the_ordering(self):
+        paginator = self.paginator(Download.objects.all())
+        self.assertEqual(paginator.ordering, ['-created_at', '-updated_at', '-pk'])
+
+    def test_invalid_cursor(self):
+        paginator = self.paginator()
+        with self.assertRaises(InvalidCursor):
+            paginator.page('bogus')
+        other = KeysetPaginator(Download.objects.order_by('title'), 10)
+        with self.assertRaises(InvalidCursor):
+            paginator.page(other.page().next_cursor + 'x')
+
+    def test_count_is_cached(self):
+        paginator = self.paginator()
+        self.assertEqual(paginator.count, 25)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.paginator().count, 25)
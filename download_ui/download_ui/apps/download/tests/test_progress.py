@@ -0,0 +1,135 @@
+from unittest.mock import MagicMock
+
+from django.test import TestCase, override_settings
+
+from download_ui.apps.download.downloaders.youtube import YoutubeDownloader
+from download_ui.apps.download.downloaders.progress import ProgressReporter, TwitchOutput
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def meta(percent):
+    return {'percent_str': f'{percent}%', 'percent': str(round(percent))}
+
+
+class ProgressReporterTest(TestCase):
+    def setUp(self):
+        self.task = MagicMock()
+        self.clock = FakeClock()
+        self.reporter = ProgressReporter(
+            self.task, min_interval=1.0, min_delta=5.0, clock=self.clock)
+
+    def emitted(self):
+        return [(kwargs['state'], kwargs['meta'])
+                for _, kwargs in self.task.update_state.call_args_list]
+
+    def test_first_update_always_emitted(self):
+        self.reporter.update(0.1, meta(0.1))
+        self.assertEqual(self.emitted(), [('PROGRESS', meta(0.1))])
+
+    def test_updates_coalesced(self):
+        for step in range(1, 401):
+            self.reporter.update(step / 100, meta(step / 100))
+        self.assertEqual(self.emitted(), [('PROGRESS', meta(0.01))])
+        self.assertEqual(self.reporter.pending, meta(4.0))
+
+    def test_percent_delta_emits(self):
+        self.reporter.update(1.0, meta(1.0))
+        self.reporter.update(3.0, meta(3.0))
+        self.reporter.update(6.0, meta(6.0))
+        self.assertEqual(self.emitted(), [('PROGRESS', meta(1.0)), ('PROGRESS', meta(6.0))])
+
+    def test_interval_emits(self):
+        self.reporter.update(1.0, meta(1.0))
+        self.clock.now = 0.5
+        self.reporter.update(1.5, meta(1.5))
+        self.clock.now = 1.0
+        self.reporter.update(2.0, meta(2.0))
+        self.assertEqual(self.emitted(), [('PROGRESS', meta(1.0)), ('PROGRESS', meta(2.0))])
+
+    def test_last_update_always_emitted(self):
+        self.reporter.update(98.0, meta(98.0))
+        self.reporter.update(100.0, meta(100.0))
+        self.assertEqual(self.emitted()[-1], ('PROGRESS', meta(100.0)))
+
+    def test_finished_flushes_pending(self):
+        self.reporter.update(1.0, meta(1.0))
+        self.reporter.update(2.0, meta(2.0))
+        self.reporter.finished({'filename': 'my_file.txt'})
+        self.assertEqual(self.emitted(), [
+            ('PROGRESS', meta(1.0)),
+            ('PROGRESS', meta(2.0)),
+            ('FILENAME', {'filename': 'my_file.txt'}),
+        ])
+        self.assertIsNone(self.reporter.pending)
+
+    @override_settings(DOWNLOAD_PROGRESS_MIN_INTERVAL=30.0, DOWNLOAD_PROGRESS_MIN_DELTA=10.0)
+    def test_settings_defaults(self):
+        reporter = ProgressReporter(self.task)
+        self.assertEqual(reporter.min_interval, 30.0)
+        self.assertEqual(reporter.min_delta, 10.0)
+
+    @override_settings(DOWNLOAD_PROGRESS_MIN_INTERVAL=60.0, DOWNLOAD_PROGRESS_MIN_DELTA=5.0)
+    def test_youtube_hook_coalesced(self):
+        downloader = YoutubeDownloader(task=self.task, code='64')
+        for tenth in range(1, 1001):
+            downloader.my_hook({
+                'status': 'downloading',
+                '_percent_str': f'{tenth / 10}%',
+                '_eta_str': '2:00 s'
+            })
+        downloader.my_hook({'status': 'finished', 'filename': 'my_file.txt'})
+
+        states = self.emitted()
+        self.assertEqual(len(states), 22)
+        self.assertEqual(states[0][1]['percent_str'], '0.1%')
+        self.assertEqual(states[-2][1]['percent_str'], '100.0%')
+        self.assertEqual(states[-1], ('FILENAME', {'filename': 'my_file.txt'}))
+
+
+class TwitchOutputTest(TestCase):
+    def setUp(self):
+        self.progress = MagicMock()
+        self.output = TwitchOutput(self.progress)
+
+    def test_progress_lines(self):
+        # As twitch-dl prints them, colored and padded, split across writes
+        self.output.write('\nDownloading 340 VODs using 20 workers to /tmp/vod\n')
+        self.output.write('\rDownloaded VOD 12/340 (3%) \x1b[96m24.1MB\x1b[0m of '
+                          '\x1b[96m~683.5MB\x1b[0m at \x1b[96m5.2MB/s\x1b[0m remaining '
+                          '\x1b[96m~2 min 6 sec\x1b[0m   ')
+        self.progress.update.assert_not_called()
+        self.output.write('\rDownloaded VOD 13/340 (3%) 26.0MB of ~680.1MB  ')
+
+        percent, meta = self.progress.update.call_args_list[0].args
+        self.assertEqual(percent, 3.0)
+        self.assertEqual(meta, {
+            'percent_str': '3%', 'percent': '3', 'segments': 12, 'total_segments': 340,
+            'speed': '5.2MB/s', 'detail': '12/340 segments at 5.2MB/s, ~2 min 6 sec left'})
+
+        self.output.close()
+        _, meta = self.progress.update.call_args.args
+        self.assertEqual(meta['detail'], '13/340 segments')
+        self.assertIsNone(meta['speed'])
+
+    def test_filename(self):
+        self.output.write('\n\nJoining files...\n')
+        self.output.write('\nDownloaded: \x1b[92m/videos/twitch/vod-7-1080p60.mkv\x1b[0m\n')
+
+        self.assertEqual(self.output.filename, '/videos/twitch/vod-7-1080p60.mkv')
+        self.progress.update.assert_called_once_with(
+            100.0, {'percent_str': 'Joining', 'percent': '100', 'detail': 'Joining the segments'})
+
+    def test_output_is_not_kept(self):
+        for done in range(1, 5001):
+            self.output.write(f'\rDownloaded VOD {done}/5000 ({done // 50}%) 1.0MB of ~5.0GB')
+            self.assertLess(len(self.output.partial), 100)
+        self.output.write('x' * (TwitchOutput.MAX_LINE + 1))
+        self.assertEqual(self.output.partial, '')
+
@@ -0,0 +1,454 @@
+from datetime import timedelta
+import os
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import redis
+
+from download_ui.apps.download import scheduler
+from download_ui.apps.download.models import (Command, Download, Extension, Format, Quality, Source,
+                                              UserProfile)
+from download_ui.apps.download.tasks import worker_download
+from download_ui.apps.download.tests.test_tasks import MockedTask
+
+
+class FakeLock:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def acquire(self, blocking=True):
+        if self.name in self.store:
+            return False
+        self.store[self.name] = 1
+        return True
+
+    def release(self):
+        del self.store[self.name]
+
+
+class FakeRedis:
+    """The few Redis commands the scheduler's lock uses, in memory."""
+
+    def __init__(self):
+        self.store = {}
+
+    def lock(self, name, timeout=None):
+        return FakeLock(self.store, name)
+
+    def set(self, name, value, ex=None):
+        self.store[name] = value
+
+    def get(self, name):
+        return self.store.get(name)
+
+    def delete(self, name):
+        self.store.pop(name, None)
+
+
+@override_settings(DOWNLOAD_SLOTS=2, DOWNLOAD_USER_SLOTS=1, DOWNLOAD_ESTIMATE_SECONDS=600)
+class SchedulerTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = UserProfile.objects.create(username='alice', is_approved=True)
+        cls.bob = UserProfile.objects.create(username='bob', is_approved=True)
+        cls.carol = UserProfile.objects.create(username='carol', is_approved=True)
+        cls.command = Command.objects.create(name='TWDL')
+        cls.source = Source.objects.create(name='Twitch')
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = patch.object(scheduler, 'get_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = timezone.now()
+        patcher = patch('download_ui.apps.download.tasks.worker_download')
+        self.mocked_worker = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, user, minutes_ago=0, status=Download.Status.QUEUED,
+               priority=Download.Priority.NORMAL, duration=None, **fields):
+        moment = self.now - timedelta(minutes=minutes_ago)
+        return Download.objects.create(
+            command=self.command, source=self.source, created_by=user,
+            url='https://www.twitch.tv/videos/1', title=f'{user} {minutes_ago}',
+            status=status, priority=priority, duration=duration, queued_at=moment,
+            started_at=moment if status == Download.Status.STARTED else None, **fields)
+
+    def started_ids(self):
+        return [call.args[0][0] for call in self.mocked_worker.apply_async.call_args_list]
+
+
+class DispatchTest(SchedulerTestCase):
+    def test_one_user_can_not_take_every_slot(self):
+        flood = [self.create(self.alice, minutes_ago=60 - index) for index in range(50)]
+        late = self.create(self.bob)
+
+        self.assertEqual(scheduler.dispatch(), [flood[0].id, late.id])
+
+        self.assertEqual(self.started_ids(), [flood[0].id, late.id])
+        late.refresh_from_db()
+        self.assertEqual(late.status, Download.Status.STARTED)
+        self.assertIsNotNone(late.started_at)
+        _, kwargs = self.mocked_worker.apply_async.call_args
+        self.assertEqual(kwargs['task_id'], late.active_task_id)
+
+    def test_full_slots_start_nothing(self):
+        self.create(self.alice, status=Download.Status.STARTED)
+        self.create(self.bob, status=Download.Status.STARTED)
+        self.create(self.carol)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(scheduler.dispatch(), [])
+
+    def test_users_take_turns(self):
+        self.create(self.alice, minutes_ago=5, status=Download.Status.STARTED)
+        alice = self.create(self.alice, minutes_ago=30)
+        bob = self.create(self.bob, minutes_ago=1)
+        carol = self.create(self.carol, minutes_ago=2)
+
+        # Alice is at her limit, Carol has waited longer than Bob
+        self.assertEqual(scheduler.dispatch(), [carol.id])
+        Download.objects.filter(created_by=self.alice, status=Download.Status.STARTED).update(
+            status=Download.Status.COMPLETED)
+        # Alice's download has finished, but she had the last turn
+        self.assertEqual(scheduler.dispatch(), [bob.id])
+        self.assertEqual(Download.objects.get(pk=alice.id).status, Download.Status.QUEUED)
+
+    def test_priority_goes_first(self):
+        vod = self.create(self.alice, minutes_ago=10, priority=Download.Priority.LOW)
+        clip = self.create(self.alice, minutes_ago=1, priority=Download.Priority.HIGH)
+
+        self.assertEqual(scheduler.dispatch(), [clip.id])
+        self.assertEqual(Download.objects.get(pk=vod.id).status, Download.Status.QUEUED)
+
+    def test_cancelled_download_is_skipped(self):
+        download = self.create(self.alice)
+        queued = scheduler.load_entries(Download.Status.QUEUED)
+        # Cancelled between reading the queue and starting it
+        Download.objects.filter(pk=download.pk).update(status=Download.Status.TERMINATED)
+
+        with patch.object(scheduler, 'load_entries', side_effect=[[], queued]):
+            self.assertEqual(scheduler.dispatch(), [])
+        self.mocked_worker.apply_async.assert_not_called()
+
+    def test_dispatch_while_locked_runs_again(self):
+        self.create(self.alice)
+        self.redis.lock(scheduler.LOCK_KEY).acquire()
+        self.assertEqual(scheduler.dispatch(), [])
+        self.assertTrue(self.redis.get(scheduler.RERUN_KEY))
+        self.mocked_worker.apply_async.assert_not_called()
+
+    def test_dispatch_asked_for_while_running_runs_again(self):
+        first = self.create(self.alice, minutes_ago=2)
+        second = self.create(self.bob, minutes_ago=1)
+
+        def load_entries(status):
+            if status == Download.Status.QUEUED and not self.redis.get('seen'):
+                # Another process asks while this dispatch holds the lock
+                self.redis.set('seen', 1)
+                self.assertEqual(scheduler.dispatch(), [])
+                return [entry for entry in original(status) if entry.id == first.id]
+            return original(status)
+        original = scheduler.load_entries
+
+        with patch.object(scheduler, 'load_entries', side_effect=load_entries):
+            self.assertEqual(scheduler.dispatch(), [first.id, second.id])
+        self.assertNotIn(scheduler.LOCK_KEY, self.redis.store)
+
+    def test_redis_unavailable(self):
+        queued = self.create(self.alice)
+        self.redis.lock = MagicMock(side_effect=None)
+        self.redis.lock.return_value.acquire.side_effect = redis.ConnectionError('refused')
+
+        with self.assertLogs('__name__', 'WARNING'):
+            self.assertEqual(scheduler.dispatch(), [queued.id])
+
+
+@override_settings(CELERY_TASK_TIME_LIMIT=1800, DOWNLOAD_SLOT_MAX_AGE=7200)
+class RecoverStaleTest(SchedulerTestCase):
+    def task_states(self, states):
+        return patch.object(scheduler, 'AsyncResult',
+                            side_effect=lambda task_id: MagicMock(state=states[task_id]))
+
+    def test_killed_tasks_free_their_slots(self):
+        killed = self.create(self.alice, minutes_ago=40, status=Download.Status.STARTED,
+                             active_task_id='killed')
+        attached = self.create(self.carol, minutes_ago=35, status=Download.Status.STARTED,
+                               attached_to=killed, active_task_id='killed')
+        retrying = self.create(self.bob, minutes_ago=40, status=Download.Status.STARTED,
+                               active_task_id='retrying')
+        queued = self.create(self.carol)
+
+        with self.task_states({'killed': 'FAILURE', 'retrying': 'RETRY'}), \
+                patch.object(scheduler, 'publish_progress') as mocked_publish, \
+                self.assertLogs('__name__', 'WARNING'):
+            self.assertEqual(scheduler.recover_stale(self.now), [killed.id])
+        mocked_publish.assert_called_once_with('killed', 'DONE', {'status': Download.Status.FAILED})
+
+        for download in (killed, attached, retrying):
+            download.refresh_from_db()
+        self.assertEqual((killed.status, attached.status),
+                         (Download.Status.FAILED, Download.Status.FAILED))
+        self.assertIsNotNone(killed.finished_at)
+        self.assertEqual(retrying.status, Download.Status.STARTED)
+        self.assertEqual(scheduler.dispatch(), [queued.id])
+
+    def test_recent_downloads_are_not_checked(self):
+        self.create(self.alice, minutes_ago=10, status=Download.Status.STARTED,
+                    active_task_id='running')
+        with patch.object(scheduler, 'AsyncResult') as mocked_result:
+            self.assertEqual(scheduler.recover_stale(self.now), [])
+        mocked_result.assert_not_called()
+
+    def test_too_old_without_a_task_state(self):
+        lost = self.create(self.alice, minutes_ago=180, status=Download.Status.STARTED,
+                           active_task_id='lost')
+        unknown = self.create(self.bob, minutes_ago=60, status=Download.Status.STARTED,
+                              active_task_id='unknown')
+
+        with self.task_states({'lost': 'STARTED', 'unknown': 'PENDING'}), \
+                self.assertLogs('__name__', 'WARNING'):
+            self.assertEqual(scheduler.recover_stale(self.now), [lost.id])
+        unknown.refresh_from_db()
+        self.assertEqual(unknown.status, Download.Status.STARTED)
+
+
+class QueueEstimatesTest(SchedulerTestCase):
+    def test_positions_and_start_times(self):
+        self.create(self.alice, minutes_ago=4, status=Download.Status.STARTED)
+        self.create(self.bob, minutes_ago=8, status=Download.Status.STARTED)
+        alice = self.create(self.alice, minutes_ago=20)
+        bob = self.create(self.bob, minutes_ago=10)
+
+        estimates = scheduler.queue_estimates(now=self.now)
+
+        # Bob's running download finishes first, the 10 minute default run
+        # time leaves 2 and 6 minutes
+        self.assertEqual(estimates[bob.id], (1, self.now + timedelta(minutes=2)))
+        self.assertEqual(estimates[alice.id], (2, self.now + timedelta(minutes=6)))
+
+    def test_estimates_learn_from_history(self):
+        finished = self.create(self.carol, minutes_ago=60, status=Download.Status.STARTED,
+                               duration=3600)
+        Download.objects.filter(pk=finished.pk).update(
+            status=Download.Status.COMPLETED, finished_at=self.now - timedelta(minutes=30))
+        self.create(self.alice, status=Download.Status.STARTED, duration=1200)
+        self.create(self.bob, status=Download.Status.STARTED)
+        queued = self.create(self.carol)
+
+        estimates = scheduler.queue_estimates(now=self.now)
+
+        # Half a second of running per second of video, the 20 minute video
+        # frees its slot after 10 minutes
+        self.assertEqual(estimates[queued.id], (1, self.now + timedelta(minutes=10)))
+
+    def test_no_queue(self):
+        self.create(self.alice, status=Download.Status.STARTED)
+        with self.assertNumQueries(1):
+            self.assertEqual(scheduler.queue_estimates(), {})
+
+
+class SchedulerViewTest(SchedulerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.alice)
+
+    def test_progress_shows_queue_position(self):
+        self.create(self.alice, minutes_ago=3, status=Download.Status.STARTED)
+        self.create(self.bob, minutes_ago=3, status=Download.Status.STARTED)
+        queued = self.create(self.alice)
+
+        response = self.client.get(reverse('download:progress', kwargs={'pk': queued.id}))
+
+        self.assertContains(response, 'Queued #1, starts around')
+        self.assertContains(response, 'data-download-status="Q"')
+        self.assertContains(response, reverse('download:cancel', kwargs={'pk': queued.id}))
+        # Alice's running download has 7 of its 10 minutes left
+        queue_start = response.context['download'].queue_start
+        self.assertLess(abs(queue_start - (self.now + timedelta(minutes=7))), timedelta(seconds=5))
+
+    def test_home_polls_queued_downloads(self):
+        queued = self.create(self.alice)
+
+        response = self.client.get(reverse('download:home'))
+
+        self.assertEqual(response.context['poll_ids'], str(queued.id))
+        self.assertEqual(response.context['my_downloads'][0].queue_position, 1)
+
+    def test_cancel_queued_download(self):
+        queued = self.create(self.alice)
+
+        with patch('download_ui.apps.download.views.app.control.revoke') as mocked_revoke:
+            self.client.post(reverse('download:cancel', kwargs={'pk': queued.id}))
+
+        mocked_revoke.assert_not_called()
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Download.Status.TERMINATED)
+
+    def test_worker_finishing_starts_the_next_download(self):
+        running = self.create(self.alice, status=Download.Status.STARTED)
+        running.file_format = Format.objects.create(
+            format_code='1080p60', command=self.command,
+            quality=Quality.objects.create(name='1080p60'), extension=Extension.objects.create(name='mkv'))
+        running.save()
+        self.create(self.bob, status=Download.Status.STARTED)
+        queued = self.create(self.carol)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'video.mkv')
+        with open(filename, 'wb') as output:
+            output.write(b'video')
+        task = MockedTask()
+        task.AsyncResult = lambda _id: MagicMock(info={'filename': filename})
+
+        with patch('download_ui.apps.download.tasks.Downloader.get_downloader') as mocked_downloader, \
+                self.settings(DOWNLOAD_DEDUPE=False):
+            mocked_downloader.return_value.format_size.return_value = '5 B'
+            worker_download(self=task, download_id=running.id)
+
+        running.refresh_from_db()
+        self.assertEqual(running.status, Download.Status.COMPLETED)
+        self.assertEqual((running.file_path, running.size), (filename, '5 B'))
+        self.assertIsNotNone(running.finished_at)
+        self.assertEqual(self.started_ids(), [queued.id])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Download.Status.STARTED)
+
+
+class SingleFlightTest(SchedulerTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.file_format = Format.objects.create(
+            format_code='1080p60', command=cls.command,
+            quality=Quality.objects.create(name='1080p60'), extension=Extension.objects.create(name='mkv'))
+
+    def create(self, user, **kwargs):
+        kwargs.setdefault('slug_id', 'v1')
+        kwargs.setdefault('file_format', self.file_format)
+        return super().create(user, **kwargs)
+
+    def test_identical_download_attaches_to_the_running_one(self):
+        running = self.create(self.alice, status=Download.Status.STARTED, active_task_id='task-1')
+        second = self.create(self.bob, status=Download.Status.DRAFT)
+
+        scheduler.enqueue(second)
+
+        second.refresh_from_db()
+        self.assertEqual(second.attached_to, running)
+        self.assertEqual(second.status, Download.Status.STARTED)
+        self.assertEqual(second.active_task_id, 'task-1')
+        self.mocked_worker.apply_async.assert_not_called()
+
+    def test_other_formats_do_not_attach(self):
+        self.create(self.alice, status=Download.Status.STARTED, slug_id='v2')
+        second = self.create(self.bob, status=Download.Status.DRAFT)
+
+        scheduler.enqueue(second)
+
+        second.refresh_from_db()
+        self.assertIsNone(second.attached_to)
+        self.assertEqual(self.started_ids(), [second.id])
+
+    def test_identical_downloads_queued_together_start_once(self):
+        first = self.create(self.alice, minutes_ago=2)
+        second = self.create(self.bob, minutes_ago=1)
+
+        self.assertEqual(scheduler.dispatch(), [first.id])
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(second.attached_to, first)
+        self.assertEqual(second.status, Download.Status.STARTED)
+        self.assertEqual(second.active_task_id, first.active_task_id)
+
+    def test_attached_to_queued_download_starts_with_it(self):
+        self.create(self.carol, status=Download.Status.STARTED, slug_id='v2')
+        blocker = self.create(self.carol, status=Download.Status.STARTED, slug_id='v3')
+        queued = self.create(self.alice)
+        second = self.create(self.bob, status=Download.Status.DRAFT)
+        scheduler.enqueue(second)
+        self.assertEqual(second.status, Download.Status.QUEUED)
+        # Attached downloads don't take a place in the queue
+        self.assertEqual(list(scheduler.queue_estimates()), [queued.id])
+
+        Download.objects.filter(pk=blocker.pk).update(status=Download.Status.COMPLETED)
+        self.assertEqual(scheduler.dispatch(), [queued.id])
+
+        queued.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(second.status, Download.Status.STARTED)
+        self.assertEqual(second.active_task_id, queued.active_task_id)
+
+    def test_worker_completes_attached_downloads(self):
+        running = self.create(self.alice, status=Download.Status.STARTED)
+        attached = self.create(self.bob, status=Download.Status.STARTED, attached_to=running)
+
+        with patch('download_ui.apps.download.tasks.Downloader.get_downloader') as mocked_downloader, \
+                patch('download_ui.apps.download.tasks.os.path.getsize', return_value=2048), \
+                self.settings(DOWNLOAD_DEDUPE=False):
+            mocked_downloader.return_value.format_size.return_value = '2.0 KiB'
+            worker_download(self=MockedTask(), download_id=running.id)
+
+        attached.refresh_from_db()
+        self.assertEqual(attached.status, Download.Status.COMPLETED)
+        self.assertEqual(attached.file_path, 'test_file.txt')
+        self.assertEqual(attached.size, '2.0 KiB')
+        self.assertIsNotNone(attached.finished_at)
+        # Only one download ran
+        self.assertEqual(mocked_downloader.call_count, 1)
+
+    def test_archiving_one_keeps_the_shared_file(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+        first = self.create(self.alice, status=Download.Status.COMPLETED, file_path=path)
+        second = self.create(self.bob, status=Download.Status.COMPLETED, file_path=path,
+                             attached_to=first)
+
+        first.archive_download()
+        first.save()
+        self.assertTrue(os.path.exists(path))
+
+        second.archive_download()
+        second.save()
+        self.assertFalse(os.path.exists(path))
+
+    def test_cancel_attached_download_leaves_the_task_running(self):
+        running = self.create(self.bob, status=Download.Status.STARTED, active_task_id='task-1')
+        attached = self.create(self.alice, status=Download.Status.STARTED, active_task_id='task-1',
+                               attached_to=running)
+        self.client.force_login(self.alice)
+
+        with patch('download_ui.apps.download.views.app.control.revoke') as mocked_revoke:
+            self.client.post(reverse('download:cancel', kwargs={'pk': attached.id}))
+
+        mocked_revoke.assert_not_called()
+        attached.refresh_from_db()
+        self.assertEqual(attached.status, Download.Status.TERMINATED)
+        self.assertIsNone(attached.attached_to)
+        self.assertEqual(Download.objects.get(pk=running.pk).status, Download.Status.STARTED)
+
+    def test_cancel_running_download_hands_over_to_attached(self):
+        running = self.create(self.alice, status=Download.Status.STARTED, active_task_id='task-1')
+        bob = self.create(self.bob, status=Download.Status.STARTED, active_task_id='task-1',
+                          attached_to=running)
+        carol = self.create(self.carol, status=Download.Status.STARTED, active_task_id='task-1',
+                            attached_to=running)
+        self.client.force_login(self.alice)
+
+        with patch('download_ui.apps.download.views.app.control.revoke') as mocked_revoke:
+            self.client.post(reverse('download:cancel', kwargs={'pk': running.id}))
+
+        mocked_revoke.assert_called_once_with('task-1', terminate=True, signal='SIGUSR1')
+        bob.refresh_from_db()
+        carol.refresh_from_db()
+        self.assertEqual(self.started_ids(), [bob.id])
+        self.assertIsNone(bob.attached_to)
+        self.assertNotEqual(bob.active_task_id, 'task-1')
+        self.assertEqual(carol.attached_to, bob)
+        self.assertEqual(carol.active_task_id, bob.active_task_id)
@@ -0,0 +1,108 @@
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+
+from download_ui.apps.download.models import Command, Download, Source, UserProfile
+from download_ui.apps.download.pagination import KeysetPaginator
+from download_ui.apps.download.search import (LikeSearchBackend, SEARCH_TABLE,
+                                              SQLiteFTSSearchBackend, get_search_backend)
+
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='searcher', is_approved=True)
+        cls.command = Command.objects.create(name='YTDL')
+        cls.source = Source.objects.create(name='Youtube')
+        cls.twitch = Source.objects.create(name='Twitch')
+        cls.guitar = cls.create(title='Guitar lesson', channel_name='Music School',
+                                url='https://youtube.com/watch?v=a1b2')
+        cls.mention = cls.create(title='Cooking stream', channel_name='guitar fans',
+                                 url='https://youtube.com/watch?v=c3d4')
+        cls.stream = cls.create(title='Speedrun', channel_name='runner', source=cls.twitch,
+                                url='https://twitch.tv/videos/1234')
+
+    @classmethod
+    def create(cls, source=None, **kwargs):
+        return Download.objects.create(command=cls.command, source=source or cls.source,
+                                       created_by=cls.user, **kwargs)
+
+    def search(self, query, backend=None):
+        backend = backend or SQLiteFTSSearchBackend()
+        return list(backend.search(Download.objects.all(), query))
+
+    def indexed_titles(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT title FROM {SEARCH_TABLE} ORDER BY rowid')
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_default_backend(self):
+        self.assertIsInstance(get_search_backend(), SQLiteFTSSearchBackend)
+
+    def test_ranks_title_matches_first(self):
+        self.assertEqual(self.search('guitar'), [self.guitar, self.mention])
+
+    def test_matches_substrings_in_every_field(self):
+        self.assertEqual(self.search('ooki'), [self.mention])
+        self.assertEqual(self.search('twitch'), [self.stream])
+        self.assertEqual(self.search('c3d4'), [self.mention])
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.search('guitar school'), [self.guitar])
+        self.assertEqual(self.search('guitar runner'), [])
+
+    def test_query_syntax_is_literal(self):
+        self.assertEqual(self.search('"guitar" OR NEAR(x'), [])
+
+    @patch.object(LikeSearchBackend, 'search')
+    def test_short_terms_fall_back_to_like(self, mocked_search):
+        backend = SQLiteFTSSearchBackend()
+        queryset = Download.objects.all()
+        backend.search(queryset, 'guitar go')
+        mocked_search.assert_called_once_with(queryset, 'guitar go')
+
+    def test_like_backend(self):
+        backend = LikeSearchBackend()
+        self.assertEqual(set(self.search('gu', backend)), {self.guitar, self.mention})
+        self.assertEqual(self.search('twitch 12', backend), [self.stream])
+
+    def test_save_updates_index(self):
+        self.guitar.title = 'Piano lesson'
+        self.guitar.save()
+        self.assertEqual(self.search('guitar'), [self.mention])
+        self.assertEqual(self.search('piano'), [self.guitar])
+
+    def test_save_of_other_fields_skips_index(self):
+        with patch.object(SQLiteFTSSearchBackend, 'update') as mocked_update:
+            self.guitar.status = Download.Status.COMPLETED
+            self.guitar.save(update_fields=['status'])
+            mocked_update.assert_not_called()
+
+    def test_delete_removes_from_index(self):
+        self.mention.delete()
+        self.assertEqual(self.search('guitar'), [self.guitar])
+        self.assertEqual(self.indexed_titles(), ['Guitar lesson', 'Speedrun'])
+
+    def test_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        SQLiteFTSSearchBackend().rebuild()
+        self.assertEqual(self.indexed_titles(), ['Guitar lesson', 'Cooking stream', 'Speedrun'])
+
+    def test_paginates_by_rank(self):
+        paginator = KeysetPaginator(SQLiteFTSSearchBackend().search(
+            Download.objects.order_by('-created_at', '-id'), 'guitar'), 1)
+        first = paginator.page()
+        second = paginator.page(first.next_cursor)
+        self.assertEqual(list(first) + list(second), [self.guitar, self.mention])
+        self.assertFalse(second.has_next())
+        self.assertEqual(list(paginator.page(second.previous_cursor)), [self.guitar])
+
+    def test_list_view_search(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('download:list') + '?q=guitar')
+        self.assertEqual(list(response.context['download_list']), [self.guitar, self.mention])
+        response = self.client.get(reverse('download:list') + '?q=guitar&mine')
+        self.assertEqual(list(response.context['download_list']), [self.guitar, self.mention])
@@ -0,0 +1,234 @@
+import asyncio
+import json
+from unittest.mock import MagicMock, patch
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+import redis
+
+from download_ui.apps.download.downloaders.progress import ProgressReporter, publish_progress
+from download_ui.apps.download.models import Command, Download, Source, UserProfile
+from download_ui.apps.download.streams import ProgressStreamApp
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.channels = None
+        self.closed = False
+
+    async def subscribe(self, *channels):
+        self.channels = channels
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        if self.messages:
+            return {'type': 'message', 'data': json.dumps(self.messages.pop(0))}
+        return None
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeAsyncRedis:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def pubsub(self):
+        return self._pubsub
+
+    async def close(self):
+        pass
+
+
+class PublishProgressTest(TestCase):
+    @override_settings(DOWNLOAD_PROGRESS_STREAM=False)
+    @patch("download_ui.apps.download.downloaders.progress.get_client")
+    def test_disabled(self, mocked_client):
+        publish_progress('a1b2', 'PROGRESS', {'percent': '20'})
+        mocked_client.assert_not_called()
+
+    @override_settings(DOWNLOAD_PROGRESS_STREAM=True)
+    @patch("download_ui.apps.download.downloaders.progress.get_client")
+    def test_enabled(self, mocked_client):
+        publish_progress('a1b2', 'PROGRESS', {'percent': '20'})
+        channel, message = mocked_client.return_value.publish.call_args[0]
+        self.assertEqual(channel, 'download-progress:a1b2')
+        self.assertEqual(json.loads(message), {
+            'task_id': 'a1b2', 'state': 'PROGRESS', 'meta': {'percent': '20'}})
+
+    @override_settings(DOWNLOAD_PROGRESS_STREAM=True)
+    @patch("download_ui.apps.download.downloaders.progress.get_client")
+    def test_redis_error_ignored(self, mocked_client):
+        mocked_client.return_value.publish.side_effect = redis.ConnectionError('down')
+        publish_progress('a1b2', 'PROGRESS', {'percent': '20'})
+
+    @patch("download_ui.apps.download.downloaders.progress.publish_progress")
+    def test_reporter_publishes(self, mocked_publish):
+        task = MagicMock()
+        task.request.id = 'a1b2'
+        ProgressReporter(task).finished({'filename': 'my_file.txt'})
+        mocked_publish.assert_called_once_with('a1b2', 'FILENAME', {'filename': 'my_file.txt'})
+
+
+@override_settings(DOWNLOAD_PROGRESS_STREAM=True)
+class ProgressStreamAppTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='streamer', is_approved=True)
+        command = Command.objects.create(name='YTDL')
+        source = Source.objects.create(name='Youtube')
+        for task_id, status in [('a1b2', Download.Status.STARTED),
+                                ('c3d4', Download.Status.STARTED),
+                                ('e5f6', Download.Status.COMPLETED)]:
+            Download.objects.create(
+                command=command,
+                source=source,
+                created_by=cls.user,
+                url='https://youtube.com',
+                title=f'Title {task_id}',
+                active_task_id=task_id,
+                status=status
+            )
+
+    def call(self, query, logged_in=True, inner=None):
+        headers = []
+        if logged_in:
+            self.client.force_login(self.user)
+            session = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={session}'.encode()))
+        scope = {
+            'type': 'http',
+            'path': reverse('download:events'),
+            'query_string': query,
+            'headers': headers,
+        }
+        sent = []
+
+        requests = [{'type': 'http.request'}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # Like a server, wait until the client goes away
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        async_to_sync(ProgressStreamApp(inner))(scope, receive, send)
+        return sent
+
+    def test_other_paths_passed_through(self):
+        inner = MagicMock()
+
+        async def django_app(scope, receive, send):
+            inner(scope['path'])
+
+        async_to_sync(ProgressStreamApp(django_app))(
+            {'type': 'http', 'path': '/download/'}, None, None)
+        inner.assert_called_once_with('/download/')
+
+    def test_anonymous_forbidden(self):
+        sent = self.call(b'ids=1,2', logged_in=False)
+        self.assertEqual(sent[0]['status'], 403)
+
+    def test_nothing_started(self):
+        sent = self.call(b'ids=3')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(sent[1]['body'], b'event: end\ndata: {}\n\n')
+
+    @patch("download_ui.apps.download.streams.async_client")
+    def test_streams_progress_until_done(self, mocked_client):
+        pubsub = FakePubSub([
+            {'task_id': 'a1b2', 'state': 'PROGRESS', 'meta': {'percent': '20', 'percent_str': '19.6%'}},
+            {'task_id': 'c3d4', 'state': 'DONE', 'meta': {'status': 'C'}},
+            {'task_id': 'a1b2', 'state': 'DONE', 'meta': {'status': 'F'}},
+        ])
+        mocked_client.return_value = FakeAsyncRedis(pubsub)
+
+        sent = self.call(b'ids=1,2,3')
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+        self.assertEqual(set(pubsub.channels),
+                         {'download-progress:a1b2', 'download-progress:c3d4'})
+        bodies = [message['body'] for message in sent[1:]]
+        self.assertEqual(bodies, [
+            b'event: progress\ndata: {"id": 1, "state": "PROGRESS", "percent": "20", "percent_str": "19.6%"}\n\n',
+            b'event: done\ndata: {"id": 2, "state": "DONE", "status": "C"}\n\n',
+            b'event: done\ndata: {"id": 1, "state": "DONE", "status": "F"}\n\n',
+            b'event: end\ndata: {}\n\n',
+            b'',
+        ])
+        self.assertTrue(pubsub.closed)
+
+    @patch("download_ui.apps.download.streams.async_client")
+    def test_done_before_subscribing(self, mocked_client):
+        pubsub = FakePubSub([
+            {'task_id': 'c3d4', 'state': 'DONE', 'meta': {'status': 'C'}},
+        ])
+
+        async def subscribe(*channels):
+            pubsub.channels = channels
+            # a1b2 finishes and publishes before the subscription is in place
+            await sync_to_async(Download.objects.filter(active_task_id='a1b2').update)(
+                status=Download.Status.COMPLETED)
+        pubsub.subscribe = subscribe
+        mocked_client.return_value = FakeAsyncRedis(pubsub)
+
+        sent = self.call(b'ids=1,2')
+
+        bodies = [message['body'] for message in sent[1:]]
+        self.assertEqual(bodies, [
+            b'event: done\ndata: {"id": 1, "state": "DONE", "status": "C"}\n\n',
+            b'event: done\ndata: {"id": 2, "state": "DONE", "status": "C"}\n\n',
+            b'event: end\ndata: {}\n\n',
+            b'',
+        ])
+
+
+class ProgressStreamViewsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='streamer', is_approved=True)
+        Download.objects.create(
+            command=Command.objects.create(name='YTDL'),
+            source=Source.objects.create(name='Youtube'),
+            created_by=cls.user,
+            url='https://youtube.com',
+            title='Title Started',
+            active_task_id='a1b2',
+            status=Download.Status.STARTED
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_events_without_asgi(self):
+        response = self.client.get(reverse('download:events'))
+        self.assertEqual(response.status_code, 204)
+
+    @override_settings(DOWNLOAD_PROGRESS_STREAM=True)
+    def test_home_streams(self):
+        response = self.client.get(reverse('download:home'))
+        self.assertTrue(response.context['progress_stream'])
+        self.assertContains(response, 'new EventSource')
+        # A reconnect doesn't give up on the stream
+        self.assertNotContains(response, 'source.onerror = fallBackToPolling')
+        self.assertContains(response, 'source.readyState === EventSource.CLOSED')
+        self.assertContains(response, 'hx-trigger="progress-refresh"')
+        self.assertContains(response, 'hx-trigger="load delay:10s"')
+
+    @override_settings(DOWNLOAD_PROGRESS_STREAM=True)
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_progress_trigger(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            id='a1b2', status='PROGRESS', info={'percent_str': '25.0%', 'percent': 25.0})
+        url = reverse('download:progress', kwargs={'pk': 1})
+        response = self.client.get(url)
+        self.assertEqual(response.context['trigger'], 'progress-refresh, every 30s')
+        response = self.client.get(url + '?poll')
+        self.assertEqual(response.context['trigger'], 'load delay:600ms')
+        self.assertContains(response, f'hx-get="{url}?poll"')
@@ -1,12 +1,17 @@
 import os
+import tempfile
 from unittest.mock import MagicMock, patch
 
-from celery.exceptions import SoftTimeLimitExceeded
+from celery.exceptions import Retry, SoftTimeLimitExceeded
 from django.test import TestCase
 
-from download_ui.apps.download.models import Download, Command, Extension, Format, Quality, Source
-from download_ui.apps.download.tasks import worker_download, check_for_missing_files
-from download_ui.apps.download.exceptions import DownloadError
+from download_ui.apps.download import extraction_cache
+from download_ui.apps.download.models import (Download, Command, Extension, FileContent, Format, Quality,
+                                              Source, UserProfile)
+from download_ui.apps.download.tasks import (worker_download, worker_extract, check_for_missing_files,
+                                             dedupe_download)
+from download_ui.apps.download.library import LibraryFiles, hash_file, link_duplicate
+from download_ui.apps.download.exceptions import DownloadError, ExtractionError
 
 
 class MockedRequest:
@@ -22,6 +27,61 @@ class MockedTask:
         return MagicMock(info={'filename': 'test_file.txt'})
 
 
+class WorkerExtractTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Command.objects.create(name='YTDL')
+
+    @patch("download_ui.apps.download.models.Downloader.get_downloader")
+    def test_task_successful_extraction(self, mocked_downloader):
+        extraction = {
+            'source': 'Youtube',
+            'title': 'Test Title',
+            'slug_id': 'sluggy',
+            'channel_name': 'youtuber man',
+            'format_info': [('mkv', '720p', '54')]
+        }
+        mocked_downloader.return_value = MagicMock(
+            extract=MagicMock(return_value=extraction))
+
+        result = worker_extract(self=MockedTask(), command_id=1,
+                                url='https://youtube.com')
+
+        self.assertEqual(result, extraction)
+        mocked_downloader.assert_called_once_with('YTDL')
+
+    @patch("download_ui.apps.download.models.Downloader.get_downloader")
+    def test_task_failed_extraction(self, mocked_downloader):
+        mocked_downloader.return_value = MagicMock(
+            extract=MagicMock(side_effect=ExtractionError('youtube-dl', 'No video')))
+
+        result = worker_extract(self=MockedTask(), command_id=1,
+                                url='https://youtube.com')
+
+        self.assertEqual(result, {'error': 'No video'})
+        self.assertIsNone(extraction_cache.get_extraction('YTDL', 'https://youtube.com'))
+
+    @patch("download_ui.apps.download.models.Downloader.get_downloader")
+    def test_task_cached_extraction(self, mocked_downloader):
+        extraction = {
+            'source': 'Youtube',
+            'title': 'Test Title',
+            'slug_id': 'sluggy',
+            'channel_name': 'youtuber man',
+            'format_info': [['mkv', '720p', '54']]
+        }
+        mocked_downloader.return_value = MagicMock(
+            extract=MagicMock(return_value=extraction))
+
+        worker_extract(self=MockedTask(), command_id=1,
+                       url='https://www.youtube.com/watch?v=sluggy')
+        result = worker_extract(self=MockedTask(), command_id=1,
+                                url='https://youtu.be/sluggy?t=10')
+
+        self.assertEqual(result, extraction)
+        mocked_downloader.assert_called_once_with('YTDL')
+
+
 class WorkerDownloadTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -29,6 +89,7 @@ class WorkerDownloadTest(TestCase):
         with open(filename, 'w', encoding='utf8') as fp:
             fp.write("New test file created")
 
+        user = UserProfile.objects.create(username='downloader', is_approved=True)
         command1 = Command.objects.create(name='YTDL')
 
         quality1 = Quality.objects.create(name='720p')
@@ -42,6 +103,7 @@ class WorkerDownloadTest(TestCase):
         Download.objects.create(
             command=command1,
             source=source1,
+            created_by=user,
             url='https://youtube.com',
             title='Title Youtube',
             slug_id='youtubeslug',
@@ -61,6 +123,7 @@ class WorkerDownloadTest(TestCase):
         Download.objects.create(
             command=command2,
             source=source2,
+            created_by=user,
             url='https://twitch.com',
             title='Title Twitch',
             slug_id='twitchslug',
@@ -71,6 +134,7 @@ class WorkerDownloadTest(TestCase):
         Download.objects.create(
             command=command2,
             source=source2,
+            created_by=user,
             url='https://twitch.com',
             title='Title File Present',
             slug_id='twitchfile',
@@ -84,20 +148,79 @@ class WorkerDownloadTest(TestCase):
         super(WorkerDownloadTest, cls).tearDownClass()
         os.remove('test_file.txt')
 
+    @patch("download_ui.apps.download.tasks.dedupe_download")
     @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
-    def test_task_successful_youtubedl(self, mocked_downloader):
+    def test_task_successful_youtubedl(self, mocked_downloader, mocked_dedupe):
         mocked_downloader.return_value = MagicMock(
             download=MagicMock(), format_size=MagicMock(return_value='84MB'))
         mocked_task = MockedTask(req_id='test-id-celery-1')
 
         worker_download(self=mocked_task, download_id=1)
 
+        mocked_dedupe.delay.assert_called_once_with(1)
+
         download = Download.objects.get(id=1)
         self.assertEqual(download.active_task_id, 'test-id-celery-1')
         self.assertEqual(download.file_path, 'test_file.txt')
         self.assertEqual(download.size, '84MB')
         self.assertEqual(download.status, Download.Status.COMPLETED)
 
+    @patch("download_ui.apps.download.tasks.dedupe_download")
+    @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
+    def test_task_dedupe_only_completed_downloads(self, mocked_downloader, mocked_dedupe):
+        mocked_downloader.return_value = MagicMock(
+            download=MagicMock(), format_size=MagicMock(return_value='84MB'))
+        with self.settings(DOWNLOAD_DEDUPE=False):
+            worker_download(self=MockedTask(req_id='test-id-celery-1'), download_id=1)
+        self.assertEqual(Download.objects.get(id=1).status, Download.Status.COMPLETED)
+
+        mocked_downloader.return_value.format_size.side_effect = OSError('File not Found')
+        worker_download(self=MockedTask(req_id='test-id-celery-2'), download_id=2)
+        self.assertEqual(Download.objects.get(id=2).status, Download.Status.FAILED)
+
+        mocked_dedupe.delay.assert_not_called()
+
+    @patch("download_ui.apps.download.tasks.dedupe_download")
+    @patch("download_ui.apps.download.tasks.BandwidthLimiter")
+    @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
+    def test_task_downloads_under_the_limiter(self, mocked_downloader, mocked_limiter,
+                                              mocked_dedupe):
+        limiter = mocked_limiter.return_value
+        mocked_downloader.return_value = MagicMock(
+            download=MagicMock(side_effect=lambda *args: limiter.__enter__.assert_called_once()),
+            format_size=MagicMock(return_value='84MB'))
+        download = Download.objects.get(id=2)
+        download.max_workers = 4
+        download.save()
+        mocked_task = MockedTask(req_id='test-id-celery-2')
+
+        worker_download(self=mocked_task, download_id=2)
+
+        mocked_limiter.assert_called_once_with('Twitch', 2)
+        mocked_downloader.assert_called_once_with('TWDL', task=mocked_task, code='54',
+                                                  max_workers=4, limiter=limiter)
+        mocked_downloader.return_value.download.assert_called_once_with(
+            'https://twitch.com', '54', 2)
+        limiter.__exit__.assert_called_once()
+
+    @patch("download_ui.apps.download.tasks.scheduler.dispatch")
+    @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
+    def test_task_failure_hands_the_slot_on(self, mocked_downloader, mocked_dispatch):
+        mocked_downloader.return_value = MagicMock(
+            download=MagicMock(side_effect=DownloadError('twitch-dl', 'Download failed to work')))
+        leader = Download.objects.get(id=2)
+        follower = Download.objects.create(
+            command=leader.command, source=leader.source, created_by=leader.created_by,
+            url=leader.url, title='Title Attached', slug_id='twitchslug',
+            file_format=leader.file_format, attached_to=leader, status=Download.Status.STARTED)
+
+        worker_download(self=MockedTask(req_id='test-id-celery-2'), download_id=2)
+
+        mocked_dispatch.assert_called_once_with()
+        follower.refresh_from_db()
+        self.assertEqual(follower.status, Download.Status.FAILED)
+        self.assertIsNotNone(follower.finished_at)
+
     @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
     def test_task_twitchdl_file_failure(self, mocked_downloader):
         mocked_downloader.return_value = MagicMock(
@@ -140,6 +263,67 @@ class WorkerDownloadTest(TestCase):
         self.assertEqual(download.size, 'N/A')
         self.assertEqual(download.status, Download.Status.TERMINATED)
 
+    @patch("download_ui.apps.download.tasks.scheduler.dispatch")
+    @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
+    def test_task_transient_failure_retries(self, mocked_downloader, mocked_dispatch):
+        mocked_downloader.return_value = MagicMock(
+            download=MagicMock(side_effect=DownloadError('twitch-dl', 'Reset', transient=True)))
+        mocked_task = MockedTask(req_id='test-id-celery-2')
+        mocked_task.request.retries = 2
+        mocked_task.retry = MagicMock(return_value=Retry())
+
+        with self.assertRaises(Retry):
+            worker_download(self=mocked_task, download_id=2)
+
+        _, kwargs = mocked_task.retry.call_args
+        self.assertEqual(kwargs['countdown'], 120)
+        self.assertEqual(kwargs['exc'].message, 'Reset')
+        self.assertEqual(kwargs['max_retries'], 5)
+        mocked_dispatch.assert_not_called()
+        download = Download.objects.get(id=2)
+        self.assertEqual(download.active_task_id, 'test-id-celery-2')
+        self.assertEqual(download.status, Download.Status.STARTED)
+
+    @patch("download_ui.apps.download.tasks.scheduler.dispatch")
+    @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
+    def test_task_transient_failure_last_retry(self, mocked_downloader, mocked_dispatch):
+        # Past Celery's default of 3 retries
+        mocked_downloader.return_value = MagicMock(
+            download=MagicMock(side_effect=DownloadError('twitch-dl', 'Reset', transient=True)))
+        mocked_task = MockedTask(req_id='test-id-celery-2')
+        mocked_task.request.retries = 4
+        mocked_task.retry = MagicMock(return_value=Retry())
+
+        with self.assertRaises(Retry):
+            worker_download(self=mocked_task, download_id=2)
+
+        _, kwargs = mocked_task.retry.call_args
+        self.assertEqual(kwargs['max_retries'], 5)
+        self.assertEqual(kwargs['countdown'], 480)
+        mocked_dispatch.assert_not_called()
+        self.assertEqual(Download.objects.get(id=2).status, Download.Status.STARTED)
+
+    @patch("download_ui.apps.download.tasks.publish_progress")
+    @patch("download_ui.apps.download.tasks.scheduler.dispatch")
+    @patch("download_ui.apps.download.tasks.Downloader.get_downloader")
+    def test_task_transient_failure_out_of_retries(self, mocked_downloader, mocked_dispatch,
+                                                   mocked_publish):
+        mocked_downloader.return_value = MagicMock(
+            download=MagicMock(side_effect=DownloadError('twitch-dl', 'Reset', transient=True)))
+        mocked_task = MockedTask(req_id='test-id-celery-2')
+        mocked_task.request.retries = 5
+        mocked_task.retry = MagicMock()
+
+        worker_download(self=mocked_task, download_id=2)
+
+        mocked_task.retry.assert_not_called()
+        download = Download.objects.get(id=2)
+        self.assertEqual(download.status, Download.Status.FAILED)
+        self.assertIsNotNone(download.finished_at)
+        mocked_publish.assert_called_once_with('test-id-celery-2', 'DONE',
+                                               {'status': Download.Status.FAILED})
+        mocked_dispatch.assert_called_once_with()
+
     def test_task_periodic_missing_files_check(self):
         download = Download.objects.get(id=3)
         self.assertEqual(download.status, Download.Status.COMPLETED)
@@ -152,3 +336,199 @@ class WorkerDownloadTest(TestCase):
         self.assertEqual(download.status, Download.Status.MISSING)
         with open('test_file.txt', 'w', encoding='utf8') as fp:
             fp.write("New test file created")
+
+
+class MissingFilesCheckTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='checker', is_approved=True)
+        cls.command = Command.objects.create(name='YTDL')
+        cls.source = Source.objects.create(name='Youtube')
+
+    def setUp(self):
+        self.library = tempfile.TemporaryDirectory()
+        self.addCleanup(self.library.cleanup)
+        os.makedirs(os.path.join(self.library.name, 'channel'))
+
+    def create(self, file_path, present, status=Download.Status.COMPLETED):
+        if present:
+            with open(file_path, 'w', encoding='utf8') as fp:
+                fp.write('video')
+        return Download.objects.create(command=self.command, source=self.source,
+                                       created_by=self.user, url='https://youtube.com',
+                                       title=file_path, file_path=file_path, status=status)
+
+    def library_path(self, *parts):
+        return os.path.join(self.library.name, *parts)
+
+    def test_marks_only_missing_files(self):
+        present = self.create(self.library_path('channel', 'present.mp4'), present=True)
+        gone = self.create(self.library_path('channel', 'gone.mp4'), present=False)
+        failed = self.create(self.library_path('failed.mp4'), present=False,
+                             status=Download.Status.FAILED)
+
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library.name + '/'):
+            stats = check_for_missing_files()
+
+        self.assertEqual(stats['checked'], 2)
+        self.assertEqual(stats['missing'], 1)
+        present.refresh_from_db()
+        gone.refresh_from_db()
+        failed.refresh_from_db()
+        self.assertEqual(present.status, Download.Status.COMPLETED)
+        self.assertEqual(gone.status, Download.Status.MISSING)
+        self.assertEqual(failed.status, Download.Status.FAILED)
+
+    @patch("download_ui.apps.download.library.os.path.exists", wraps=os.path.exists)
+    def test_library_files_come_from_one_scan(self, mocked_exists):
+        for num in range(5):
+            self.create(self.library_path('channel', f'{num}.mp4'), present=num % 2 == 0)
+
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library.name):
+            stats = check_for_missing_files()
+
+        # Only the misses are looked at again
+        self.assertEqual(sorted(call.args[0] for call in mocked_exists.call_args_list),
+                         [self.library_path('channel', '1.mp4'),
+                          self.library_path('channel', '3.mp4')])
+        self.assertEqual(stats['missing'], 2)
+
+    def test_downloads_completed_after_the_scan_are_not_missing(self):
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library.name):
+            library = LibraryFiles(self.library.name)
+            # Finishes while the check runs
+            finished = self.create(self.library_path('channel', 'new.mp4'), present=True)
+            with patch('download_ui.apps.download.tasks.LibraryFiles', return_value=library):
+                stats = check_for_missing_files()
+
+        finished.refresh_from_db()
+        self.assertEqual(finished.status, Download.Status.COMPLETED)
+        self.assertEqual(stats['missing'], 0)
+
+    @patch("download_ui.apps.download.tasks.MISSING_FILES_CHUNK_SIZE", 2)
+    def test_writes_once_per_chunk_with_changes(self):
+        for num in range(5):
+            self.create(self.library_path(f'{num}.mp4'), present=num == 4)
+
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library.name):
+            # Three chunk reads, the last one empty, and two chunks with
+            # changes written in one statement each
+            with self.assertNumQueries(6):
+                stats = check_for_missing_files()
+
+        self.assertEqual(stats['checked'], 5)
+        self.assertEqual(stats['missing'], 4)
+
+    def test_unreadable_library_falls_back_to_exists(self):
+        other = tempfile.TemporaryDirectory()
+        self.addCleanup(other.cleanup)
+        outside = self.create(os.path.join(other.name, 'outside.mp4'), present=True)
+
+        with self.settings(FILE_PATH_FIELD_DIRECTORY=self.library_path('not-mounted')):
+            stats = check_for_missing_files()
+
+        outside.refresh_from_db()
+        self.assertEqual(outside.status, Download.Status.COMPLETED)
+        self.assertEqual(stats['missing'], 0)
+
+
+class DedupeDownloadTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='deduper', is_approved=True)
+        cls.command = Command.objects.create(name='YTDL')
+        cls.source = Source.objects.create(name='Youtube')
+
+    def setUp(self):
+        self.library = tempfile.TemporaryDirectory()
+        self.addCleanup(self.library.cleanup)
+
+    def create(self, name, content=b'video'):
+        file_path = os.path.join(self.library.name, name)
+        with open(file_path, 'wb') as fp:
+            fp.write(content)
+        return Download.objects.create(command=self.command, source=self.source,
+                                       created_by=self.user, url='https://youtube.com',
+                                       title=name, file_path=file_path,
+                                       status=Download.Status.COMPLETED)
+
+    def dedupe(self, download):
+        result = dedupe_download(self=MockedTask(), download_id=download.id)
+        download.refresh_from_db()
+        return result
+
+    def test_identical_files_are_hardlinked(self):
+        first = self.create('first.mp4')
+        second = self.create('second.mp4')
+        other = self.create('other.mp4', content=b'another video')
+
+        self.assertFalse(self.dedupe(first)['linked'])
+        self.assertTrue(self.dedupe(second)['linked'])
+        self.assertFalse(self.dedupe(other)['linked'])
+
+        self.assertTrue(os.path.samefile(first.file_path, second.file_path))
+        self.assertFalse(os.path.samefile(first.file_path, other.file_path))
+        self.assertEqual(os.stat(first.file_path).st_nlink, 2)
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertNotEqual(first.content_hash, other.content_hash)
+        content = FileContent.objects.get(sha256=first.content_hash)
+        self.assertEqual(content.file_path, first.file_path)
+        self.assertEqual(content.size, 5)
+        self.assertEqual(FileContent.objects.count(), 2)
+        # Linking again is a no-op
+        self.assertFalse(self.dedupe(second)['linked'])
+
+    @patch('download_ui.apps.download.library.uuid.uuid4')
+    def test_taken_temporary_name_is_skipped(self, mocked_uuid):
+        mocked_uuid.side_effect = [MagicMock(hex='taken'), MagicMock(hex='free')]
+        first = self.create('first.mp4')
+        second = self.create('second.mp4')
+        taken = os.path.join(self.library.name, '.dedupe-taken')
+        with open(taken, 'wb') as fp:
+            fp.write(b'someone else')
+
+        self.assertTrue(link_duplicate(first.file_path, second.file_path))
+
+        self.assertTrue(os.path.samefile(first.file_path, second.file_path))
+        with open(taken, 'rb') as fp:
+            self.assertEqual(fp.read(), b'someone else')
+        self.assertFalse(os.path.exists(os.path.join(self.library.name, '.dedupe-free')))
+
+    def test_hash_is_streamed(self):
+        download = self.create('video.mp4', content=b'0123456789')
+        self.assertEqual(hash_file(download.file_path, chunk_size=3),
+                         '84d89877f0d4041efb6bf91a16f0248f2fd573e6af05c19f96bedb9f882f7882')
+
+    def test_canonical_copy_gone(self):
+        first = self.create('first.mp4')
+        self.dedupe(first)
+        os.remove(first.file_path)
+        second = self.create('second.mp4')
+
+        self.assertFalse(self.dedupe(second)['linked'])
+        self.assertEqual(FileContent.objects.get().file_path, second.file_path)
+
+    def test_archive_keeps_shared_content(self):
+        first = self.create('first.mp4')
+        second = self.create('second.mp4')
+        self.dedupe(first)
+        self.dedupe(second)
+
+        first.archive_download()
+        first.save()
+
+        self.assertFalse(os.path.exists(first.file_path))
+        with open(second.file_path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'video')
+        self.assertEqual(FileContent.objects.get().file_path, second.file_path)
+
+        second.cancel_download()
+        second.save()
+        self.assertFalse(FileContent.objects.exists())
+
+    def test_skips_downloads_that_are_not_completed(self):
+        download = self.create('video.mp4')
+        download.status = Download.Status.FAILED
+        download.save()
+        self.assertIsNone(self.dedupe(download))
+        self.assertEqual(download.content_hash, '')
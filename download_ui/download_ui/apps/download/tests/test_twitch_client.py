@@ -0,0 +1,181 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from download_ui.apps.download.downloaders import http_pool, twitch_client
+from download_ui.apps.download.downloaders.http_pool import HTTPPool
+from download_ui.apps.download.downloaders.twitch import TwitchDownloader
+from download_ui.apps.download.downloaders.twitch_client import TwitchError, get_client
+from download_ui.apps.download.exceptions import ExtractionError
+
+VIDEOS = {
+    '1001': {'id': '1001', 'title': 'Marathon', 'lengthSeconds': 3600,
+             'creator': {'login': 'streamer', 'displayName': 'Streamer'}},
+    '1002': {'id': '1002', 'title': 'Rerun', 'lengthSeconds': 60,
+             'creator': {'login': 'streamer', 'displayName': 'Streamer'}},
+}
+
+CLIPS = {
+    'FunnyClip': {'id': '77', 'slug': 'FunnyClip', 'title': 'Oops', 'durationSeconds': 30,
+                  'broadcaster': {'login': 'streamer', 'displayName': 'Streamer'},
+                  'videoQualities': [{'quality': '1080', 'frameRate': 60,
+                                      'sourceURL': 'https://clips.example/77.mp4'}]},
+}
+
+MASTER_PLAYLIST = '\n'.join([
+    '#EXTM3U',
+    '#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="chunked",NAME="1080p60",AUTOSELECT=YES,DEFAULT=YES',
+    '#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080,VIDEO="chunked"',
+    'https://vod.example/chunked/index-dvr.m3u8',
+    '#EXT-X-MEDIA:TYPE=VIDEO,GROUP-ID="720p30",NAME="720p",AUTOSELECT=YES,DEFAULT=YES',
+    '#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1280x720,VIDEO="720p30"',
+    'https://vod.example/720p30/index-dvr.m3u8',
+])
+
+LOOKUP = re.compile(r'(?P<alias>\w+): (?P<field>\w+)\(\w+: "(?P<key>[^"]+)"')
+
+
+class GraphQLHandler(BaseHTTPRequestHandler):
+    """Stands in for Twitch's GraphQL endpoint and usher, answering the
+    aliased video, clip and access token lookups."""
+    protocol_version = 'HTTP/1.1'
+    queries = []
+    connections = []
+    fail = False
+
+    def reply(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.connections.append(self.client_address)
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+        self.queries.append(query)
+        if self.fail:
+            content = {'errors': [{'message': 'service unavailable'}]}
+        else:
+            data = {}
+            for match in LOOKUP.finditer(query):
+                if match['field'] == 'video':
+                    data[match['alias']] = VIDEOS.get(match['key'])
+                elif match['field'] == 'clip':
+                    data[match['alias']] = CLIPS.get(match['key'])
+                else:
+                    data[match['alias']] = {'signature': 'sig', 'value': f'token-{match["key"]}'}
+            content = {'data': data}
+        self.reply(200, json.dumps(content).encode())
+
+    def do_GET(self):
+        self.connections.append(self.client_address)
+        if 'nauth=token-' not in self.path:
+            self.reply(403, b'[]')
+        else:
+            self.reply(200, MASTER_PLAYLIST.encode(), 'application/vnd.apple.mpegurl')
+
+    def log_message(self, *args):
+        pass
+
+
+class TwitchClientTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), GraphQLHandler)
+        thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        thread.start()
+        cls.addClassCleanup(thread.join)
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+
+    def setUp(self):
+        GraphQLHandler.queries = []
+        GraphQLHandler.connections = []
+        GraphQLHandler.fail = False
+        host, port = self.server.server_address
+        settings = self.settings(TWITCH_GQL_URL=f'http://{host}:{port}/gql',
+                                 TWITCH_USHER_URL=f'http://{host}:{port}/vod')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # Every test starts with a client of its own, without pooled connections
+        patcher = patch.object(twitch_client, '_local', threading.local())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = HTTPPool(hosts=4, per_host=4, idle_seconds=60)
+        patcher = patch.object(http_pool, '_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Lets the server's keep-alive handler finish before it closes
+        self.addCleanup(self.pool.clear)
+
+    def test_lookups_share_one_request(self):
+        urls = ['https://www.twitch.tv/videos/1001', 'https://clips.twitch.tv/FunnyClip',
+                '1002', 'https://www.twitch.tv/videos/404']
+
+        results = get_client().lookup(urls)
+
+        self.assertEqual(len(GraphQLHandler.queries), 1)
+        self.assertEqual(results[urls[0]]['title'], 'Marathon')
+        self.assertEqual(results[urls[0]]['accessToken'], {'signature': 'sig',
+                                                            'value': 'token-1001'})
+        self.assertEqual(results[urls[1]]['slug'], 'FunnyClip')
+        self.assertEqual(results['1002']['title'], 'Rerun')
+        self.assertIsNone(results[urls[3]])
+
+    def test_large_lookups_are_split(self):
+        with patch.object(twitch_client, 'BATCH_SIZE', 2):
+            results = get_client().lookup(['1001', '1002', 'FunnyClip'])
+
+        self.assertEqual(len(GraphQLHandler.queries), 2)
+        self.assertEqual(set(results), {'1001', '1002', 'FunnyClip'})
+
+    def test_invalid_identifier(self):
+        with self.assertRaises(TwitchError):
+            get_client().lookup(['https://www.twitch.tv/streamer/schedule'])
+        self.assertEqual(GraphQLHandler.queries, [])
+
+    def test_extract_video_reuses_the_connection(self):
+        downloader = TwitchDownloader()
+        first = downloader.extract('https://www.twitch.tv/videos/1001')
+        second = downloader.extract('https://www.twitch.tv/videos/1002')
+
+        self.assertEqual(first, {
+            'channel_name': 'Streamer', 'title': 'Marathon', 'slug_id': '1001',
+            'source': 'Twitch', 'duration': 3600,
+            'format_info': [('mkv', 'chunked', 'chunked'), ('mkv', '720p30', '720p30')]})
+        self.assertEqual(second['title'], 'Rerun')
+        # A lookup and a playlist per video, all over one keep-alive connection
+        self.assertEqual(len(GraphQLHandler.connections), 4)
+        self.assertEqual(len(set(GraphQLHandler.connections)), 1)
+
+    def test_extract_clip(self):
+        result = TwitchDownloader().extract('https://www.twitch.tv/streamer/clip/FunnyClip')
+
+        self.assertEqual(result['slug_id'], 'FunnyClip')
+        self.assertEqual(result['format_info'], [('mp4', '1080', '1080')])
+        # Clips carry their qualities, usher is not asked
+        self.assertEqual(len(GraphQLHandler.connections), 1)
+
+    def test_extract_not_found(self):
+        with self.assertRaisesRegex(ExtractionError, 'Download Information not found'):
+            TwitchDownloader().extract('https://www.twitch.tv/videos/404')
+
+    def test_extract_query_failure(self):
+        GraphQLHandler.fail = True
+        with self.assertRaisesRegex(ExtractionError, 'GraphQL query failed'):
+            TwitchDownloader().extract('https://www.twitch.tv/videos/1001')
+
+    def test_one_client_per_thread(self):
+        clients = []
+        thread = threading.Thread(target=lambda: clients.append(get_client()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(get_client(), get_client())
+        self.assertIsNot(clients[0], get_client())
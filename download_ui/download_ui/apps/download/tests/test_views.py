@@ -2,11 +2,15 @@ from datetime import timedelta
 import os
 from unittest.mock import MagicMock, patch
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from download_ui.apps.download.models import Command, Extension, Quality, Source, Download, Format
+from download_ui.apps.download import extraction_cache
+from download_ui.apps.download.models import (Command, Extension, Quality, Source, Download, Format,
+                                              UserProfile)
 
 
 class DownloadHomeViewTest(TestCase):
@@ -72,6 +76,7 @@ class DownloadHomeViewTest(TestCase):
 class DownloadCreateViewTest(TestCase):
     @classmethod
     def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='creator', is_approved=True)
         command1 = Command.objects.create(name='YTDL')
         Command.objects.create(name='TWDL')
 
@@ -80,6 +85,7 @@ class DownloadCreateViewTest(TestCase):
         Download.objects.create(
             command=command1,
             source=source,
+            created_by=cls.user,
             url='URL',
             title='Title Original',
             status=Download.Status.STARTED
@@ -88,6 +94,7 @@ class DownloadCreateViewTest(TestCase):
         Download.objects.create(
             command=command1,
             source=source,
+            created_by=cls.user,
             url='https://youtube.com',
             title='Title Current',
             slug_id='currentslug',
@@ -100,6 +107,7 @@ class DownloadCreateViewTest(TestCase):
         Download.objects.create(
             command=command1,
             source=source,
+            created_by=cls.user,
             url='https://youtube.com',
             title='Title Current',
             slug_id='currentslug',
@@ -107,6 +115,13 @@ class DownloadCreateViewTest(TestCase):
             status=Download.Status.COMPLETED
         )
 
+    def setUp(self):
+        self.client.force_login(self.user)
+        # The extraction the tests poll was started by this session
+        session = self.client.session
+        session['extraction_tasks'] = ['a1b2']
+        session.save()
+
     def test_view_url_exists_at_desired_location(self):
         response = self.client.get('/download/create/')
         self.assertEqual(response.status_code, 200)
@@ -128,23 +143,115 @@ class DownloadCreateViewTest(TestCase):
         self.assertEqual(response.context['trigger'], 'load delay:600ms')
         self.assertEqual(response.context['task_info'], default_task_info)
 
-    @patch("download_ui.apps.download.models.Downloader.get_downloader")
-    def test_view_successful_post(self, mocked_downloader):
-        mocked_extract = MagicMock()
-        mocked_extract.return_value = {
+    @patch("download_ui.apps.download.views.worker_extract")
+    def test_view_post_starts_extraction(self, mocked_worker):
+        mocked_worker.delay.return_value = MagicMock(id='a1b2')
+        test_url = 'https://google.com'
+        test_command = 1
+        response = self.client.post(reverse('download:create'), {
+                                    'command': test_command, 'url': test_url})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'partials/download_extracting.html')
+        self.assertEqual(response.context['task_id'], 'a1b2')
+        self.assertEqual(response.context['trigger'], 'load delay:600ms')
+        mocked_worker.delay.assert_called_once_with(test_command, test_url)
+        self.assertEqual(Download.objects.count(), 3)
+
+    @patch("download_ui.apps.download.views.worker_extract")
+    def test_view_post_cached_extraction(self, mocked_worker):
+        extraction_cache.set_extraction('YTDL', 'https://youtu.be/sluggy', {
             'source': 'Youtube',
             'title': 'Test Title',
             'slug_id': 'sluggy',
             'channel_name': 'youtuber man',
-            'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
-        }
-        mocked_downloader.return_value = MagicMock(extract=mocked_extract)
-        test_url = 'https://google.com'
+            'format_info': [['mkv', '720p', '54'], ['mp4', '360p', '36']]
+        })
+        test_url = 'https://www.youtube.com/watch?v=sluggy'
         test_command = 1
         response = self.client.post(reverse('download:create'), {
                                     'command': test_command, 'url': test_url})
         self.assertRedirects(response, reverse(
             'download:update', kwargs={'pk': 4}))
+        mocked_worker.delay.assert_not_called()
+        download = Download.objects.get(id=4)
+        self.assertEqual(download.slug_id, 'sluggy')
+        self.assertEqual(download.choices_for.count(), 2)
+
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_post_extraction_pending(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=False))
+        test_url = 'https://google.com'
+        test_command = 1
+        response = self.client.post(reverse('download:create'), {
+                                    'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'partials/download_extracting.html')
+        self.assertEqual(response.context['task_id'], 'a1b2')
+        self.assertEqual(Download.objects.count(), 3)
+
+    @patch("download_ui.apps.download.views.worker_extract")
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_post_other_sessions_task(self, mocked_async_result, mocked_worker):
+        mocked_worker.delay.return_value = MagicMock(id='c3d4')
+        response = self.client.post(reverse('download:create'), {
+                                    'command': 1, 'url': 'https://google.com', 'task_id': 'e5f6'})
+        self.assertTemplateUsed(response, 'partials/download_extracting.html')
+        self.assertEqual(response.context['task_id'], 'c3d4')
+        mocked_async_result.assert_not_called()
+        self.assertEqual(self.client.session['extraction_tasks'], ['a1b2', 'c3d4'])
+
+    @patch("download_ui.apps.download.views.worker_extract")
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_post_task_result_not_an_extraction(self, mocked_async_result, mocked_worker):
+        mocked_worker.delay.return_value = MagicMock(id='c3d4')
+        for result in ({'user_id': 1, 'results': []}, ['sluggy'], {'title': 'Test Title'}):
+            mocked_async_result.return_value = MagicMock(
+                ready=MagicMock(return_value=True),
+                successful=MagicMock(return_value=True),
+                result=result)
+            self.setUp()
+            response = self.client.post(reverse('download:create'), {
+                                        'command': 1, 'url': 'https://google.com',
+                                        'task_id': 'a1b2'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['task_id'], 'c3d4')
+        self.assertEqual(mocked_worker.delay.call_count, 3)
+        self.assertEqual(Download.objects.count(), 3)
+
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_post_extraction_failed(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={'error': 'Unsupported URL: https://google.com'})
+        test_url = 'https://google.com'
+        test_command = 1
+        response = self.client.post(reverse('download:create'), {
+                                    'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'partials/download_form.html')
+        self.assertFormError(response, 'form', None, [
+                             'Download failure: Unsupported URL: https://google.com'])
+
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_successful_post(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Test Title',
+                'slug_id': 'sluggy',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
+            })
+        test_url = 'https://google.com'
+        test_command = 1
+        response = self.client.post(reverse('download:create'), {
+                                    'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
+        self.assertRedirects(response, reverse(
+            'download:update', kwargs={'pk': 4}))
         download = Download.objects.get(id=4)
         self.assertEqual(download.url, test_url)
         self.assertEqual(download.command.id, test_command)
@@ -154,39 +261,66 @@ class DownloadCreateViewTest(TestCase):
         self.assertEqual(download.slug_id, 'sluggy')
         self.assertEqual(download.channel_name, 'youtuber man')
 
-    @patch("download_ui.apps.download.models.Downloader.get_downloader")
-    def test_view_invalid_post(self, mocked_downloader):
-        mocked_extract = MagicMock()
-        mocked_extract.return_value = {
-            'source': 'Youtube',
-            'title': 'Test Title',
-            'slug_id': 'sluggy',
-            'channel_name': 'youtuber man',
-            'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
-        }
-        mocked_downloader.return_value = MagicMock(extract=mocked_extract)
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_successful_post_writes_format_catalog(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Test Title',
+                'slug_id': 'sluggy',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36'), ('mp4', '360p', '18')]
+            })
+        data = {'command': 1, 'url': 'https://google.com', 'task_id': 'a1b2'}
+        self.client.post(reverse('download:create'), data)
+        # The same video again finds the catalog already written
+        self.setUp()
+        self.client.post(reverse('download:create'), data)
+
+        self.assertEqual(Format.objects.count(), 2)
+        self.assertEqual(Extension.objects.count(), 2)
+        self.assertEqual(Quality.objects.count(), 2)
+        download = Download.objects.get(slug_id='sluggy')
+        self.assertEqual(sorted(str(file_format) for file_format in download.choices_for.all()),
+                         ['mkv : 720p', 'mp4 : 360p'])
+
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_invalid_post(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Test Title',
+                'slug_id': 'sluggy',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
+            })
         test_url = 'gibberish'
         test_command = 1
         response = self.client.post(reverse('download:create'), {
-                                    'command': test_command, 'url': test_url})
+                                    'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
         self.assertEqual(response.status_code, 200)
         self.assertFormError(response, 'form', 'url', ['Enter a valid URL.'])
 
-    @patch("download_ui.apps.download.models.Downloader.get_downloader")
-    def test_view_successful_post_draft_exists_and_other_file(self, mocked_downloader):
-        mocked_extract = MagicMock()
-        mocked_extract.return_value = {
-            'source': 'Youtube',
-            'title': 'Title Current',
-            'slug_id': 'currentslug',
-            'channel_name': 'youtuber man',
-            'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
-        }
-        mocked_downloader.return_value = MagicMock(extract=mocked_extract)
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_successful_post_draft_exists_and_other_file(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Title Current',
+                'slug_id': 'currentslug',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
+            })
         test_url = 'https://youtube.com'
         test_command = 1
         response = self.client.post(reverse('download:create'), {
-                                    'command': test_command, 'url': test_url})
+                                    'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'partials/download_form.html')
         self.assertEqual(response.context['download'].slug_id, 'currentslug')
@@ -198,43 +332,71 @@ class DownloadCreateViewTest(TestCase):
             'Please select to skip a fresh download and use an existing file.'
         ])
 
-    @patch("download_ui.apps.download.models.Downloader.get_downloader")
-    def test_view_successful_post_override(self, mocked_downloader):
-        mocked_extract = MagicMock()
-        mocked_extract.return_value = {
-            'source': 'Youtube',
-            'title': 'Title Current',
-            'slug_id': 'currentslug',
-            'channel_name': 'youtuber man',
-            'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
-        }
-        mocked_downloader.return_value = MagicMock(extract=mocked_extract)
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_successful_post_override(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Title Current',
+                'slug_id': 'currentslug',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
+            })
         test_url = 'https://youtube.com'
         test_command = 1
         response = self.client.post(reverse(
-            'download:create')+'?override', {'command': test_command, 'url': test_url})
+            'download:create')+'?override', {'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
         self.assertRedirects(response, reverse(
             'download:update', kwargs={'pk': 4}))
         download = Download.objects.get(id=4)
         self.assertEqual(download.url, test_url)
         self.assertEqual(download.command.id, test_command)
 
-    @patch("download_ui.apps.download.models.Downloader.get_downloader")
-    def test_view_successful_post_download_exists_but_file_missing(self, mocked_downloader):
-        mocked_extract = MagicMock()
-        mocked_extract.return_value = {
-            'source': 'Youtube',
-            'title': 'Title Current',
-            'slug_id': 'currentslug',
-            'channel_name': 'youtuber man',
-            'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
-        }
-        mocked_downloader.return_value = MagicMock(extract=mocked_extract)
+    @patch("download_ui.apps.download.views.worker_extract")
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_modal_continue_reuses_extraction(self, mocked_async_result, mocked_worker):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Title Current',
+                'slug_id': 'currentslug',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
+            })
+        data = {'command': 1, 'url': 'https://youtube.com', 'task_id': 'a1b2'}
+        response = self.client.post(reverse('download:create'), data)
+        self.assertEqual(response.context['modal_title'], 'Video Exists')
+        self.assertContains(response, '<input type="hidden" name="task_id" value="a1b2">')
+        self.assertEqual(self.client.session['extraction_tasks'], ['a1b2'])
+
+        # Continue in the modal posts the same task again
+        response = self.client.post(reverse('download:create') + '?override=true', data)
+        self.assertRedirects(response, reverse('download:update', kwargs={'pk': 4}))
+        mocked_worker.delay.assert_not_called()
+        self.assertEqual(Download.objects.get(id=4).slug_id, 'currentslug')
+        self.assertEqual(self.client.session['extraction_tasks'], [])
+
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_view_successful_post_download_exists_but_file_missing(self, mocked_async_result):
+        mocked_async_result.return_value = MagicMock(
+            ready=MagicMock(return_value=True),
+            successful=MagicMock(return_value=True),
+            result={
+                'source': 'Youtube',
+                'title': 'Title Current',
+                'slug_id': 'currentslug',
+                'channel_name': 'youtuber man',
+                'format_info': [('mkv', '720p', '54'), ('mp4', '360p', '36')]
+            })
         os.remove('test_file.txt')
         test_url = 'https://youtube.com'
         test_command = 1
         response = self.client.post(reverse('download:create'), {
-                                    'command': test_command, 'url': test_url})
+                                    'command': test_command, 'url': test_url, 'task_id': 'a1b2'})
         self.assertRedirects(response, reverse(
             'download:update', kwargs={'pk': 4}))
         download = Download.objects.get(id=4)
@@ -318,7 +480,7 @@ class DownloadUpdateViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['form'].initial['id'], 2)
 
-    @patch("download_ui.apps.download.views.worker_download")
+    @patch("download_ui.apps.download.tasks.worker_download")
     def test_view_successful_post(self, _mocked_worker):
         test_url = 'https://youtube.com'
         test_command = 1
@@ -357,7 +519,7 @@ class DownloadUpdateViewTest(TestCase):
         ])
         self.assertTrue(response.context['update'])
 
-    @patch("download_ui.apps.download.views.worker_download")
+    @patch("download_ui.apps.download.tasks.worker_download")
     def test_view_successful_post_override(self, _mocked_worker):
         test_url = 'https://youtube.com'
         test_command = 1
@@ -368,7 +530,7 @@ class DownloadUpdateViewTest(TestCase):
         self.assertEqual(download.url, test_url)
         self.assertEqual(download.command.id, test_command)
 
-    @patch("download_ui.apps.download.views.worker_download")
+    @patch("download_ui.apps.download.tasks.worker_download")
     def test_view_successful_post_download_exists_but_file_missing(self, _mocked_worker):
         os.remove('test_file.txt')
         test_url = 'https://youtube.com'
@@ -510,6 +672,7 @@ class DownloadListViewTest(TestCase):
         # Create 23 downloads for pagination tests
         number_of_downloads = 24
 
+        cls.user = UserProfile.objects.create(username='lister', is_approved=True)
         command = Command.objects.create(name='YTDL')
         source = Source.objects.create(name='Youtube')
 
@@ -517,10 +680,14 @@ class DownloadListViewTest(TestCase):
             Download.objects.create(
                 command=command,
                 source=source,
+                created_by=cls.user,
                 url=f'URL {down_id}',
                 title=f'Title {down_id}'
             )
 
+    def setUp(self):
+        self.client.force_login(self.user)
+
     def test_view_url_exists_at_desired_location(self):
         response = self.client.get('/download/list/')
         self.assertEqual(response.status_code, 200)
@@ -542,12 +709,35 @@ class DownloadListViewTest(TestCase):
         self.assertEqual(len(response.context['download_list']), 20)
 
     def test_lists_all_downloads(self):
-        # Get second page and confirm it has (exactly) remaining 4 items
-        response = self.client.get(reverse('download:list')+'?page=2')
+        # Follow the next cursor and confirm it has (exactly) remaining 4 items
+        response = self.client.get(reverse('download:list'))
+        next_query = response.context['next_query']
+        response = self.client.get(reverse('download:list')+'?'+next_query)
         self.assertEqual(response.status_code, 200)
         self.assertTrue('is_paginated' in response.context)
         self.assertTrue(response.context['is_paginated'])
         self.assertEqual(len(response.context['download_list']), 4)
+        self.assertNotIn('next_query', response.context)
+        self.assertIn('previous_query', response.context)
+
+    def test_infinite_scroll_renders_rows(self):
+        response = self.client.get(reverse('download:list'))
+        next_query = response.context['next_query']
+        response = self.client.get(reverse('download:list')+'?'+next_query,
+                                   HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'partials/download_list_rows.html')
+        self.assertTemplateNotUsed(response, 'download_list.html')
+        self.assertEqual(len(response.context['download_list']), 4)
+
+    def test_cursor_keeps_filters(self):
+        response = self.client.get(reverse('download:list')+'?q=Title&mine')
+        self.assertIn('q=Title', response.context['next_query'])
+        self.assertIn('mine=', response.context['next_query'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('download:list')+'?cursor=bogus')
+        self.assertEqual(response.status_code, 404)
 
     def test_search_query_exists(self):
         # Query and get any with title containg a 3 (should be 3 results 3,13,23)
@@ -561,17 +751,22 @@ class DownloadListViewTest(TestCase):
 class DownloadProgressViewTest(TestCase):
     @classmethod
     def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='progresser', is_approved=True)
         command = Command.objects.create(name='YTDL')
         source = Source.objects.create(name='Youtube')
         Download.objects.create(
             command=command,
             source=source,
+            created_by=cls.user,
             url='URL Test',
             title='Title Test',
             active_task_id='a1b2',
             status=Download.Status.COMPLETED
         )
 
+    def setUp(self):
+        self.client.force_login(self.user)
+
     def test_view_url_exists_at_desired_location(self):
         response = self.client.get('/download/1/progress/')
         self.assertEqual(response.status_code, 200)
@@ -629,6 +824,20 @@ class DownloadProgressViewTest(TestCase):
         self.assertEqual(response.context['task_status'], task_status)
         self.assertEqual(response.context['task_info'], task_info)
 
+    @patch("download_ui.apps.download.views.AsyncResult")
+    def test_context_values_status_started_task_retry(self, mocked_async_result):
+        download_id = 1
+        download = Download.objects.get(id=download_id)
+        download.status = Download.Status.STARTED
+        download.save()
+        mocked_async_result.return_value = MagicMock(
+            id='a1b2', status='RETRY', info=ConnectionError('reset'))
+        response = self.client.get(
+            reverse('download:progress', kwargs={'pk': download_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['task_info'], {'percent_str': 'Retrying', 'percent': 0})
+        self.assertContains(response, 'Retrying')
+
     def test_context_values_status_completed(self):
         download_id = 1
         response = self.client.get(
@@ -636,3 +845,143 @@ class DownloadProgressViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['download'].id, download_id)
         self.assertEqual(response.context['trigger'], 'none')
+
+
+class DownloadMultiProgressViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='poller', is_approved=True)
+        command = Command.objects.create(name='YTDL')
+        source = Source.objects.create(name='Youtube')
+        for down_id in range(3):
+            Download.objects.create(
+                command=command,
+                source=source,
+                created_by=cls.user,
+                url=f'URL Test {down_id}',
+                title=f'Title Test {down_id}',
+                active_task_id=f'task{down_id}',
+                status=Download.Status.STARTED
+            )
+        Download.objects.create(
+            command=command,
+            source=source,
+            created_by=cls.user,
+            url='URL Test Completed',
+            title='Title Test Completed',
+            active_task_id='task3',
+            status=Download.Status.COMPLETED
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_view_url_accessible_by_name(self):
+        response = self.client.get(reverse('download:multi_progress'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'partials/download_progress_multi.html')
+        self.assertEqual(response.context['progress'], [])
+        self.assertEqual(response.context['poll_ids'], '')
+
+    @patch("download_ui.apps.download.views.app")
+    def test_fetches_all_task_metas_at_once(self, mocked_app):
+        backend = mocked_app.backend
+        backend.get_key_for_task.side_effect = lambda task_id: f'key-{task_id}'
+        backend.mget.return_value = [None, b'started', b'progress']
+        backend.decode_result.side_effect = [
+            {'status': 'STARTED', 'result': None},
+            {'status': 'PROGRESS', 'result': {'percent_str': '25.0%', 'percent': 25.0}},
+        ]
+        ids = ','.join(str(down.id) for down in Download.objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('download:multi_progress') + f'?ids={ids}')
+        self.assertEqual(response.status_code, 200)
+        download_queries = [query for query in queries
+                            if 'download_download' in query['sql']]
+        self.assertEqual(len(download_queries), 1)
+        backend.mget.assert_called_once_with(['key-task2', 'key-task1', 'key-task0'])
+        task_infos = {item['download'].active_task_id: item['task_info']
+                      for item in response.context['progress']}
+        self.assertEqual(task_infos, {
+            'task0': {'percent_str': '25.0%', 'percent': 25.0},
+            'task1': {'percent_str': '0.0%', 'percent': 0},
+            'task2': None,
+            'task3': None,
+        })
+        self.assertContains(response, 'hx-swap-oob="true"', count=4)
+
+    @patch("download_ui.apps.download.views.app")
+    def test_poller_only_keeps_started_downloads(self, mocked_app):
+        mocked_app.backend.mget.return_value = [None, None, None]
+        ids = ','.join(str(down.id) for down in Download.objects.all())
+        response = self.client.get(
+            reverse('download:multi_progress') + f'?poll&ids={ids}')
+        started = ','.join(str(down.id) for down in Download.objects.filter(
+            status=Download.Status.STARTED))
+        self.assertEqual(response.context['poll_ids'], started)
+        self.assertIn('poll', response.context['poll_url'])
+        self.assertEqual(response.context['poll_delay'], '600ms')
+        self.assertEqual(response.context['trigger'], 'none')
+
+
+class DownloadResumeViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='resumer', is_approved=True)
+        cls.other = UserProfile.objects.create(username='other', is_approved=True)
+        command = Command.objects.create(name='YTDL')
+        quality = Quality.objects.create(name='720p')
+        extension = Extension.objects.create(name='mp4')
+        cls.file_format = Format.objects.create(format_code='22', quality=quality,
+                                                command=command, extension=extension)
+        cls.command = command
+        cls.source = Source.objects.create(name='Youtube')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def create(self, status, user=None):
+        return Download.objects.create(
+            command=self.command,
+            source=self.source,
+            created_by=user or self.user,
+            url='https://youtube.com',
+            title='Title Resume',
+            file_format=self.file_format,
+            active_task_id='old-task',
+            status=status
+        )
+
+    @patch("download_ui.apps.download.tasks.worker_download")
+    def test_resume_queues_the_same_download(self, mocked_worker):
+        for status in (Download.Status.FAILED, Download.Status.TERMINATED):
+            download = self.create(status)
+            response = self.client.post(reverse('download:resume', kwargs={'pk': download.id}))
+            self.assertRedirects(response, reverse('download:home'))
+            download.refresh_from_db()
+            self.assertEqual(download.status, Download.Status.STARTED)
+            args, kwargs = mocked_worker.apply_async.call_args
+            self.assertEqual(args, ((download.id,),))
+            self.assertEqual(kwargs['task_id'], download.active_task_id)
+            Download.objects.filter(pk=download.pk).update(status=Download.Status.COMPLETED)
+
+    @patch("download_ui.apps.download.tasks.worker_download")
+    def test_only_failed_or_cancelled(self, mocked_worker):
+        download = self.create(Download.Status.COMPLETED)
+        response = self.client.post(reverse('download:resume', kwargs={'pk': download.id}))
+        self.assertEqual(response.status_code, 400)
+        mocked_worker.apply_async.assert_not_called()
+
+    def test_only_the_owner(self):
+        download = self.create(Download.Status.FAILED, user=self.other)
+        response = self.client.post(reverse('download:resume', kwargs={'pk': download.id}))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('download:detail', kwargs={'pk': download.id}))
+        self.assertContains(response, 'Resume</button>')
+        self.assertContains(response, 'disabled>Resume')
+
+    def test_detail_shows_resume(self):
+        download = self.create(Download.Status.TERMINATED)
+        response = self.client.get(reverse('download:detail', kwargs={'pk': download.id}))
+        self.assertContains(response, reverse('download:resume', kwargs={'pk': download.id}))
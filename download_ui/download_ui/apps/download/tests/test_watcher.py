@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+from unittest import skipIf
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.urls import reverse
+
+from download_ui.apps.download.models import Command, Download, Source, UserProfile
+from download_ui.apps.download.watcher import (LibraryChanges, LibraryWatcher, apply_changes,
+                                               inotify_simple)
+
+
+class WatcherTestMixin:
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(username='watcher', is_approved=True)
+        cls.command = Command.objects.create(name='YTDL')
+        cls.source = Source.objects.create(name='Youtube')
+
+    def setUp(self):
+        self.library = tempfile.TemporaryDirectory()
+        self.addCleanup(self.library.cleanup)
+        self.root = os.path.realpath(self.library.name)
+        os.makedirs(self.path('channel'))
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def create(self, file_path, status=Download.Status.COMPLETED):
+        if status == Download.Status.COMPLETED:
+            with open(file_path, 'w', encoding='utf8') as fp:
+                fp.write('video')
+        return Download.objects.create(command=self.command, source=self.source,
+                                       created_by=self.user, url='https://youtube.com',
+                                       title=os.path.basename(file_path), file_path=file_path,
+                                       status=status)
+
+    def assertStatus(self, download, status, file_path=None):
+        download.refresh_from_db()
+        self.assertEqual(download.status, status)
+        if file_path is not None:
+            self.assertEqual(download.file_path, file_path)
+
+
+class ApplyChangesTest(WatcherTestMixin, TestCase):
+    def test_removed_and_restored(self):
+        gone = self.create(self.path('gone.mp4'))
+        folder = self.create(self.path('channel', 'in_folder.mp4'))
+        back = self.create(self.path('back.mp4'), status=Download.Status.MISSING)
+        failed = self.create(self.path('failed.mp4'), status=Download.Status.FAILED)
+        changes = LibraryChanges()
+        changes.remove(gone.file_path, is_dir=False)
+        changes.remove(self.path('channel'), is_dir=True)
+        changes.remove(failed.file_path, is_dir=False)
+        changes.add(back.file_path)
+
+        with self.assertNumQueries(3):
+            self.assertEqual(apply_changes(changes), 3)
+
+        self.assertStatus(gone, Download.Status.MISSING)
+        self.assertStatus(folder, Download.Status.MISSING)
+        self.assertStatus(back, Download.Status.COMPLETED)
+        self.assertStatus(failed, Download.Status.FAILED)
+
+    def test_moves_keep_the_download(self):
+        renamed = self.create(self.path('old.mp4'))
+        folder = self.create(self.path('channel', 'video.mp4'))
+        changes = LibraryChanges()
+        changes.move(renamed.file_path, self.path('new.mp4'), is_dir=False)
+        changes.move(self.path('channel'), self.path('renamed'), is_dir=True)
+
+        self.assertEqual(apply_changes(changes), 2)
+
+        self.assertStatus(renamed, Download.Status.COMPLETED, self.path('new.mp4'))
+        self.assertStatus(folder, Download.Status.COMPLETED, self.path('renamed', 'video.mp4'))
+
+
+@skipIf(inotify_simple is None, 'inotify_simple is not installed')
+class LibraryWatcherTest(WatcherTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.watcher = None
+
+    def watch(self):
+        self.watcher = LibraryWatcher(self.root, batch_seconds=0.05)
+        self.addCleanup(self.watcher.close)
+
+    def process(self):
+        return self.watcher.process(self.watcher.inotify.read(timeout=1000, read_delay=50))
+
+    def test_delete_marks_missing(self):
+        download = self.create(self.path('channel', 'video.mp4'))
+        other = self.create(self.path('other.mp4'))
+        self.watch()
+
+        os.remove(download.file_path)
+        self.assertEqual(self.process(), 1)
+
+        self.assertStatus(download, Download.Status.MISSING)
+        self.assertStatus(other, Download.Status.COMPLETED)
+
+    def test_move_out_of_library_marks_missing(self):
+        outside = tempfile.TemporaryDirectory()
+        self.addCleanup(outside.cleanup)
+        download = self.create(self.path('channel', 'video.mp4'))
+        self.watch()
+
+        shutil.move(self.path('channel'), os.path.join(outside.name, 'channel'))
+        self.process()
+
+        self.assertStatus(download, Download.Status.MISSING)
+        self.assertEqual(list(self.watcher.directories.values()), [self.root])
+
+    def test_rename_follows_the_file(self):
+        download = self.create(self.path('channel', 'video.mp4'))
+        self.watch()
+
+        os.rename(self.path('channel'), self.path('renamed'))
+        self.process()
+        self.assertStatus(download, Download.Status.COMPLETED, self.path('renamed', 'video.mp4'))
+
+        # The renamed folder is still watched under its new name
+        os.remove(self.path('renamed', 'video.mp4'))
+        self.process()
+        self.assertStatus(download, Download.Status.MISSING)
+
+    def test_new_folders_are_watched(self):
+        self.watch()
+        os.makedirs(self.path('new', 'nested'))
+        self.process()
+        download = self.create(self.path('new', 'nested', 'video.mp4'))
+        self.process()
+
+        os.remove(download.file_path)
+        self.process()
+        self.assertStatus(download, Download.Status.MISSING)
+
+    def test_restored_file(self):
+        download = self.create(self.path('video.mp4'), status=Download.Status.MISSING)
+        self.watch()
+
+        with open(download.file_path, 'w', encoding='utf8') as fp:
+            fp.write('video')
+        self.process()
+
+        self.assertStatus(download, Download.Status.COMPLETED)
+
+
+class FileWatcherSettingTest(WatcherTestMixin, TestCase):
+    @patch.object(Download, 'set_missing_if_file_not_found')
+    def test_detail_trusts_status_with_watcher(self, mocked_check):
+        download = self.create(self.path('video.mp4'))
+        self.client.force_login(self.user)
+
+        with self.settings(DOWNLOAD_FILE_WATCHER=True):
+            response = self.client.get(reverse('download:detail', kwargs={'pk': download.id}))
+        self.assertEqual(response.status_code, 200)
+        mocked_check.assert_not_called()
+
+        response = self.client.get(reverse('download:detail', kwargs={'pk': download.id}))
+        mocked_check.assert_called_once_with()
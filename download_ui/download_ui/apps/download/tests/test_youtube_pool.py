@@ -0,0 +1,124 @@
+from http.cookiejar import Cookie
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase, override_settings
+import youtube_dl
+
+from download_ui.apps.download.downloaders import youtube
+from download_ui.apps.download.downloaders.youtube import YoutubeDownloader
+from download_ui.apps.download.downloaders.youtube_pool import YoutubeDLPool
+from download_ui.apps.download.exceptions import ExtractionError
+from download_ui.apps.download.tasks import start_youtube_dl_pool
+
+VIDEO = {
+    'channel': 'youtube lady',
+    'title': 'Test Video',
+    'id': 'gibberish',
+    'extractor_key': 'Youtube',
+    'formats': [{'vcodec': 'avc1', 'acodec': 'mp4a', 'format_id': '22', 'ext': 'mp4',
+                 'resolution': '1280x720'}],
+}
+
+
+def cookie(name):
+    return Cookie(0, name, 'value', None, False, '.youtube.com', True, True, '/', True,
+                  False, None, False, None, None, {})
+
+
+class YoutubeDLPoolTest(TestCase):
+    def setUp(self):
+        self.pool = YoutubeDLPool(size=2, max_uses=3)
+
+    def test_instances_are_reused_per_profile(self):
+        with self.pool.checkout('extract', {'quiet': True}) as first:
+            pass
+        with self.pool.checkout('extract', {'quiet': True}) as second:
+            pass
+        with self.pool.checkout('download', {'quiet': True}) as other:
+            pass
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual((self.pool.created, self.pool.reused), (2, 1))
+
+    def test_reset_for_each_task(self):
+        hook = MagicMock()
+        with self.pool.checkout('download', {'format': '22', 'progress_hooks': [hook],
+                                             'ratelimit': 1000}) as ydl:
+            ydl.cookiejar.set_cookie(cookie('CONSENT'))
+            ydl._download_retcode = 1
+
+        with self.pool.checkout('download', {'format': '137', 'progress_hooks': []}) as again:
+            self.assertIs(again, ydl)
+            self.assertEqual(again.params['format'], '137')
+            self.assertNotIn('ratelimit', again.params)
+            self.assertEqual(again._progress_hooks, [])
+            self.assertEqual(again._download_retcode, 0)
+            self.assertEqual(len(again.cookiejar), 0)
+
+    def test_recycled_after_max_uses(self):
+        instances = []
+        for _ in range(4):
+            with self.pool.checkout('extract', {}) as ydl:
+                instances.append(ydl)
+
+        self.assertEqual(len(set(map(id, instances[:3]))), 1)
+        self.assertIsNot(instances[3], instances[0])
+
+    def test_idle_instances_are_bounded(self):
+        with self.pool.checkout('extract', {}), self.pool.checkout('extract', {}), \
+                self.pool.checkout('extract', {}):
+            pass
+
+        self.assertEqual(self.pool.created, 3)
+        self.assertEqual(len(self.pool.idle['extract']), 2)
+
+    def test_failures(self):
+        with self.assertRaises(youtube_dl.utils.ExtractorError):
+            with self.pool.checkout('extract', {}) as ydl:
+                raise youtube_dl.utils.ExtractorError('Video unavailable', expected=True)
+        self.assertEqual(self.pool.idle['extract'], [(ydl, 1)])
+
+        # Anything else might have left it half way through a download
+        with self.assertRaises(KeyboardInterrupt):
+            with self.pool.checkout('extract', {}):
+                raise KeyboardInterrupt()
+        self.assertEqual(self.pool.idle['extract'], [])
+
+
+class YoutubeDownloaderPoolTest(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, youtube, '_pool', None)
+
+    @override_settings(DOWNLOAD_YTDL_POOL_SIZE=2)
+    def test_worker_processes_start_warm(self):
+        start_youtube_dl_pool()
+
+        self.assertEqual(youtube._pool.created, 3)
+        self.assertEqual(set(youtube._pool.idle), {'extract', 'batch', 'download'})
+
+    @override_settings(DOWNLOAD_YTDL_POOL_SIZE=0)
+    def test_pool_turned_off(self):
+        start_youtube_dl_pool()
+        self.assertIsNone(youtube._pool)
+
+    @patch.object(youtube_dl.YoutubeDL, 'extract_info', autospec=True)
+    def test_extractions_share_an_instance(self, mocked_extract_info):
+        youtube._pool = YoutubeDLPool(size=2, max_uses=10)
+
+        def extract_info(ydl, url, download):
+            if url.endswith('missing'):
+                raise youtube_dl.utils.DownloadError(
+                    'Video unavailable', (None, Exception('Video unavailable'), None))
+            return VIDEO
+        mocked_extract_info.side_effect = extract_info
+
+        downloader = YoutubeDownloader()
+        self.assertEqual(downloader.extract('https://youtu.be/gibberish')['title'], 'Test Video')
+        with self.assertRaisesMessage(ExtractionError, 'Video unavailable'):
+            downloader.extract('https://youtu.be/missing')
+        downloader.extract('https://youtu.be/gibberish')
+
+        instances = {id(call.args[0]) for call in mocked_extract_info.call_args_list}
+        self.assertEqual(len(instances), 1)
+        self.assertEqual(youtube._pool.created, 1)
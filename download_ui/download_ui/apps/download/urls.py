@@ -1,7 +1,10 @@
 from django.urls import path
 
 from .views import (DownloadCreateView, DownloadArchiveView, DownloadListView, DownloadCancelView,
-                    DownloadDetailView, DownloadProgressView, DownloadUpdateView, DownloadHomeView,
+                    DownloadBatchCreateView, DownloadBatchDetailView, DownloadBatchProgressView,
+                    DownloadBulkImportView, DownloadBulkResultsView,
+                    DownloadDetailView, DownloadEventsView, DownloadMultiProgressView,
+                    DownloadProgressView, DownloadResumeView, DownloadUpdateView, DownloadHomeView,
                     RegisterView)
 
 app_name = 'download'
@@ -13,6 +16,14 @@ urlpatterns = [
     path('list/', DownloadListView.as_view(), name='list'),
     path('<int:pk>/archive/', DownloadArchiveView.as_view(), name='archive'),
     path('<int:pk>/cancel/', DownloadCancelView.as_view(), name='cancel'),
+    path('<int:pk>/resume/', DownloadResumeView.as_view(), name='resume'),
     path('<int:pk>/progress/', DownloadProgressView.as_view(), name='progress'),
+    path('progress/', DownloadMultiProgressView.as_view(), name='multi_progress'),
+    path('events/', DownloadEventsView.as_view(), name='events'),
+    path('bulk/', DownloadBulkImportView.as_view(), name='bulk_import'),
+    path('bulk/<str:task_id>/', DownloadBulkResultsView.as_view(), name='bulk_results'),
+    path('batch/create/', DownloadBatchCreateView.as_view(), name='batch_create'),
+    path('batch/<int:pk>/', DownloadBatchDetailView.as_view(), name='batch_detail'),
+    path('batch/<int:pk>/progress/', DownloadBatchProgressView.as_view(), name='batch_progress'),
     path('register/', RegisterView.as_view(), name="register")
 ]
@@ -1,38 +1,162 @@
+from collections import Counter
 from datetime import timedelta
 import logging
 
 from celery.result import AsyncResult
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.messages.views import SuccessMessageMixin
-from django.db.models import Q
-from django.shortcuts import get_object_or_404, render
-from django.urls import reverse_lazy
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.utils.http import urlencode
-from django.views.generic import CreateView, ListView, DetailView, UpdateView, View
+from django.views.generic import CreateView, FormView, ListView, DetailView, UpdateView, View
 
 from download_ui.celery import app
-from .forms import DownloadForm, DownloadFormatForm, UserRegisterForm
-from .models import Download, UserProfile
-from .tasks import worker_download
+from . import extraction_cache, scheduler
+from .forms import (BulkImportForm, DownloadBatchForm, DownloadForm, DownloadFormatForm,
+                    UserRegisterForm)
+from .models import Download, DownloadBatch, UserProfile
+from .pagination import InvalidCursor, KeysetPaginator
+from .search import get_search_backend
+from .tasks import worker_extract, worker_extract_batch, worker_extract_bulk
 
 logger = logging.getLogger('__name__')
 
+# The extraction tasks a session started and may poll, the newest last
+EXTRACTION_TASKS_SESSION_KEY = 'extraction_tasks'
+EXTRACTION_TASKS_KEPT = 20
+
+# The bulk imports a session started and may see the results of
+BULK_TASKS_SESSION_KEY = 'bulk_tasks'
+BULK_TASKS_KEPT = 20
+
+# What a worker_extract result has when it isn't an error
+EXTRACTION_KEYS = ('source', 'title', 'slug_id', 'channel_name', 'format_info')
+
+
+def is_extraction(result):
+    """Whether a task result is what worker_extract returns."""
+    if not isinstance(result, dict):
+        return False
+    if 'error' in result:
+        return True
+    return (all(key in result for key in EXTRACTION_KEYS)
+            and isinstance(result['format_info'], (list, tuple)))
+
+
+def is_bulk_import(result):
+    """Whether a task result is what worker_extract_bulk returns."""
+    return (isinstance(result, dict) and isinstance(result.get('user_id'), int)
+            and isinstance(result.get('results'), list))
+
+
+def remember_task(session, key, task_id, kept):
+    """Add a task the session started to its list under key, keeping the
+    newest kept."""
+    session[key] = (session.get(key, []) + [task_id])[-kept:]
+
+
+def progress_trigger(request):
+    # With the progress stream a card only refreshes when its task is done,
+    # the slow poll is a safety net. ?poll is the fallback when the stream
+    # can't connect.
+    if settings.DOWNLOAD_PROGRESS_STREAM and 'poll' not in request.GET:
+        return 'progress-refresh, every 30s'
+    return 'load delay:600ms'
+
+
+def get_task_metas(task_ids):
+    """Fetch the Celery result metas for all the task ids with one MGET."""
+    if not task_ids:
+        return {}
+    backend = app.backend
+    values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    return {
+        task_id: backend.decode_result(value) if value else {'status': 'PENDING', 'result': None}
+        for task_id, value in zip(task_ids, values)
+    }
+
+
+def get_task_info(meta):
+    if meta['status'] == 'STARTED':
+        return {'percent_str': '0.0%', 'percent': 0}
+    if meta['status'] == 'RETRY':
+        # The result is the error until the next attempt reports progress
+        return {'percent_str': 'Retrying', 'percent': 0}
+    return meta['result']
+
+
+def progress_poller_context(request, downloads):
+    # One poller per page refreshes every started and queued card at once.
+    # With the progress stream it only runs slowly as a safety net.
+    poll = 'poll' in request.GET
+    query = {'ids': ','.join(str(down.id) for down in downloads
+                             if down.status in (Download.Status.STARTED, Download.Status.QUEUED))}
+    if poll:
+        query['poll'] = ''
+    return {
+        'poll_ids': query['ids'],
+        'poll_url': f"{reverse('download:multi_progress')}?{urlencode(query)}",
+        'poll_delay': '10s' if settings.DOWNLOAD_PROGRESS_STREAM and not poll else '600ms',
+    }
+
+
+def add_queue_estimates(downloads):
+    # Queue position and estimated start for the queued cards
+    if any(down.status == Download.Status.QUEUED for down in downloads):
+        estimates = scheduler.queue_estimates()
+        for down in downloads:
+            down.queue_position, down.queue_start = estimates.get(down.id, (None, None))
+
+
+def get_batch_progress(batch):
+    """Status counts and overall percent for the downloads of a batch."""
+    rows = list(batch.downloads.values_list('status', 'active_task_id'))
+    counts = Counter(status for status, _ in rows)
+    metas = get_task_metas(list({task_id for status, task_id in rows
+                                 if status == Download.Status.STARTED and task_id}))
+    total_percent = 0.0
+    for status, task_id in rows:
+        if status == Download.Status.STARTED:
+            info = get_task_info(metas[task_id]) if task_id in metas else None
+            if isinstance(info, dict):
+                total_percent += float(info.get('percent') or 0)
+        elif status not in (Download.Status.QUEUED, Download.Status.DRAFT):
+            # Finished one way or another
+            total_percent += 100
+    running = counts[Download.Status.STARTED] + counts[Download.Status.QUEUED]
+    return {
+        'total': len(rows),
+        'counts': [(label, counts[status]) for status, label in Download.Status.choices
+                   if counts[status]],
+        'percent': round(total_percent / len(rows)) if rows else 0,
+        'done': batch.status == DownloadBatch.Status.FAILED or (
+            batch.status == DownloadBatch.Status.STARTED and not running),
+    }
+
 
 class DownloadHomeView(LoginRequiredMixin, View):
     def get(self, request):
         time_threshold = timezone.now() - timedelta(hours=24)
         all_downloads = Download.objects.filter(
             created_at__gte=time_threshold).exclude(
-            status=Download.Status.DRAFT)
-        my_downloads = all_downloads.filter(
-            created_by=self.request.user)
-        other_downloads = all_downloads.exclude(
-            created_by=self.request.user)
+            status=Download.Status.DRAFT).select_related('created_by')
+        my_downloads = list(all_downloads.filter(
+            created_by=self.request.user))
+        other_downloads = list(all_downloads.exclude(
+            created_by=self.request.user))
+        add_queue_estimates([*my_downloads, *other_downloads])
         context = {
             'my_downloads': my_downloads,
-            'other_downloads': other_downloads
+            'other_downloads': other_downloads,
+            'progress_stream': settings.DOWNLOAD_PROGRESS_STREAM,
+            # Started cards are refreshed by the page's progress poller
+            'trigger': 'progress-refresh' if settings.DOWNLOAD_PROGRESS_STREAM else 'none'
         }
+        context.update(progress_poller_context(
+            request, [*my_downloads, *other_downloads]))
         if 'continue' in self.request.GET:
             context['continue'] = self.request.GET['continue']
         return render(request, "download_home.html", context)
@@ -46,7 +170,63 @@ class DownloadCreateView(LoginRequiredMixin, CreateView):
         logger.debug('Initial form submitted. ID is %d', self.object.id)
         return reverse_lazy('download:update', kwargs={'pk': self.object.id})
 
+    def post(self, request, *args, **kwargs):
+        self.object = None
+        form = self.get_form()
+        task_id = request.POST.get('task_id')
+        tasks = request.session.get(EXTRACTION_TASKS_SESSION_KEY, [])
+        if task_id and task_id not in tasks:
+            # Only extractions this session started, anything else starts over
+            logger.warning('Ignoring extraction task %s, not started by this session', task_id)
+            task_id = None
+        if task_id:
+            # The info extraction is running in the background, check on it
+            task = AsyncResult(task_id)
+            if not task.ready():
+                return self.render_extracting(form, task_id)
+            if task.successful():
+                result = task.result
+            else:
+                result = {'error': str(task.result)}
+            if is_extraction(result):
+                # Kept in the session until its draft is saved, the existing
+                # download modal posts it again
+                form.instance.extraction = result
+            else:
+                logger.warning('Task %s did not return an extraction, extracting again', task_id)
+                self.forget_extraction_task(task_id)
+        if form.is_valid():
+            return self.form_valid(form)
+        return self.form_invalid(form)
+
+    def forget_extraction_task(self, task_id):
+        tasks = self.request.session.get(EXTRACTION_TASKS_SESSION_KEY, [])
+        if task_id in tasks:
+            self.request.session[EXTRACTION_TASKS_SESSION_KEY] = [
+                other for other in tasks if other != task_id]
+
+    def render_extracting(self, form, task_id):
+        context = {'form': form, 'task_id': task_id, 'trigger': 'load delay:600ms'}
+        return render(self.request, "partials/download_extracting.html", context)
+
     def form_valid(self, form):
+        if form.instance.extraction is None:
+            # Repeat submissions of the same video skip extraction entirely
+            # worker_extract looks it up again and counts the miss
+            form.instance.extraction = extraction_cache.get_extraction(
+                form.instance.command.name, form.instance.url, count_miss=False)
+            if form.instance.extraction is not None:
+                form.full_clean()
+                if not form.is_valid():
+                    return self.form_invalid(form)
+
+        if form.instance.extraction is None:
+            # Hand the info extraction off to a worker and poll for the result
+            task = worker_extract.delay(form.instance.command.id, form.instance.url)
+            remember_task(self.request.session, EXTRACTION_TASKS_SESSION_KEY, task.id,
+                          EXTRACTION_TASKS_KEPT)
+            return self.render_extracting(form, task.id)
+
         if 'override' not in self.request.GET:
             # Get rid of dangling drafts
             existing_draft_list = Download.objects.filter(slug_id=form.instance.slug_id,
@@ -60,10 +240,11 @@ class DownloadCreateView(LoginRequiredMixin, CreateView):
                                                              status=Download.Status.COMPLETED)
 
             if existing_download_list:
-                # Check if any of the completed downloads are actually missing
-                for down in existing_download_list:
-                    down.set_missing_if_file_not_found()
-                    down.save()
+                if not settings.DOWNLOAD_FILE_WATCHER:
+                    # Check if any of the completed downloads are actually missing
+                    for down in existing_download_list:
+                        down.set_missing_if_file_not_found()
+                        down.save()
                 fresh_existing_download_list = existing_download_list.filter(
                     status=Download.Status.COMPLETED)
 
@@ -72,6 +253,7 @@ class DownloadCreateView(LoginRequiredMixin, CreateView):
                     context = {
                         'form': form,
                         'download': form.instance,
+                        'task_id': self.request.POST.get('task_id'),
                         'existing': fresh_existing_download_list,
                         'modal_title': 'Video Exists',
                         'modal_body': [
@@ -81,9 +263,11 @@ class DownloadCreateView(LoginRequiredMixin, CreateView):
                     }
                     return render(self.request, "partials/download_form.html", context)
         form.instance.created_by = self.request.user
+        self.forget_extraction_task(self.request.POST.get('task_id'))
         return super().form_valid(form)
 
     def form_invalid(self, form):
+        self.forget_extraction_task(self.request.POST.get('task_id'))
         context = {'form': form}
         return render(self.request, "partials/download_form.html", context)
 
@@ -91,10 +275,11 @@ class DownloadCreateView(LoginRequiredMixin, CreateView):
         context = super().get_context_data(**kwargs)
         if 'old_pk' in self.request.GET:
             down_object = self.get_object()
+            add_queue_estimates([down_object])
             info = {'percent_str': '0.0%', 'percent': 0}
             context['download'] = down_object
             context['task_info'] = info
-            context['trigger'] = 'load delay:600ms'
+            context['trigger'] = progress_trigger(self.request)
         return context
 
     def get_object(self, *args, **kwargs):
@@ -122,10 +307,11 @@ class DownloadUpdateView(LoginRequiredMixin, UpdateView):
                                                              file_format=form.instance.file_format)
 
             if existing_download_list:
-                # Check if any of the completed downloads are actually missing
-                for down in existing_download_list:
-                    down.set_missing_if_file_not_found()
-                    down.save()
+                if not settings.DOWNLOAD_FILE_WATCHER:
+                    # Check if any of the completed downloads are actually missing
+                    for down in existing_download_list:
+                        down.set_missing_if_file_not_found()
+                        down.save()
                 fresh_existing_download_list = existing_download_list.filter(
                     status=Download.Status.COMPLETED)
 
@@ -144,9 +330,7 @@ class DownloadUpdateView(LoginRequiredMixin, UpdateView):
                     }
                     return render(self.request, "partials/download_format_form.html", context)
 
-        worker_download.delay(self.object.pk)
-        self.object.status = Download.Status.STARTED
-        self.object.save()
+        scheduler.enqueue(self.object)
         return response
 
     def form_invalid(self, form):
@@ -174,8 +358,9 @@ class DownloadDetailView(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         obj = self.get_object()
-        obj.set_missing_if_file_not_found()
-        obj.save()
+        if not settings.DOWNLOAD_FILE_WATCHER:
+            obj.set_missing_if_file_not_found()
+            obj.save()
         context['download'] = obj
         return context
 
@@ -203,35 +388,155 @@ class DownloadCancelView(LoginRequiredMixin, UpdateView):
     def form_valid(self, form):
         response = super().form_valid(form)
         obj = self.get_object()
-        app.control.revoke(obj.active_task_id,
-                           terminate=True, signal='SIGUSR1')
+        if obj.attached_to_id is not None:
+            # The task belongs to the download this one is attached to, and
+            # so does the file
+            obj.status = Download.Status.TERMINATED
+            obj.attached_to = None
+            obj.save()
+            return response
+        # A download still in the queue has no task to stop
+        unqueued = obj.status == Download.Status.QUEUED and Download.objects.filter(
+            pk=obj.pk, status=Download.Status.QUEUED).update(status=Download.Status.TERMINATED)
+        if not unqueued:
+            if obj.status == Download.Status.QUEUED:
+                # The scheduler started it in the meantime
+                obj.refresh_from_db(fields=['active_task_id'])
+            app.control.revoke(obj.active_task_id,
+                               terminate=True, signal='SIGUSR1')
         obj.cancel_download()
         obj.save()
+        # Other users still want the downloads attached to this one
+        scheduler.detach(obj)
+        return response
+
+
+class DownloadResumeView(LoginRequiredMixin, View):
+    # Queue a failed or cancelled download again. It keeps its id and so its
+    # output file, the downloaders pick up the partial files from before.
+    def post(self, request, pk):
+        download = get_object_or_404(Download, pk=pk, created_by=request.user)
+        if (download.status not in (Download.Status.FAILED, Download.Status.TERMINATED)
+                or download.file_format is None):
+            return HttpResponseBadRequest('Only failed or cancelled downloads can be resumed')
+        scheduler.enqueue(download)
+        return redirect('download:home')
+
+
+class DownloadBulkImportView(LoginRequiredMixin, FormView):
+    form_class = BulkImportForm
+    template_name = "download_bulk_import.html"
+
+    def form_valid(self, form):
+        task = worker_extract_bulk.delay(form.cleaned_data['command'].id,
+                                         form.cleaned_data['url_list'], self.request.user.id)
+        remember_task(self.request.session, BULK_TASKS_SESSION_KEY, task.id, BULK_TASKS_KEPT)
+        return redirect('download:bulk_results', task_id=task.id)
+
+
+class DownloadBulkResultsView(LoginRequiredMixin, View):
+    # Polls the bulk extraction, then queues the drafts the user keeps
+    # ticked in one go
+    def get(self, request, task_id):
+        # Only imports this session started, anything else would stay
+        # pending forever or show another task's result
+        if task_id not in request.session.get(BULK_TASKS_SESSION_KEY, []):
+            raise Http404('No such import')
+        task = AsyncResult(task_id)
+        context = {'task_id': task_id, 'ready': task.ready()}
+        if task.ready():
+            if not task.successful():
+                context['error'] = str(task.result)
+            elif not is_bulk_import(task.result) or task.result['user_id'] != request.user.id:
+                raise Http404('No such import')
+            else:
+                context['results'] = task.result['results']
+        template = "partials/download_bulk_results.html" if 'partial' in request.GET \
+            else "download_bulk_results.html"
+        return render(request, template, context)
+
+    def post(self, request, task_id):
+        ids = [int(pk) for pk in request.POST.getlist('download') if pk.isdigit()]
+        drafts = Download.objects.filter(pk__in=ids, created_by=request.user,
+                                         status=Download.Status.DRAFT,
+                                         file_format__isnull=False).order_by('id')
+        for download in drafts:
+            scheduler.enqueue(download)
+        return redirect('download:home')
+
+
+class DownloadBatchCreateView(LoginRequiredMixin, CreateView):
+    form_class = DownloadBatchForm
+    template_name = "download_batch_form.html"
+
+    def form_valid(self, form):
+        form.instance.created_by = self.request.user
+        response = super().form_valid(form)
+        # Listing a playlist can take a while, the batch page shows it going
+        worker_extract_batch.delay(self.object.id)
         return response
 
 
+class DownloadBatchDetailView(LoginRequiredMixin, DetailView):
+    model = DownloadBatch
+    template_name = "download_batch_detail.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['progress'] = get_batch_progress(self.object)
+        context['downloads'] = self.object.downloads.order_by('id')
+        return context
+
+
+class DownloadBatchProgressView(LoginRequiredMixin, View):
+    def get(self, request, pk):
+        batch = get_object_or_404(DownloadBatch, pk=pk)
+        context = {'batch': batch, 'progress': get_batch_progress(batch)}
+        return render(request, "partials/download_batch_progress.html", context)
+
+
 class DownloadListView(LoginRequiredMixin, ListView):
     model = Download
     template_name = "download_list.html"
     paginate_by = 20
+    paginator_class = KeysetPaginator
+
+    def get_template_names(self):
+        # htmx asks for the next rows as the end of the table scrolls into view
+        if self.request.headers.get('HX-Request'):
+            return ["partials/download_list_rows.html"]
+        return super().get_template_names()
 
     def get_queryset(self):
-        query = self.request.GET.get('q')
-        filters = {
-            'mine': Q(created_by=self.request.user),
-            'q': Q(title__icontains=query) | Q(url__icontains=query)
-        }
-        selected_filters = [v for k,v in filters.items() if k in self.request.GET]
-        if len(selected_filters) > 0:
-            download_list = Download.objects.filter(*selected_filters)
-        else:
-            download_list = Download.objects.all()
+        download_list = Download.objects.select_related('source').order_by('-created_at', '-id')
+        if 'mine' in self.request.GET:
+            download_list = download_list.filter(created_by=self.request.user)
+        if 'q' in self.request.GET:
+            download_list = get_search_backend().search(download_list, self.request.GET['q'])
         return download_list
 
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return self.paginator_class(queryset, per_page)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_paginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return paginator, page, page.object_list, page.has_other_pages()
+
     def get_context_data(self,**kwargs):
         context = super().get_context_data(**kwargs)
         vals = {k: self.request.GET[k] for k in self.request.GET.keys() & {'q', 'mine'}}
         context.update(vals)
+        page = context['page_obj']
+        for name, cursor in (('next_query', page.next_cursor),
+                             ('previous_query', page.previous_cursor)):
+            if cursor is not None:
+                query = self.request.GET.copy()
+                query['cursor'] = cursor
+                context[name] = query.urlencode()
         return context
 
 
@@ -240,14 +545,21 @@ class DownloadProgressView(LoginRequiredMixin, View):
         download = Download.objects.get(pk=pk)
         if download.status == Download.Status.STARTED:
             task = AsyncResult(download.active_task_id)
-            info = {'percent_str': '0.0%',
-                    'percent': 0} if task.status is 'STARTED' else task.info
+            info = get_task_info({'status': task.status, 'result': task.info})
             context = {
                 'task_status': task.status,
                 'task_id': task.id,
                 'task_info': info,
                 'download': download,
-                'trigger': 'load delay:600ms'
+                'poll': 'poll' in request.GET,
+                'trigger': progress_trigger(request)
+            }
+        elif download.status == Download.Status.QUEUED:
+            add_queue_estimates([download])
+            context = {
+                'download': download,
+                'poll': 'poll' in request.GET,
+                'trigger': progress_trigger(request)
             }
         else:
             context = {'download': download, 'trigger': 'none'}
@@ -255,6 +567,33 @@ class DownloadProgressView(LoginRequiredMixin, View):
         return render(request, "partials/download_progress.html", context)
 
 
+class DownloadMultiProgressView(LoginRequiredMixin, View):
+    def get(self, request):
+        ids = [int(pk) for pk in request.GET.get('ids', '').split(',') if pk.isdigit()]
+        downloads = list(Download.objects.filter(pk__in=ids).select_related('created_by'))
+        add_queue_estimates(downloads)
+        metas = get_task_metas([down.active_task_id for down in downloads
+                                if down.status == Download.Status.STARTED])
+        progress = []
+        for down in downloads:
+            meta = metas.get(down.active_task_id)
+            progress.append({'download': down, 'task_info': get_task_info(meta) if meta else None})
+        context = {
+            'progress': progress,
+            'trigger': 'progress-refresh' if settings.DOWNLOAD_PROGRESS_STREAM else 'none'
+        }
+        context.update(progress_poller_context(request, downloads))
+        return render(request, "partials/download_progress_multi.html", context)
+
+
+class DownloadEventsView(LoginRequiredMixin, View):
+    # The progress stream is served by ProgressStreamApp in asgi.py. Without
+    # it (e.g. under WSGI) a 204 tells the EventSource to stop reconnecting
+    # so the page falls back to polling.
+    def get(self, request):
+        return HttpResponse(status=204)
+
+
 class RegisterView(SuccessMessageMixin, CreateView):
     template_name = 'registration/register.html'
     model = UserProfile
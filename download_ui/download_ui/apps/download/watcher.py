@@ -0,0 +1,223 @@
+import logging
+import os
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Download
+
+try:
+    import inotify_simple
+    from inotify_simple import flags
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger('__name__')
+
+# Milliseconds a read waits for events before checking whether to stop
+READ_TIMEOUT = 1000
+
+# Paths per query when updating downloads by file path
+PATHS_PER_QUERY = 500
+
+
+class LibraryChanges:
+    """The file changes from one batch of inotify events."""
+
+    def __init__(self):
+        # Files and folders deleted or moved out of the library
+        self.removed = set()
+        self.removed_dirs = set()
+        # Files that appeared, a MISSING download at the path is back
+        self.added = set()
+        # Old path to new path for renames inside the library
+        self.moved = {}
+        self.moved_dirs = {}
+        # Events were dropped and only a full check can catch up
+        self.overflowed = False
+
+    def __bool__(self):
+        return bool(self.removed or self.removed_dirs or self.added or self.moved
+                    or self.moved_dirs or self.overflowed)
+
+    def remove(self, path, is_dir):
+        if is_dir:
+            self.removed_dirs.add(path)
+        else:
+            self.added.discard(path)
+            self.removed.add(path)
+
+    def add(self, path):
+        self.removed.discard(path)
+        self.added.add(path)
+
+    def move(self, old, new, is_dir):
+        if is_dir:
+            self.moved_dirs[old] = new
+        else:
+            self.moved[old] = new
+
+
+def _chunks(paths):
+    paths = list(paths)
+    for start in range(0, len(paths), PATHS_PER_QUERY):
+        yield paths[start:start + PATHS_PER_QUERY]
+
+
+def apply_changes(changes):
+    """Write a batch of file changes to the downloads and return the number
+    of rows updated.
+    """
+    now = timezone.now()
+    updated = 0
+
+    # Renames inside the library keep their downloads, with the new path
+    moved = []
+    for chunk in _chunks(changes.moved):
+        for download in Download.objects.filter(file_path__in=chunk).only('id', 'file_path'):
+            download.file_path = changes.moved[download.file_path]
+            moved.append(download)
+    for old, new in changes.moved_dirs.items():
+        for download in Download.objects.filter(
+                file_path__startswith=old + os.sep).only('id', 'file_path'):
+            download.file_path = new + download.file_path[len(old):]
+            moved.append(download)
+    for download in moved:
+        download.updated_at = now
+    Download.objects.bulk_update(moved, ['file_path', 'updated_at'], batch_size=PATHS_PER_QUERY)
+    updated += len(moved)
+
+    completed = Download.objects.filter(status=Download.Status.COMPLETED)
+    for chunk in _chunks(changes.removed):
+        updated += completed.filter(file_path__in=chunk).update(
+            status=Download.Status.MISSING, updated_at=now)
+    if changes.removed_dirs:
+        under = reduce(or_, (Q(file_path__startswith=path + os.sep)
+                             for path in changes.removed_dirs))
+        updated += completed.filter(under).update(
+            status=Download.Status.MISSING, updated_at=now)
+
+    missing = Download.objects.filter(status=Download.Status.MISSING)
+    for chunk in _chunks(changes.added):
+        updated += missing.filter(file_path__in=chunk).update(
+            status=Download.Status.COMPLETED, updated_at=now)
+    return updated
+
+
+class LibraryWatcher:
+    """Watches every folder under the library root with inotify and keeps
+    the download statuses in step with the files.
+
+    Events are gathered for batch_seconds after the first one arrives and
+    written together, so a folder being deleted costs a few queries.
+    """
+
+    def __init__(self, root, batch_seconds):
+        if inotify_simple is None:
+            raise ImproperlyConfigured('The file watcher needs the inotify_simple package')
+        self.root = os.path.normpath(root)
+        self.batch_delay = int(batch_seconds * 1000)
+        self.inotify = inotify_simple.INotify()
+        self.mask = (flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO
+                     | flags.ONLYDIR | flags.DONT_FOLLOW)
+        # Watch descriptor to the folder it watches
+        self.directories = {}
+        self.watch_tree(self.root)
+
+    def close(self):
+        self.inotify.close()
+
+    def watch_tree(self, top):
+        for directory, _, _ in os.walk(top):
+            try:
+                wd = self.inotify.add_watch(directory, self.mask)
+            except OSError as error:
+                # Usually fs.inotify.max_user_watches is too low
+                logger.warning('Could not watch %s: %s', directory, error)
+                continue
+            self.directories[wd] = directory
+
+    def unwatch_tree(self, top):
+        for wd, directory in list(self.directories.items()):
+            if directory == top or directory.startswith(top + os.sep):
+                del self.directories[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    def rename_watches(self, old, new):
+        # A watch follows its folder, only the path needs updating
+        for wd, directory in self.directories.items():
+            if directory == old or directory.startswith(old + os.sep):
+                self.directories[wd] = new + directory[len(old):]
+
+    def collect(self, events):
+        changes = LibraryChanges()
+        moved_from = {}
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                changes.overflowed = True
+                continue
+            directory = self.directories.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self.directories[event.wd]
+                continue
+            path = os.path.join(directory, event.name)
+            is_dir = bool(event.mask & flags.ISDIR)
+            if event.mask & flags.MOVED_FROM:
+                moved_from[event.cookie] = (path, is_dir)
+            elif event.mask & flags.MOVED_TO:
+                old = moved_from.pop(event.cookie, None)
+                if old is not None:
+                    changes.move(old[0], path, is_dir)
+                    if is_dir:
+                        self.rename_watches(old[0], path)
+                elif is_dir:
+                    self.added_tree(path, changes)
+                else:
+                    changes.add(path)
+            elif event.mask & flags.CREATE:
+                if is_dir:
+                    self.added_tree(path, changes)
+                else:
+                    changes.add(path)
+            elif event.mask & flags.DELETE:
+                changes.remove(path, is_dir)
+
+        # Moved somewhere outside the library
+        for path, is_dir in moved_from.values():
+            changes.remove(path, is_dir)
+            if is_dir:
+                self.unwatch_tree(path)
+        return changes
+
+    def added_tree(self, top, changes):
+        # Files can land in a new folder before its watch exists
+        self.watch_tree(top)
+        for directory, _, filenames in os.walk(top):
+            for filename in filenames:
+                changes.add(os.path.join(directory, filename))
+
+    def process(self, events):
+        changes = self.collect(events)
+        if not changes:
+            return 0
+        if changes.overflowed:
+            from .tasks import check_for_missing_files
+            logger.warning('inotify queue overflowed, checking every download')
+            check_for_missing_files()
+        updated = apply_changes(changes)
+        logger.info('File watcher updated %d downloads from %d events', updated, len(events))
+        return updated
+
+    def run(self, stop=lambda: False):
+        while not stop():
+            events = self.inotify.read(timeout=READ_TIMEOUT, read_delay=self.batch_delay)
+            if events:
+                self.process(events)
@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'download_ui.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up by get_asgi_application()
+from download_ui.apps.download.streams import ProgressStreamApp  # noqa: E402
+
+application = ProgressStreamApp(django_application)
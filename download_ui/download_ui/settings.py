@@ -139,6 +139,81 @@ ADMINS = [('Dummy_Admin', 'bozo-who-is-it@gmail.com')]
 # Development
 FILE_PATH_FIELD_DIRECTORY = '/home/magnolia3289/video-downloads'
 
+# Parallel segment downloads for Twitch VODs, keyed by Source name. A
+# download can ask for its own count, everything is capped at the
+# DOWNLOAD_MAX_WORKERS_CAP.
+DOWNLOAD_MAX_WORKERS = {
+    'default': 20,
+}
+DOWNLOAD_MAX_WORKERS_CAP = 64
+
+# Download scheduling. At most DOWNLOAD_SLOTS downloads run at once (keep
+# it at the worker concurrency) and one user gets DOWNLOAD_USER_SLOTS of
+# them, the rest wait in the queue and take turns.
+DOWNLOAD_SLOTS = config('DOWNLOAD_SLOTS', default=4, cast=int)
+DOWNLOAD_USER_SLOTS = config('DOWNLOAD_USER_SLOTS', default=2, cast=int)
+
+# Videos up to DOWNLOAD_SHORT_SECONDS long are queued with high priority,
+# from DOWNLOAD_LONG_SECONDS on with low priority
+DOWNLOAD_SHORT_SECONDS = 10 * 60
+DOWNLOAD_LONG_SECONDS = 2 * 60 * 60
+
+# Run time assumed by the queue estimates until there is download history
+DOWNLOAD_ESTIMATE_SECONDS = 10 * 60
+
+# Playlist and channel batches download every video in one format,
+# (extension, quality, format code) per Command, and take at most
+# DOWNLOAD_BATCH_MAX_ENTRIES videos
+DOWNLOAD_BATCH_FORMATS = {
+    'YTDL': ('mp4', 'best', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]'),
+    'TWDL': ('mkv', 'source', 'source'),
+}
+DOWNLOAD_BATCH_MAX_ENTRIES = config('DOWNLOAD_BATCH_MAX_ENTRIES', default=200, cast=int)
+
+# Bulk imports extract at most DOWNLOAD_BULK_MAX_URLS links, this many at once
+DOWNLOAD_BULK_MAX_URLS = 100
+DOWNLOAD_BULK_EXTRACT_WORKERS = config('DOWNLOAD_BULK_EXTRACT_WORKERS', default=8, cast=int)
+
+# Drafts made without a format chosen get the tallest video up to this
+# height, these extensions win a tie
+DOWNLOAD_DEFAULT_MAX_HEIGHT = 1080
+DOWNLOAD_DEFAULT_EXTENSIONS = ['mp4', 'mkv']
+
+# Hash completed downloads and hardlink identical files to one copy
+DOWNLOAD_DEDUPE = config('DOWNLOAD_DEDUPE', default=True, cast=bool)
+
+# Set when the watch_downloads command is running. Views then trust the
+# download status instead of checking the file on every request.
+DOWNLOAD_FILE_WATCHER = config('DOWNLOAD_FILE_WATCHER', default=False, cast=bool)
+# Seconds the watcher gathers file events for before writing them
+DOWNLOAD_FILE_WATCHER_BATCH_SECONDS = 2.0
+
+# Minimum seconds or percent between progress updates written to the task state
+DOWNLOAD_PROGRESS_MIN_INTERVAL = 1.0
+DOWNLOAD_PROGRESS_MIN_DELTA = 1.0
+
+# Push progress to the home page over Server-Sent Events instead of polling.
+# Needs the ASGI app (asgi.py), polling stays as the fallback.
+DOWNLOAD_PROGRESS_STREAM = config('DOWNLOAD_PROGRESS_STREAM', default=False, cast=bool)
+DOWNLOAD_PROGRESS_REDIS_URL = 'redis://localhost:6379'
+DOWNLOAD_PROGRESS_STREAM_KEEPALIVE = 15.0
+
+# Extraction result cache
+# Seconds an extraction result stays fresh, keyed by Source name
+EXTRACTION_CACHE_TTL = {
+    'default': 6 * 60 * 60,
+    'Twitch': 60 * 60,
+}
+EXTRACTION_CACHE_MAX_ENTRIES = 1000
+
+# Searches the download list. SQLiteFTSSearchBackend uses an FTS5 index and
+# falls back to LikeSearchBackend on other databases.
+DOWNLOAD_SEARCH_BACKEND = config(
+    'DOWNLOAD_SEARCH_BACKEND', default='download_ui.apps.download.search.SQLiteFTSSearchBackend')
+
+# Seconds the total shown on the download list is cached for
+DOWNLOAD_LIST_COUNT_TIMEOUT = 60
+
 # Celery Configuration Options
 CELERY_TIMEZONE = 'America/New_York'
 CELERY_TASK_TRACK_STARTED = True
@@ -149,6 +224,60 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379'
 #: from unwanted access (see userguide/security.html)
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+# Late acked downloads go back on the queue if not acked within this many
+# seconds, keep it above the time limit and the longest retry countdown
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 2 * 60 * 60}
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Downloads failing on network errors are retried up to DOWNLOAD_MAX_RETRIES
+# times, waiting DOWNLOAD_RETRY_BACKOFF seconds and doubling each time up to
+# DOWNLOAD_RETRY_BACKOFF_MAX
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_RETRY_BACKOFF = 30
+DOWNLOAD_RETRY_BACKOFF_MAX = 30 * 60
+
+# The scheduler's lock lives in the broker's Redis, shared by every process
+DOWNLOAD_SCHEDULER_REDIS_URL = CELERY_BROKER_URL
+
+# A started download still running after this many seconds lost its task,
+# every attempt at the time limit, the waits between them and a redelivery
+DOWNLOAD_SLOT_MAX_AGE = ((DOWNLOAD_MAX_RETRIES + 1) * CELERY_TASK_TIME_LIMIT
+                         + DOWNLOAD_MAX_RETRIES * DOWNLOAD_RETRY_BACKOFF_MAX
+                         + CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout'])
+
+# Bandwidth shared by every worker in bytes per second, 0 for no limit.
+# DOWNLOAD_BANDWIDTH_SCHEDULE overrides it by time of day with
+# ('HH:MM', 'HH:MM', bytes per second) windows, the first match wins.
+# DOWNLOAD_BANDWIDTH_SOURCES gives a Source name a budget of its own.
+DOWNLOAD_BANDWIDTH_LIMIT = config('DOWNLOAD_BANDWIDTH_LIMIT', default=0, cast=int)
+DOWNLOAD_BANDWIDTH_SCHEDULE = [
+    # ('18:00', '23:30', 2 * 1024 * 1024),
+]
+DOWNLOAD_BANDWIDTH_SOURCES = {
+    # 'Twitch': 5 * 1024 * 1024,
+}
+# The budgets live in the broker's Redis
+DOWNLOAD_BANDWIDTH_REDIS_URL = CELERY_BROKER_URL
+
+# Celery worker processes keep up to DOWNLOAD_YTDL_POOL_SIZE idle YoutubeDL
+# instances per option profile and build a new one after
+# DOWNLOAD_YTDL_POOL_MAX_USES tasks. 0 turns the pool off
+DOWNLOAD_YTDL_POOL_SIZE = config('DOWNLOAD_YTDL_POOL_SIZE', default=4, cast=int)
+DOWNLOAD_YTDL_POOL_MAX_USES = 50
+
+# Keep-alive HTTP connections shared by the downloaders of a worker process,
+# up to DOWNLOAD_HTTP_POOL_PER_HOST idle ones for each of the last
+# DOWNLOAD_HTTP_POOL_HOSTS hosts. A host's are closed after
+# DOWNLOAD_HTTP_POOL_IDLE_SECONDS without a request
+DOWNLOAD_HTTP_POOL_HOSTS = 32
+DOWNLOAD_HTTP_POOL_PER_HOST = config('DOWNLOAD_HTTP_POOL_PER_HOST', default=20, cast=int)
+DOWNLOAD_HTTP_POOL_IDLE_SECONDS = 60
+
+# Twitch video and clip metadata, looked up directly instead of through
+# twitch-dl's info command
+TWITCH_GQL_URL = 'https://gql.twitch.tv/gql'
+TWITCH_USHER_URL = 'https://usher.twitch.tv/vod'
+TWITCH_HTTP_TIMEOUT = 10
 
 # django-crispy-forms config
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"